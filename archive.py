@@ -0,0 +1,364 @@
+"""A user's notes and attachments as one ZIP archive: export and import.
+
+    notes.ndjson              one JSON object per note, in id order
+    attachments/<sha256>      each attachment file once, however many notes share it
+    attachments/legacy-<id>   an attachment from before the blob store (see blobs.py)
+
+A note's "attachment" field names the member holding its file. Export
+writes the archive while it is being sent: nothing is buffered beyond the
+chunk in flight and no temp file is made. Import reads the archive member
+by member and inserts the notes in batches, one transaction each.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel, Field, ValidationError
+from sqlalchemy import func, insert, select
+from starlette.concurrency import run_in_threadpool
+
+from blobs import BLOB_ROOT, add_blob, blob_path, discard_uploads, legacy_upload_path
+from models import Note, make_excerpt, utcnow
+from pagination import STREAM_BATCH_SIZE
+from search import index_notes
+from shards import new_note_ids
+from uploads import CHUNK_SIZE, StoredUpload, UploadTooLarge
+from versioning import bump_notes_version
+
+ARCHIVE_MEDIA_TYPE = "application/zip"
+NOTES_MEMBER = "notes.ndjson"
+
+# notes per import transaction
+IMPORT_BATCH_SIZE = 500
+# longest notes.ndjson line accepted on import, i.e. the largest note
+MAX_RECORD_BYTES = 16 * 1024 * 1024
+# uncompressed bytes an import may read out of an archive, all members together
+MAX_EXPANDED_BYTES = 4 * 1024 * 1024 * 1024
+
+EXPORT_COLUMNS = (Note.id, Note.title, Note.content, Note.filename, Note.sha256, Note.size,
+                  Note.created_at, Note.updated_at)
+
+
+class InvalidArchive(ValueError):
+    imported = 0  # notes committed by earlier batches before the problem was found
+
+
+class ArchiveTooLarge(HTTPException):
+    # like UploadTooLarge, a 413 wherever it is raised
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"Archive expands to more than {max_bytes} bytes")
+
+
+class ArchivedNote(BaseModel):
+    """One line of notes.ndjson. Other fields of an export (id, sha256, size) are ignored."""
+    title: str = Field(..., min_length=1)
+    content: Optional[str] = None
+    filename: Optional[str] = None
+    attachment: Optional[str] = None  # archive member holding the file
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
+@dataclass
+class ImportResult:
+    notes: int = 0
+    attachments: int = 0  # files read from the archive
+
+
+# ---- export ----
+
+class _Sink:
+    """Write-only, unseekable file for ZipFile that hands back what was written.
+
+    With no seek() ZipFile streams: sizes and CRCs go in a data descriptor
+    after each member instead of being patched into its header.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _member(name: str, compress_type: int, size: Optional[int] = None) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.compress_type = compress_type
+    info.external_attr = 0o644 << 16
+    if size is not None:
+        info.file_size = size  # only decides whether the member needs ZIP64 fields
+    return info
+
+
+def _record(row, attachment: Optional[str]) -> str:
+    return json.dumps({
+        "id": row.id, "title": row.title, "content": row.content, "filename": row.filename,
+        "sha256": row.sha256, "size": row.size, "attachment": attachment,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "updated_at": row.updated_at.isoformat() if row.updated_at else None,
+    }) + "\n"
+
+
+def _existing(paths: dict) -> dict:
+    # {note id: (path, size)} of the legacy files that are still there
+    return {note_id: (path, os.path.getsize(path)) for note_id, path in paths.items() if os.path.isfile(path)}
+
+
+def _copy_chunk(source, out) -> bool:
+    # runs on a worker thread; the read and the CRC both release the GIL
+    chunk = source.read(CHUNK_SIZE)
+    out.write(chunk)
+    return bool(chunk)
+
+
+async def _copy_file(archive, sink, name: str, path: str, size: int) -> AsyncIterator[bytes]:
+    # attachments are mostly images and PDFs, already compressed: stored as they are
+    source = await run_in_threadpool(open, path, "rb")
+    try:
+        with archive.open(_member(name, zipfile.ZIP_STORED, size), "w") as out:
+            while await run_in_threadpool(_copy_chunk, source, out):
+                yield sink.take()
+    finally:
+        source.close()
+
+
+async def export_archive(session_factory, user_id: int, root: str = BLOB_ROOT) -> AsyncIterator[bytes]:
+    """Yield a ZIP of every note of `user_id` and their attachments, chunk by chunk.
+
+    Notes are read from a server-side cursor like stream_notes_ndjson() and
+    compressed on a worker thread; attachment files follow, each read in
+    CHUNK_SIZE pieces. Opens its own session from `session_factory` because
+    the request's session is closed before the body is streamed.
+    """
+    sink = _Sink()
+    legacy = {}
+    async with session_factory() as db:
+        with zipfile.ZipFile(sink, "w") as archive:
+            # force_zip64: the size isn't known up front and may pass 4 GiB
+            with archive.open(_member(NOTES_MEMBER, zipfile.ZIP_DEFLATED), "w", force_zip64=True) as out:
+                result = await db.stream(select(*EXPORT_COLUMNS)
+                                         .where(Note.user_id == user_id)
+                                         .order_by(Note.id)
+                                         .execution_options(yield_per=STREAM_BATCH_SIZE))
+                async for rows in result.partitions():
+                    found = {row.id: path for row in rows if row.filename and not row.sha256
+                             and (path := legacy_upload_path(row.filename, root))}
+                    if found:
+                        found = await run_in_threadpool(_existing, found)
+                        legacy.update(found)
+                    lines = "".join(_record(row, f"attachments/{row.sha256}" if row.sha256
+                                            else f"attachments/legacy-{row.id}" if row.id in found else None)
+                                    for row in rows)
+                    await run_in_threadpool(out.write, lines.encode())
+                    yield sink.take()
+
+            blobs = await db.stream(select(Note.sha256, func.max(Note.size))
+                                    .where(Note.user_id == user_id, Note.sha256.is_not(None))
+                                    .group_by(Note.sha256)
+                                    .execution_options(yield_per=STREAM_BATCH_SIZE))
+            async for sha256, size in blobs:
+                async for chunk in _copy_file(archive, sink, f"attachments/{sha256}", blob_path(sha256, root), size):
+                    yield chunk
+            for note_id, (path, size) in legacy.items():
+                async for chunk in _copy_file(archive, sink, f"attachments/legacy-{note_id}", path, size):
+                    yield chunk
+    yield sink.take()  # the central directory, written when the archive closed
+
+
+# ---- import ----
+
+class _Expansion:
+    """Uncompressed bytes read out of an archive so far, against the import's budget.
+
+    A small archive can inflate to far more than its own size (a zip bomb),
+    so every byte read is counted, not just the size of each member.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total = 0
+
+    def add(self, size: int):
+        self.total += size
+        if self.total > self.max_bytes:
+            raise ArchiveTooLarge(self.max_bytes)
+
+
+def _open_archive(file, max_expanded_bytes: int) -> zipfile.ZipFile:
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise InvalidArchive("not a ZIP archive")
+    # the sizes in the headers can lie, but when they don't there's no need to start
+    if sum(info.file_size for info in archive.infolist()) > max_expanded_bytes:
+        archive.close()
+        raise ArchiveTooLarge(max_expanded_bytes)
+    return archive
+
+
+def _read_records(archive, expansion: _Expansion):
+    try:
+        member = archive.open(NOTES_MEMBER)
+    except KeyError:
+        raise InvalidArchive(f"{NOTES_MEMBER} is missing from the archive")
+    with member:
+        for number, line in enumerate(iter(lambda: member.readline(MAX_RECORD_BYTES + 1), b""), 1):
+            if len(line) > MAX_RECORD_BYTES:
+                raise InvalidArchive(f"{NOTES_MEMBER} line {number}: longer than {MAX_RECORD_BYTES} bytes")
+            expansion.add(len(line))
+            if not line.strip():
+                continue
+            try:
+                yield ArchivedNote.model_validate_json(line)
+            except ValidationError as exc:
+                error = exc.errors()[0]
+                field = ".".join(str(part) for part in error["loc"])
+                raise InvalidArchive(f"{NOTES_MEMBER} line {number}: {field + ': ' if field else ''}{error['msg']}")
+
+
+def _next_batch(records, size: int) -> list:
+    batch = []
+    try:
+        for record in records:
+            batch.append(record)
+            if len(batch) == size:
+                break
+    except (zipfile.BadZipFile, zlib.error) as exc:
+        raise InvalidArchive(f"{NOTES_MEMBER}: {exc}")
+    return batch
+
+
+def _extract(archive, name: str, directory: str, max_bytes: int, expansion: _Expansion) -> StoredUpload:
+    """Copy one member into a temp file in `directory`, hashing it like uploads.save_upload().
+
+    Member names are never used as paths, so an archive can't write outside
+    the store, and the size is counted as the file is read, not taken from
+    the archive's headers.
+    """
+    try:
+        source = archive.open(name)
+    except KeyError:
+        raise InvalidArchive(f"{name} is missing from the archive")
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".import-")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with source, os.fdopen(fd, "wb") as out:
+            while chunk := source.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                expansion.add(len(chunk))
+                digest.update(chunk)
+                out.write(chunk)
+    except (zipfile.BadZipFile, zlib.error) as exc:
+        os.unlink(tmp_path)
+        raise InvalidArchive(f"{name}: {exc}")
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return StoredUpload(path=tmp_path, size=size, sha256=digest.hexdigest())
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+async def _import_batch(session_factory, user_id: int, archive, records, max_attachment_bytes: int,
+                        expansion: _Expansion, root: str, result: ImportResult):
+    # one reference per note, so notes sharing a file share its blob
+    references = Counter(record.attachment for record in records if record.attachment)
+    staged = {}
+    try:
+        # copied out of the archive before the transaction starts, so the write lock isn't held meanwhile
+        for name in references:
+            staged[name] = await run_in_threadpool(_extract, archive, name, os.path.join(root, "tmp"),
+                                                   max_attachment_bytes, expansion)
+
+        async with session_factory() as db:
+            try:
+                for name, stored in staged.items():
+                    await add_blob(db, stored, root, references[name])
+                now = utcnow()
+                rows = []
+                for note_id, record in zip(await new_note_ids(db, len(records)), records):
+                    stored = staged.get(record.attachment)
+                    created_at = _naive_utc(record.created_at) or now
+                    rows.append({
+                        "id": note_id, "title": record.title, "content": record.content,
+                        "excerpt": make_excerpt(record.content), "user_id": user_id,
+                        "filename": os.path.basename(record.filename or record.attachment) if stored else None,
+                        "sha256": stored.sha256 if stored else None, "size": stored.size if stored else None,
+                        "created_at": created_at, "updated_at": _naive_utc(record.updated_at) or created_at,
+                    })
+                # returning the indexed columns, not just ids, so the rows can come back in any order
+                # and SQLAlchemy inserts them many per statement
+                inserted = await db.execute(insert(Note).returning(Note.id, Note.title, Note.content), rows)
+                await index_notes(db, [{**row._mapping, "user_id": user_id} for row in inserted])
+                await bump_notes_version(db, user_id)
+                await db.commit()
+            except BaseException:
+                await discard_uploads(db, list(staged.values()), root)
+                raise
+    finally:
+        # temp files of attachments that never reached add_blob()
+        for stored in staged.values():
+            if os.path.exists(stored.path):
+                os.unlink(stored.path)
+
+    result.notes += len(records)
+    result.attachments += len(staged)
+
+
+async def import_archive(session_factory, user_id: int, file, max_attachment_bytes: int,
+                         root: str = BLOB_ROOT, batch_size: int = IMPORT_BATCH_SIZE,
+                         max_expanded_bytes: int = MAX_EXPANDED_BYTES) -> ImportResult:
+    """Add the notes and attachments of an archive made by export_archive() to `user_id`.
+
+    `file` is a seekable file holding the archive. Notes get new ids and
+    keep their timestamps. Every `batch_size` notes are committed together,
+    so a large archive never holds the write lock for long. If a problem
+    turns up part way through, InvalidArchive (or UploadTooLarge for an
+    attachment over `max_attachment_bytes`, ArchiveTooLarge once more than
+    `max_expanded_bytes` have been uncompressed in all) is raised and the
+    batches committed before it stay imported.
+    """
+    result = ImportResult()
+    expansion = _Expansion(max_expanded_bytes)
+    try:
+        archive = await run_in_threadpool(_open_archive, file, max_expanded_bytes)
+        with archive:
+            records = _read_records(archive, expansion)
+            while batch := await run_in_threadpool(_next_batch, records, batch_size):
+                await _import_batch(session_factory, user_id, archive, batch, max_attachment_bytes, expansion,
+                                    root, result)
+    except InvalidArchive as exc:
+        exc.imported = result.notes
+        raise
+    return result
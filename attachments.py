@@ -0,0 +1,153 @@
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import JSONResponse, Response
+
+# attachments are per-user, so shared caches must not keep them. A URL that
+# names the content (?v=<sha256>) always means the same bytes and can be kept
+# for good; the plain /attachments/{id} is revalidated with the ETag, since a
+# note id (and so its URL) can be reused after the note is deleted
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    """Parse a single `bytes=` range into an inclusive (start, end).
+
+    Returns None when the whole file should be sent instead: the header isn't
+    a valid byte range (e.g. `bytes=2-1`), or asks for several ranges (both
+    allowed by RFC 9110). Raises RangeNotSatisfiable for a range entirely
+    past the end of the file.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, sep, end = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start:
+            if end and int(end) < int(start):
+                return None
+            start, end = int(start), int(end) if end else size - 1
+        else:
+            # suffix range: the last N bytes
+            start, end = max(size - int(end), 0), size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+
+def _not_modified_since(header: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class AttachmentResponse(Response):
+    """Serve a stored attachment with conditional GET and byte-range support.
+
+    Zero-copy: when the server offers the ASGI `http.response.pathsend` or
+    `http.response.zerocopysend` extension the file is handed to it instead
+    of being read through Python; otherwise it is streamed in chunks read on
+    a worker thread.
+    """
+
+    def __init__(self, path: str, etag: str, filename: Optional[str] = None, download: bool = False,
+                 immutable: bool = False):
+        self.path = path
+        self.etag = etag
+        self.immutable = immutable
+        self.filename = filename or os.path.basename(path)
+        self.download = download
+        self.status_code = 200
+        self.background = None
+        self.media_type = mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+        self.init_headers()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            # the note points at a file that is gone from disk
+            return await JSONResponse({"detail": "Attachment not found"}, status_code=404)(scope, receive, send)
+        size = stat_result.st_size
+        request_headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+
+        disposition = "attachment" if self.download else "inline"
+        self.headers.update({
+            "etag": self.etag,
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "cache-control": IMMUTABLE_CACHE_CONTROL if self.immutable else REVALIDATE_CACHE_CONTROL,
+            "accept-ranges": "bytes",
+            "content-disposition": f"{disposition}; filename*=utf-8''{quote(self.filename)}",
+        })
+
+        # conditional GET: If-None-Match wins over If-Modified-Since when both are sent
+        if "if-none-match" in request_headers:
+            not_modified = etag_matches(request_headers["if-none-match"], self.etag)
+        else:
+            not_modified = _not_modified_since(request_headers.get("if-modified-since"), stat_result.st_mtime)
+        if not_modified:
+            del self.headers["content-type"]
+            return await self._send_headers_only(send, 304)
+
+        start, end = 0, size - 1
+        status = 200
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and (if_range is None or if_range == self.etag):
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                self.headers["content-range"] = f"bytes */{size}"
+                self.headers["content-length"] = "0"
+                return await self._send_headers_only(send, 416)
+            if byte_range:
+                start, end = byte_range
+                status = 206
+                self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+
+        count = end - start + 1
+        self.headers["content-length"] = str(count)
+        await send({"type": "http.response.start", "status": status, "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or count <= 0:
+            return await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+        extensions = scope.get("extensions") or {}
+        if status == 200 and "http.response.pathsend" in extensions:
+            return await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+
+        async with await anyio.open_file(self.path, "rb") as file:
+            if "http.response.zerocopysend" in extensions:
+                return await send({"type": "http.response.zerocopysend", "file": file.wrapped.fileno(),
+                                   "offset": start, "count": count, "more_body": False})
+            await file.seek(start)
+            remaining = count
+            while remaining:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": bool(remaining)})
+
+    async def _send_headers_only(self, send, status: int):
+        await send({"type": "http.response.start", "status": status, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
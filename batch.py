@@ -0,0 +1,125 @@
+from collections import Counter
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+from sqlalchemy import delete, insert, select, update
+
+from blobs import release
+from models import Note, make_excerpt, utcnow
+from revisions import delete_revisions, record_revisions
+from search import index_notes, unindex_notes
+from shards import new_note_ids
+from versioning import bump_notes_version
+
+MAX_BATCH_OPS = 1000
+
+
+class BatchOp(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    # atomic: any invalid item rejects the whole batch and nothing is written;
+    # best_effort: invalid items are reported and the rest are applied
+    mode: Literal["atomic", "best_effort"] = "atomic"
+    ops: List[BatchOp] = Field(..., min_length=1, max_length=MAX_BATCH_OPS)
+
+
+def _check(op: BatchOp, seen_ids: set) -> Optional[str]:
+    if op.op == "create":
+        if op.id is not None:
+            return "id is assigned by the server"
+        if not op.title:
+            return "title is required"
+        return None
+    if op.id is None:
+        return "id is required"
+    if op.id in seen_ids:
+        return "note appears more than once in the batch"
+    seen_ids.add(op.id)
+    if op.op == "update" and (op.title is None or op.content is None):
+        return "title and content are required"
+    return None
+
+
+async def apply_batch(db, user_id: int, request: BatchRequest):
+    """Validate and apply a batch of note operations in one transaction.
+
+    Returns (committed, results) with one result per op, in request order.
+    All creates go in one INSERT, all updates in one executemany UPDATE and
+    all deletes in one DELETE, so a batch costs a handful of statements
+    instead of a round trip per note. Ops in a batch are independent of
+    each other: a note may appear at most once, and creates can't be
+    referenced by later ops since their ids are only known afterwards.
+    """
+    errors, seen_ids = {}, set()
+    for index, op in enumerate(request.ops):
+        error = _check(op, seen_ids)
+        if error:
+            errors[index] = error
+
+    # one query checks ownership of every note the batch touches
+    owned = {}
+    if seen_ids:
+        rows = await db.execute(select(Note.id, Note.sha256)
+                                .where(Note.user_id == user_id, Note.id.in_(seen_ids)))
+        owned = {row.id: row.sha256 for row in rows}
+    for index, op in enumerate(request.ops):
+        if index not in errors and op.op != "create" and op.id not in owned:
+            errors[index] = "Note not found"
+
+    if errors and request.mode == "atomic":
+        return False, [_result(index, op, errors.get(index, "not applied: batch rejected"))
+                       for index, op in enumerate(request.ops)]
+
+    applied = [(index, op) for index, op in enumerate(request.ops) if index not in errors]
+    creates = [(index, op) for index, op in applied if op.op == "create"]
+    updates = [op for _, op in applied if op.op == "update"]
+    deletes = [op.id for _, op in applied if op.op == "delete"]
+
+    created_ids = {}
+    if creates:
+        ids = (await db.scalars(
+            insert(Note).returning(Note.id, sort_by_parameter_order=True),
+            [{"id": note_id, "title": op.title, "content": op.content, "excerpt": make_excerpt(op.content),
+              "user_id": user_id}
+             for note_id, (_, op) in zip(await new_note_ids(db, len(creates)), creates)])).all()
+        created_ids = {index: note_id for (index, _), note_id in zip(creates, ids)}
+    if updates:
+        await record_revisions(db, {op.id: (op.title, op.content) for op in updates})
+        now = utcnow()
+        await db.execute(update(Note), [{"id": op.id, "title": op.title, "content": op.content,
+                                         "excerpt": make_excerpt(op.content), "updated_at": now}
+                                        for op in updates])
+    if deletes:
+        await delete_revisions(db, deletes)
+        await db.execute(delete(Note).where(Note.id.in_(deletes), Note.user_id == user_id))
+        for sha256, count in Counter(owned[note_id] for note_id in deletes if owned[note_id]).items():
+            await release(db, sha256, count)
+
+    await index_notes(db, [{"id": created_ids[index], "title": op.title, "content": op.content, "user_id": user_id}
+                           for index, op in creates]
+                          + [{"id": op.id, "title": op.title, "content": op.content, "user_id": user_id}
+                             for op in updates])
+    await unindex_notes(db, deletes)
+    if applied:
+        await bump_notes_version(db, user_id)
+    await db.commit()
+
+    results = []
+    for index, op in enumerate(request.ops):
+        result = _result(index, op, errors.get(index))
+        if index in created_ids:
+            result["id"] = created_ids[index]
+        results.append(result)
+    return True, results
+
+
+def _result(index: int, op: BatchOp, error: Optional[str]) -> dict:
+    result = {"index": index, "op": op.op, "id": op.id, "status": "error" if error else "ok"}
+    if error:
+        result["error"] = error
+    return result
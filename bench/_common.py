@@ -0,0 +1,49 @@
+"""Shared setup for the benchmark scripts.
+
+The engines in database.py and the templates/uploads folders in main.py are
+all relative to the working directory, so each benchmark runs against a
+throw-away directory instead of the real notes.db.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scratch_dir() -> str:
+    """The benchmark's scratch directory, created on first use.
+
+    Child processes started by a benchmark inherit NOTES_BENCH_DIR and share
+    their parent's directory.
+    """
+    workdir = os.environ.get("NOTES_BENCH_DIR")
+    if workdir is None:
+        workdir = os.environ["NOTES_BENCH_DIR"] = tempfile.mkdtemp(prefix="notes-bench-")
+        os.symlink(os.path.join(ROOT, "templates"), os.path.join(workdir, "templates"))
+    return workdir
+
+
+def scratch_app():
+    """chdir into the scratch directory and import the app there.
+
+    Returns the imported `main` module. Must be called before anything
+    imports database.py. httpx's ASGI transport doesn't run the app's
+    lifespan, so each benchmark creates the tables itself. Rate limits are
+    off unless RATE_LIMIT_ENABLED says otherwise.
+    """
+    os.chdir(scratch_dir())
+    sys.path.insert(0, ROOT)
+    # every simulated client comes from one address; the limits would turn most of them away
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    import main
+    return main
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
@@ -0,0 +1,98 @@
+"""Bulk note writes: one request per note vs POST /api/notes/batch.
+
+Creates, updates and then deletes NOTES notes, first through the per-item
+endpoints (a request, a transaction and an fsync per note) and then through
+the batch endpoint in chunks of BATCH_SIZE ops, and reports notes/s for each
+phase.
+
+    python bench/bench_batch.py [--notes 2000] [--batch-size 500]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import async_engine  # noqa: E402
+
+PASSWORD = "secret123"
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def timed(label, count, coro):
+    started = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<7} {count} notes in {elapsed:.2f}s ({count / elapsed:,.0f}/s)")
+    return result
+
+
+async def per_item(client, notes):
+    async def create():
+        ids = []
+        for i in range(notes):
+            res = await client.post("/api/notes", json={"title": f"Note {i}", "content": "per-item body"})
+            ids.append(res.json()["id"])
+        return ids
+
+    async def update(ids):
+        for note_id in ids:
+            await client.put(f"/api/notes/{note_id}", json={"title": "Updated", "content": "per-item edit"})
+
+    async def remove(ids):
+        for note_id in ids:
+            await client.delete(f"/api/notes/{note_id}")
+
+    print("per-item:")
+    ids = await timed("create", notes, create())
+    await timed("update", notes, update(ids))
+    await timed("delete", notes, remove(ids))
+
+
+async def batched(client, notes, batch_size):
+    async def send(ops):
+        results = []
+        for chunk in chunks(ops, batch_size):
+            res = await client.post("/api/notes/batch", json={"ops": chunk})
+            res.raise_for_status()
+            results.extend(res.json()["results"])
+        return [r["id"] for r in results]
+
+    print(f"batch ({batch_size} ops/request):")
+    ids = await timed("create", notes, send([{"op": "create", "title": f"Note {i}", "content": "batch body"}
+                                             for i in range(notes)]))
+    await timed("update", notes, send([{"op": "update", "id": note_id, "title": "Updated", "content": "batch edit"}
+                                       for note_id in ids]))
+    await timed("delete", notes, send([{"op": "delete", "id": note_id} for note_id in ids]))
+
+
+async def run(notes: int, batch_size: int):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/api/register", json={"username": "bench", "email": "bench@example.com",
+                                                 "password": PASSWORD})
+        res = await client.post("/api/login", json={"email": "bench@example.com", "password": PASSWORD})
+        res.raise_for_status()
+
+        await per_item(client, notes)
+        await batched(client, notes, batch_size)
+    await async_engine.dispose()
+    main.password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(run(args.notes, args.batch_size))
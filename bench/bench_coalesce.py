@@ -0,0 +1,97 @@
+"""Bursts of identical note reads, with and without single-flight coalescing.
+
+Seeds USERS users with NOTES notes each. Every round, each user fires a
+burst of BURST identical requests at once (as from several tabs or a
+retrying client) for GET /api/notes and for GET /api/notes/{id}, then saves
+one note, so the next round can't reuse the last one's results. Reports the
+SQL statements the reads ran per request and the request latency, with
+note_reads on and off.
+
+    python bench/bench_coalesce.py [--users 5] [--notes 200] [--burst 10] [--rounds 10]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import async_engine, read_engine  # noqa: E402
+from metrics import SQL_STATEMENTS  # noqa: E402
+
+PASSWORD = "secret123"
+
+
+async def seed(args):
+    users = []
+    transport = httpx.ASGITransport(app=main.app)
+    for u in range(args.users):
+        client = httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None)
+        email = f"user{u}@example.com"
+        await client.post("/api/register", json={"username": f"user{u}", "email": email, "password": PASSWORD})
+        (await client.post("/api/login", json={"email": email, "password": PASSWORD})).raise_for_status()
+        ops = [{"op": "create", "title": f"Note {i}", "content": f"body of note {i} " * 20} for i in range(args.notes)]
+        res = await client.post("/api/notes/batch", json={"ops": ops})
+        users.append((client, [result["id"] for result in res.json()["results"]]))
+    return users
+
+
+async def rounds(args, users):
+    rng = random.Random(args.seed)
+    reads = SQL_STATEMENTS.labels("read")
+    latencies, statements, requests = [], 0, 0
+
+    async def get(client, path):
+        started = time.perf_counter()
+        (await client.get(path)).raise_for_status()
+        latencies.append(time.perf_counter() - started)
+
+    for _ in range(args.rounds):
+        before = reads.value
+        bursts = []
+        for client, ids in users:
+            note_id = rng.choice(ids)
+            bursts += [get(client, "/api/notes") for _ in range(args.burst)]
+            bursts += [get(client, f"/api/notes/{note_id}") for _ in range(args.burst)]
+        await asyncio.gather(*bursts)
+        statements += reads.value - before
+        requests += len(bursts)
+        for client, ids in users:
+            (await client.put(f"/api/notes/{rng.choice(ids)}", json={"title": "Edited", "content": "new"})
+             ).raise_for_status()
+    return statements / requests, latencies
+
+
+async def run(args):
+    users = await seed(args)
+    print(f"{args.users} users x bursts of {args.burst} identical requests, {args.rounds} rounds")
+    print(f"  {'coalescing':<12} {'SQL/request':>12} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for enabled in (False, True):
+        main.note_reads.enabled = enabled
+        main.note_reads.clear()
+        per_request, latencies = await rounds(args, users)
+        print(f"  {'on' if enabled else 'off':<12} {per_request:>12.2f} {percentile(latencies, 50) * 1000:>7.2f}ms "
+              f"{percentile(latencies, 95) * 1000:>7.2f}ms {percentile(latencies, 99) * 1000:>7.2f}ms")
+
+    for client, _ in users:
+        await client.aclose()
+    await async_engine.dispose()
+    await read_engine.dispose()
+    main.password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--notes", type=int, default=200)
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(run(args))
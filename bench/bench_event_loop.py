@@ -0,0 +1,91 @@
+"""Event-loop responsiveness while note writes are in flight.
+
+Fires WRITES concurrent POST /api/notes requests at the app in-process and,
+at the same time, measures how late a 5 ms asyncio.sleep() wakes up. That
+lateness is exactly what every other request in the worker would wait.
+
+    python bench/bench_event_loop.py [--writes 500] [--concurrency 50]
+
+`--mode blocking` runs the same writes through the synchronous SessionLocal
+inside a coroutine, which is what the handlers did before the async port.
+"""
+import argparse
+import asyncio
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import SessionLocal, async_engine  # noqa: E402
+from models import Note, User  # noqa: E402
+
+PROBE_INTERVAL = 0.005
+
+
+async def probe_loop_lag(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+
+async def run(mode: str, writes: int, concurrency: int):
+    main.Base.metadata.drop_all(bind=main.engine)
+    main.Base.metadata.create_all(bind=main.engine)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/api/register", json={"username": "bench", "email": "bench@example.com",
+                                                 "password": "secret123"})
+        await client.post("/api/login", json={"email": "bench@example.com", "password": "secret123"})
+
+        async def async_write(i):
+            res = await client.post("/api/notes", json={"title": f"note {i}", "content": "x" * 2000})
+            res.raise_for_status()
+
+        async def blocking_write(i):
+            db = SessionLocal()
+            try:
+                user = db.query(User).filter(User.username == "bench").first()
+                db.add(Note(title=f"note {i}", content="x" * 2000, user_id=user.id))
+                db.commit()
+            finally:
+                db.close()
+
+        write = async_write if mode == "async" else blocking_write
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(i):
+            async with semaphore:
+                await write(i)
+
+        stop, lags = asyncio.Event(), []
+        probe = asyncio.create_task(probe_loop_lag(stop, lags))
+        started = time.perf_counter()
+        await asyncio.gather(*(bounded(i) for i in range(writes)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe
+
+    # pooled aiosqlite connections belong to this event loop
+    await async_engine.dispose()
+
+    print(f"{mode:>8}: {writes} writes in {elapsed:.2f}s ({writes / elapsed:.0f}/s), "
+          f"loop lag p50={percentile(lags, 50) * 1000:.1f}ms "
+          f"p99={percentile(lags, 99) * 1000:.1f}ms max={max(lags) * 1000:.1f}ms "
+          f"({len(lags)} probes)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mode", choices=["async", "blocking", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["blocking", "async"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        asyncio.run(run(mode, args.writes, args.concurrency))
@@ -0,0 +1,103 @@
+"""Export and re-import of one user's notes: throughput and memory.
+
+Seeds a user with NOTES notes and ATTACHMENTS attachments of ATTACHMENT_KB
+each, writes their export to a file, then imports that file for a second
+user. Reports MB/s and notes/s, and the peak of Python allocations
+(tracemalloc) during each phase; neither should grow with the archive.
+Tracing allocations slows both phases down by a fair margin.
+archive.py is called directly: httpx's ASGI transport holds whole request
+and response bodies in memory, which would hide what the app itself uses.
+
+    python bench/bench_export.py [--notes 20000] [--attachments 20] [--attachment-kb 1024]
+"""
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+
+from _common import scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from archive import export_archive, import_archive  # noqa: E402
+from database import AsyncSessionLocal, async_engine, read_engine  # noqa: E402
+
+PASSWORD = "secret123"
+
+
+async def login(client, name) -> int:
+    res = await client.post("/api/register", json={"username": name, "email": f"{name}@example.com",
+                                                   "password": PASSWORD})
+    res.raise_for_status()
+    (await client.post("/api/login", json={"email": f"{name}@example.com", "password": PASSWORD})).raise_for_status()
+    return res.json()["id"]
+
+
+async def seed(client, args):
+    for start in range(0, args.notes, 1000):
+        ops = [{"op": "create", "title": f"Note {i}", "content": f"body of note {i} " * 20}
+               for i in range(start, min(start + 1000, args.notes))]
+        (await client.post("/api/notes/batch", json={"ops": ops})).raise_for_status()
+    for i in range(args.attachments):
+        res = await client.post("/notes", data={"title": f"Scan {i}"},
+                                files={"file": (f"scan{i}.bin", os.urandom(args.attachment_kb * 1024))})
+        assert res.status_code == 302, res.text
+
+
+async def measure(coro):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+async def export(user_id, path):
+    size = 0
+    with open(path, "wb") as out:
+        async for chunk in export_archive(user_id):
+            size += len(chunk)
+            out.write(chunk)
+    return size
+
+
+async def restore(user_id, path):
+    with open(path, "rb") as archive:
+        return await import_archive(AsyncSessionLocal, user_id, archive, main.settings.MAX_UPLOAD_BYTES)
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        owner = await login(client, "owner")
+        await seed(client, args)
+        client.cookies.clear()
+        restored = await login(client, "restored")
+
+    path = os.path.abspath("export.zip")
+    size, elapsed, peak = await measure(export(owner, path))
+    print(f"  export  {size / 2 ** 20:8.1f} MB in {elapsed:.2f}s ({size / 2 ** 20 / elapsed:,.1f} MB/s), "
+          f"peak allocations {peak / 2 ** 20:.1f} MB")
+    result, elapsed, peak = await measure(restore(restored, path))
+    print(f"  import  {result.notes} notes in {elapsed:.2f}s ({result.notes / elapsed:,.0f}/s), "
+          f"peak allocations {peak / 2 ** 20:.1f} MB")
+
+    await async_engine.dispose()
+    await read_engine.dispose()
+    main.password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=20000)
+    parser.add_argument("--attachments", type=int, default=20)
+    parser.add_argument("--attachment-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(run(args))
@@ -0,0 +1,94 @@
+"""List views with and without note bodies: response size, latency and database size.
+
+Seeds one user with NOTES notes of about NOTE_KB of text each, then pages
+through GET /api/notes (limit 100) REQUESTS times for each of a few ?fields=
+projections, and times GET /mynotes. Also reports the size of the notes
+table next to the raw size of the text, since content over COMPRESS_ABOVE
+bytes is stored compressed.
+
+    python bench/bench_fields.py [--notes 2000] [--note-kb 8] [--requests 200]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import async_engine, read_engine  # noqa: E402
+
+PASSWORD = "secret123"
+WORDS = ("alpha", "budget", "canvas", "draft", "editor", "feature", "garden", "harbor", "invoice", "journal",
+         "kernel", "ledger", "meeting", "network", "orbit", "planner", "quarter", "recipe", "sprint", "ticket")
+PROJECTIONS = (None, "title,excerpt", "title,excerpt,filename,updated_at", "title")
+
+
+def note_text(rng, size):
+    words = []
+    while sum(len(word) + 1 for word in words) < size:
+        words.append(f"{rng.choice(WORDS)}{rng.randrange(1000)}")
+    return " ".join(words)
+
+
+async def seed(client, args):
+    rng = random.Random(args.seed)
+    await client.post("/api/register", json={"username": "bench", "email": "bench@example.com",
+                                             "password": PASSWORD})
+    (await client.post("/api/login", json={"email": "bench@example.com", "password": PASSWORD})).raise_for_status()
+    for start in range(0, args.notes, 500):
+        ops = [{"op": "create", "title": f"Note {i}", "content": note_text(rng, args.note_kb * 1024)}
+               for i in range(start, min(start + 500, args.notes))]
+        (await client.post("/api/notes/batch", json={"ops": ops})).raise_for_status()
+
+
+async def timed(client, args, url, params):
+    rng = random.Random(args.seed)
+    latencies, size = [], 0
+    for _ in range(args.requests):
+        cursor = rng.randrange(args.notes)
+        started = time.perf_counter()
+        res = await client.get(url, params={**params, "cursor": cursor})
+        latencies.append(time.perf_counter() - started)
+        res.raise_for_status()
+        size += len(res.content)
+    return latencies, size / args.requests
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await seed(client, args)
+
+        print(f"{args.notes} notes of {args.note_kb} KiB, {args.requests} requests each")
+        print(f"  {'request':<52} {'bytes':>10} {'p50':>8} {'p95':>8}")
+        rows = [("/api/notes", {"fields": fields} if fields else {}, f"/api/notes?fields={fields or '(default)'}")
+                for fields in PROJECTIONS]
+        rows.append(("/mynotes", {}, "/mynotes (cards show the excerpt)"))
+        for url, params, label in rows:
+            latencies, size = await timed(client, args, url, params)
+            print(f"  {label:<52} {size:>10,.0f} {percentile(latencies, 50) * 1000:>6.2f}ms "
+                  f"{percentile(latencies, 95) * 1000:>6.2f}ms")
+
+    with main.engine.connect() as conn:
+        stored = conn.exec_driver_sql("SELECT sum(pgsize) FROM dbstat WHERE name = 'notes'").scalar()
+    print(f"  notes table {stored / 2 ** 20:.1f} MiB for {args.notes * args.note_kb / 1024:.1f} MiB of text")
+
+    await async_engine.dispose()
+    await read_engine.dispose()
+    main.password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--note-kb", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(run(args))
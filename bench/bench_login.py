@@ -0,0 +1,71 @@
+"""Login throughput as the password-hash pool grows.
+
+Runs LOGINS concurrent POST /api/login requests against the app in-process,
+once per pool size, and reports logins/s and event-loop lag. With scrypt
+running on the pool (GIL released) throughput should scale with the pool
+size up to the number of cores, while the loop stays responsive.
+
+    python bench/bench_login.py [--logins 200] [--pools 1,2,4,8]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import async_engine  # noqa: E402
+from passwords import PasswordHasher  # noqa: E402
+
+PROBE_INTERVAL = 0.005
+PASSWORD = "secret123"
+
+
+async def run(workers: int, logins: int):
+    main.password_hasher = PasswordHasher(n=main.settings.SCRYPT_N, r=main.settings.SCRYPT_R,
+                                          p=main.settings.SCRYPT_P, workers=workers)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        res = await client.post("/api/register", json={"username": "bench", "email": "bench@example.com",
+                                                       "password": PASSWORD})
+        assert res.status_code in (200, 400)
+
+        lags, stop = [], asyncio.Event()
+
+        async def probe():
+            while not stop.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(PROBE_INTERVAL)
+                lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+        async def login():
+            res = await client.post("/api/login", json={"email": "bench@example.com", "password": PASSWORD})
+            res.raise_for_status()
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe_task
+
+    await async_engine.dispose()
+    main.password_hasher.shutdown()
+    print(f"pool={workers:>2}: {logins} logins in {elapsed:.2f}s ({logins / elapsed:.0f}/s), "
+          f"loop lag p99={percentile(lags, 99) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--pools", default=",".join(str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)))
+    args = parser.parse_args()
+
+    main.Base.metadata.drop_all(bind=main.engine)
+    main.Base.metadata.create_all(bind=main.engine)
+    for workers in (int(n) for n in args.pools.split(",")):
+        asyncio.run(run(workers, args.logins))
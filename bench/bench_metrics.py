@@ -0,0 +1,90 @@
+"""What the /metrics instrumentation costs.
+
+First the cost of single operations: a counter increment, a histogram
+observation and a request through MetricsMiddleware around an app that does
+nothing. Then bench_routes.py runs twice on the same seeded data, with
+METRICS_ENABLED=false and with METRICS_ENABLED=true, and the per-route
+latency and throughput are compared.
+
+    python bench/bench_metrics.py [--only "GET /api/notes$|GET /mynotes|POST /api/notes$"] [--requests 300]
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from _common import ROOT
+
+sys.path.insert(0, ROOT)
+
+from metrics import Counter, Histogram, MetricsMiddleware, Registry  # noqa: E402
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def micro(number=200_000):
+    registry = Registry()
+    counter = Counter("bench_total", "", ("route",), registry=registry)
+    histogram = Histogram("bench_seconds", "", ("route",), registry=registry)
+    inc = timeit.timeit(lambda: counter.labels("/api/notes").inc(), number=number) / number
+    observe = timeit.timeit(lambda: histogram.labels("/api/notes").observe(0.012), number=number) / number
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def noop(message):
+        pass
+
+    async def requests(handler, count):
+        scope = {"type": "http", "method": "GET", "path": "/ping"}
+        started = time.perf_counter()
+        for _ in range(count):
+            await handler(dict(scope), None, noop)
+        return (time.perf_counter() - started) / count
+
+    count = number // 10
+    bare = asyncio.run(requests(app, count))
+    wrapped = asyncio.run(requests(MetricsMiddleware(app), count))
+    print("per operation:")
+    print(f"  counter inc            {inc * 1e9:8.0f} ns")
+    print(f"  histogram observe      {observe * 1e9:8.0f} ns")
+    print(f"  middleware, per request {(wrapped - bare) * 1e6:7.2f} us")
+
+
+def run_routes(enabled, args, path):
+    env = dict(os.environ, METRICS_ENABLED=str(enabled).lower())
+    env.pop("NOTES_BENCH_DIR", None)  # each run seeds its own scratch database
+    subprocess.run([sys.executable, os.path.join(HERE, "bench_routes.py"), "--only", args.only,
+                    "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--save", path],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+    with open(path) as f:
+        return json.load(f)["routes"]
+
+
+def macro(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        off = run_routes(False, args, os.path.join(tmp, "off.json"))
+        on = run_routes(True, args, os.path.join(tmp, "on.json"))
+    print("per route (metrics off -> on):")
+    for key, stats in on.items():
+        base = off[key]
+        print(f"  {key:<28} p50 {base['p50_ms']:7.2f} -> {stats['p50_ms']:7.2f}ms   "
+              f"{base['throughput']:>8,.1f} -> {stats['throughput']:>8,.1f}/s "
+              f"({(stats['throughput'] - base['throughput']) / base['throughput']:+.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", default="GET /api/notes$|GET /mynotes|GET /ping|POST /api/notes$")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    micro()
+    macro(args)
@@ -0,0 +1,120 @@
+"""A login flood from one client, and what everyone else sees meanwhile.
+
+An attacker sends RATE guesses a second (POST /api/login with a wrong
+password for one account, from one IP), up to ATTACKERS at a time. Meanwhile another client on
+another IP logs in LOGINS times and reads GET /api/notes READS times.
+Runs once with rate limits off and once per bucket store (memory, then
+sqlite), and reports the other client's latencies and how many of the
+attacker's guesses were actually checked. Also times RateLimiter.hit()
+on its own.
+
+    python bench/bench_ratelimit.py [--rate 500] [--attackers 32] [--logins 10] [--reads 200]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import AsyncSessionLocal, async_engine, read_engine  # noqa: E402
+from ratelimit import MemoryBuckets, SQLiteBuckets  # noqa: E402
+
+PASSWORD = "secret123"
+
+
+def client_for(ip):
+    transport = httpx.ASGITransport(app=main.app, client=(ip, 40000))
+    return httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None)
+
+
+async def timed(samples, coro):
+    started = time.perf_counter()
+    res = await coro
+    samples.append(time.perf_counter() - started)
+    return res
+
+
+async def scenario(args, user):
+    main.rate_limiter.clear()
+    stop = asyncio.Event()
+    statuses = {}
+
+    async def attack(client):
+        # paced, like a client with finite bandwidth, not a loop that gets the next 429 back in microseconds
+        next_at = time.perf_counter()
+        while not stop.is_set():
+            res = await client.post("/api/login", json={"email": "victim@example.com", "password": "guess"})
+            statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+            next_at += args.attackers / args.rate
+            await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+
+    async with client_for("203.0.113.9") as attacker, client_for(f"198.51.100.{user}") as other:
+        email = f"user{user}@example.com"
+        await other.post("/api/register", json={"username": f"user{user}", "email": email, "password": PASSWORD})
+        attackers = [asyncio.create_task(attack(attacker)) for _ in range(args.attackers)]
+        await asyncio.sleep(0.5)  # let the flood build up
+
+        logins, reads = [], []
+        started = time.perf_counter()
+        for _ in range(args.logins):
+            res = await timed(logins, other.post("/api/login", json={"email": email, "password": PASSWORD}))
+            res.raise_for_status()
+        for _ in range(args.reads):
+            (await timed(reads, other.get("/api/notes"))).raise_for_status()
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        await asyncio.gather(*attackers)
+    return logins, reads, statuses, elapsed
+
+
+async def hit_rate(store, count):
+    main.rate_limiter.store = store
+    started = time.perf_counter()
+    for i in range(count):
+        await main.rate_limiter.hit({"write": f"user:{i % 100}"})
+    return count / (time.perf_counter() - started)
+
+
+async def run(args):
+    async with client_for("198.51.100.0") as setup:
+        await setup.post("/api/register", json={"username": "victim", "email": "victim@example.com",
+                                                "password": PASSWORD})
+
+    print(f"{args.rate} guesses/s from {args.attackers} attackers; the other client logs in {args.logins}x and reads {args.reads}x")
+    print(f"  {'limits':<10} {'login p50':>10} {'p95':>9} {'read p50':>9} {'p95':>9} "
+          f"{'guesses checked':>16} {'refused':>8}")
+    runs = [("off", False, None), ("memory", True, MemoryBuckets()), ("sqlite", True, SQLiteBuckets(AsyncSessionLocal))]
+    for user, (label, enabled, store) in enumerate(runs, 1):
+        main.rate_limiter.enabled = enabled
+        if store is not None:
+            main.rate_limiter.store = store
+        logins, reads, statuses, elapsed = await scenario(args, user)
+        print(f"  {label:<10} {percentile(logins, 50) * 1000:>8.1f}ms {percentile(logins, 95) * 1000:>7.1f}ms "
+              f"{percentile(reads, 50) * 1000:>7.2f}ms {percentile(reads, 95) * 1000:>7.2f}ms "
+              f"{statuses.get(401, 0) / elapsed:>14,.1f}/s {statuses.get(429, 0):>8,}")
+
+    main.rate_limiter.enabled = True
+    for label, store in (("memory", MemoryBuckets()), ("sqlite", SQLiteBuckets(AsyncSessionLocal))):
+        print(f"  RateLimiter.hit(), {label}: {await hit_rate(store, args.hits):,.0f}/s")
+
+    await async_engine.dispose()
+    await read_engine.dispose()
+    main.password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=500, help="guesses per second offered")
+    parser.add_argument("--attackers", type=int, default=32)
+    parser.add_argument("--logins", type=int, default=10, help="within the default per-account budget")
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--hits", type=int, default=5000)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(run(args))
@@ -0,0 +1,153 @@
+"""Revision history: storage and rebuild latency of deltas vs full copies.
+
+Makes NOTES notes of about NOTE_KB of text and edits each of them EDITS
+times (a few words replaced, now and then a line added), saving every edit
+through revisions.record_revisions(). Then rebuilds REBUILDS random
+revisions with load_revision(). This runs once per snapshot interval in
+--intervals, and the same edits are also stored as plain full copies in a
+side table for comparison. Interval 1 is a compressed full copy per revision.
+
+    python bench/bench_revisions.py [--notes 20] [--edits 100] [--note-kb 4] [--intervals 1,4,16,64]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+from sqlalchemy import func, insert, select, text  # noqa: E402
+
+import revisions  # noqa: E402
+from database import AsyncSessionLocal, ReadSessionLocal, async_engine, read_engine  # noqa: E402
+from models import Note, NoteRevision, User  # noqa: E402
+
+WORDS = ("alpha", "budget", "canvas", "draft", "editor", "feature", "garden", "harbor", "invoice", "journal",
+         "kernel", "ledger", "meeting", "network", "orbit", "planner", "quarter", "recipe", "sprint", "ticket")
+
+
+def sentence(rng):
+    return " ".join(f"{rng.choice(WORDS)}{rng.randrange(100)}" for _ in range(rng.randint(6, 14))) + ".\n"
+
+
+def edit(rng, content):
+    words = content.split(" ")
+    for _ in range(rng.randint(1, 4)):
+        words[rng.randrange(len(words))] = f"{rng.choice(WORDS)}{rng.randrange(100)}"
+    content = " ".join(words)
+    if rng.random() < 0.2:
+        content += sentence(rng)
+    return content
+
+
+def history(args):
+    """Every version of every note, the same for each interval."""
+    rng = random.Random(args.seed)
+    notes = []
+    for _ in range(args.notes):
+        content = ""
+        while len(content) < args.note_kb * 1024:
+            content += sentence(rng)
+        versions = [content]
+        for _ in range(args.edits):
+            versions.append(edit(rng, versions[-1]))
+        notes.append(versions)
+    return notes
+
+
+async def store(notes, user_id, naive: bool):
+    """Save the versions as revisions; returns the note ids and the seconds spent saving edits."""
+    async with AsyncSessionLocal() as db:
+        ids = (await db.scalars(insert(Note).returning(Note.id, sort_by_parameter_order=True),
+                                [{"title": "Bench", "content": versions[0], "user_id": user_id}
+                                 for versions in notes])).all()
+        await db.commit()
+
+    elapsed = 0.0
+    for note_id, versions in zip(ids, notes):
+        for number, content in enumerate(versions[1:], 2):
+            started = time.perf_counter()
+            async with AsyncSessionLocal() as db:
+                if naive:
+                    await db.execute(text("INSERT INTO naive_revisions VALUES (:note_id, :number, :content)"),
+                                     {"note_id": note_id, "number": number, "content": content})
+                else:
+                    await revisions.record_revision(db, note_id, "Bench", content)
+                await db.execute(Note.__table__.update().where(Note.id == note_id).values(content=content))
+                await db.commit()
+            elapsed += time.perf_counter() - started
+    return ids, elapsed
+
+
+async def rebuild_latencies(ids, notes, args, naive: bool):
+    rng = random.Random(args.seed)
+    latencies = []
+    async with ReadSessionLocal() as db:
+        for _ in range(args.rebuilds):
+            index = rng.randrange(len(ids))
+            number = rng.randint(2, len(notes[index]))
+            started = time.perf_counter()
+            if naive:
+                content = await db.scalar(text("SELECT content FROM naive_revisions WHERE note_id = :id AND number = :n"),
+                                          {"id": ids[index], "n": number})
+            else:
+                content = (await revisions.load_revision(db, ids[index], number))["content"]
+            latencies.append(time.perf_counter() - started)
+            assert content == notes[index][number - 1]
+    return latencies
+
+
+async def run(args):
+    notes = history(args)
+    edits = args.notes * args.edits
+    raw = sum(len(content.encode()) for versions in notes for content in versions[1:])
+    print(f"{args.notes} notes x {args.edits} edits, {raw / edits / 1024:.1f} KiB per version")
+    print(f"  {'storage':<16} {'bytes/revision':>14} {'vs full copy':>12} {'save ms':>8} "
+          f"{'rebuild p50':>11} {'p95':>7} {'max':>7}")
+
+    async with AsyncSessionLocal() as db:
+        user = User(username="bench", email="bench@example.com", password="x")
+        db.add(user)
+        await db.commit()
+
+    async def report(label, stored, saving, latencies):
+        print(f"  {label:<16} {stored / edits:>14,.0f} {stored / raw:>12.1%} {saving / edits * 1000:>8.2f} "
+              f"{percentile(latencies, 50) * 1000:>9.3f}ms {percentile(latencies, 95) * 1000:>5.3f}ms "
+              f"{max(latencies) * 1000:>5.3f}ms")
+
+    ids, saving = await store(notes, user.id, naive=True)
+    async with ReadSessionLocal() as db:
+        stored = await db.scalar(text("SELECT sum(length(CAST(content AS BLOB))) FROM naive_revisions"))
+    await report("full copies", stored, saving, await rebuild_latencies(ids, notes, args, naive=True))
+
+    for interval in args.intervals:
+        revisions.SNAPSHOT_INTERVAL = interval
+        ids, saving = await store(notes, user.id, naive=False)
+        async with ReadSessionLocal() as db:
+            # revision 1 of each note is the unedited version, which full copies don't count
+            stored = await db.scalar(select(func.sum(func.length(NoteRevision.data)))
+                                     .where(NoteRevision.note_id.in_(ids), NoteRevision.number > 1))
+        label = "compressed copies" if interval == 1 else f"deltas, every {interval}"
+        await report(label, stored, saving, await rebuild_latencies(ids, notes, args, naive=False))
+
+    await async_engine.dispose()
+    await read_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=20)
+    parser.add_argument("--edits", type=int, default=100)
+    parser.add_argument("--note-kb", type=int, default=4)
+    parser.add_argument("--intervals", type=lambda value: [int(v) for v in value.split(",")], default=[1, 4, 16, 64])
+    parser.add_argument("--rebuilds", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    with main.engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS naive_revisions (note_id INTEGER, number INTEGER, content TEXT,"
+                             " PRIMARY KEY (note_id, number))")
+    asyncio.run(run(args))
@@ -0,0 +1,586 @@
+"""Throughput and p50/p95/p99 latency of every route in main.py.
+
+Seeds a scratch notes.db with USERS users, each with NOTES notes and
+ATTACHMENTS attachment notes. The same --seed always produces the same data
+and the same requests. Each route then gets WARMUP untimed requests and
+REQUESTS timed ones, CONCURRENCY at a time, sent in-process through httpx's
+ASGI transport. The script refuses to run if a route in main.py has no
+scenario here, so new routes can't go unbenchmarked.
+
+Results can be saved as JSON and compared with an earlier run. A route
+whose p95 latency rose, or whose throughput fell, by more than --threshold
+is a regression, and the script then exits with status 1:
+
+    python bench/bench_routes.py [--users 20] [--notes 200] [--attachments 2] [--requests 200] [--concurrency 8]
+    python bench/bench_routes.py --save baseline.json
+    python bench/bench_routes.py --compare baseline.json [--threshold 0.15] [--save current.json]
+    python bench/bench_routes.py --load current.json --compare baseline.json
+    python bench/bench_routes.py --only "/api/notes"    # a subset, by regex
+"""
+import argparse
+import asyncio
+import io
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import zipfile
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from _common import ROOT, percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+from fastapi.routing import APIRoute  # noqa: E402
+from sqlalchemy import select  # noqa: E402
+
+from archive import NOTES_MEMBER  # noqa: E402
+from batch import MAX_BATCH_OPS  # noqa: E402
+from database import AsyncSessionLocal, async_engine, db_settings, read_engine  # noqa: E402
+from models import Note, User  # noqa: E402
+from sessions import SESSION_COOKIE  # noqa: E402
+
+PASSWORD = "secret123"
+WORDS = ("alpha", "budget", "canvas", "draft", "editor", "feature", "garden", "harbor", "invoice", "journal",
+         "kernel", "ledger", "meeting", "network", "orbit", "planner", "quarter", "recipe", "sprint", "ticket",
+         "upload", "vector", "weekly", "yearly", "zenith")
+BATCH_UPDATES = 10  # ops per POST /api/notes/batch request
+IMPORT_NOTES = 10  # notes per archive sent to POST /api/notes/import, one of them with an attachment
+REVISION_EDITS = 20  # edits made to one note of each user for the revision routes
+
+
+class Skip(Exception):
+    """The seeded dataset has nothing for this route to work on (e.g. --attachments 0)."""
+
+
+@dataclass
+class SeededUser:
+    id: int
+    username: str
+    email: str
+    cookie: str
+    note_ids: List[int] = field(default_factory=list)
+    attachment_ids: List[int] = field(default_factory=list)
+
+    @property
+    def headers(self):
+        return {"Cookie": f"{SESSION_COOKIE}={self.cookie}"}
+
+
+@dataclass
+class Bench:
+    client: httpx.AsyncClient
+    args: argparse.Namespace
+    password_hash: str
+    users: List[SeededUser] = field(default_factory=list)
+    edited: list = field(default_factory=list)  # (user, note id) with REVISION_EDITS revisions, made once
+    _counter: int = 0
+
+    def unique(self) -> int:
+        self._counter += 1
+        return self._counter
+
+
+@dataclass
+class Scenario:
+    method: str
+    path: str
+    build: Callable  # (bench, rng, item) -> (url, httpx request kwargs)
+    ok: tuple = (200,)
+    prepare: Optional[Callable] = None  # async (bench, count) -> one item per request, made before timing
+
+    @property
+    def key(self):
+        return f"{self.method} {self.path}"
+
+
+SCENARIOS = {}
+
+
+def route(method: str, path: str, ok=(200,), prepare=None):
+    def register(build):
+        scenario = Scenario(method, path, build, ok, prepare)
+        SCENARIOS[scenario.key] = scenario
+        return build
+    return register
+
+
+def words(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def pick_note(rng, user):
+    if not user.note_ids:
+        raise Skip("no notes seeded")
+    return rng.choice(user.note_ids)
+
+
+def pick_attachment(rng, bench):
+    users = [user for user in bench.users if user.attachment_ids]
+    if not users:
+        raise Skip("no attachments seeded")
+    user = rng.choice(users)
+    return user, rng.choice(user.attachment_ids)
+
+
+def attachment_file(rng, bench):
+    return {"file": (f"bench-{bench.unique()}.bin", rng.randbytes(bench.args.attachment_kb * 1024),
+                     "application/octet-stream")}
+
+
+# ---- data made before timing, for routes that use something up ----
+
+async def create_users(bench, count, **fields):
+    """Users that nothing else touches, e.g. for password resets, which sign them out."""
+    async with AsyncSessionLocal() as db:
+        users = []
+        for _ in range(count):
+            n = bench.unique()
+            users.append(User(username=f"extra{n}", email=f"extra{n}@example.com", password=bench.password_hash,
+                              **{name: value.format(n=n) for name, value in fields.items()}))
+        db.add_all(users)
+        await db.commit()
+    return users
+
+
+async def create_notes(bench, count):
+    """`count` extra notes spread over the seeded users, as (user, note id) pairs."""
+    per_user = {}
+    for i in range(count):
+        per_user.setdefault(bench.users[i % len(bench.users)].id, []).append(i)
+    items = []
+    for user in bench.users:
+        titles = per_user.get(user.id, [])
+        for start in range(0, len(titles), MAX_BATCH_OPS):
+            ops = [{"op": "create", "title": f"Disposable {i}", "content": "to be deleted"}
+                   for i in titles[start:start + MAX_BATCH_OPS]]
+            res = await bench.client.post("/api/notes/batch", json={"ops": ops}, headers=user.headers)
+            res.raise_for_status()
+            items.extend((user, result["id"]) for result in res.json()["results"])
+    return items
+
+
+async def create_sessions(bench, count):
+    async with AsyncSessionLocal() as db:
+        return [await main.session_store.create(db, bench.users[i % len(bench.users)]) for i in range(count)]
+
+
+async def reset_tokens(bench, count):
+    return [user.reset_token for user in await create_users(bench, count, reset_token="bench-reset-{n}")]
+
+
+async def edited_notes(bench, count):
+    """(user, note id) pairs for notes with a revision history, one note per user."""
+    if not bench.edited:
+        rng = random.Random(f"{bench.args.seed}:edits")
+        for user in bench.users:
+            if not user.note_ids:
+                raise Skip("no notes seeded")
+            note_id = user.note_ids[0]
+            for _ in range(REVISION_EDITS):
+                res = await bench.client.put(f"/api/notes/{note_id}", headers=user.headers,
+                                             json={"title": words(rng, 2, 5), "content": words(rng, 20, 80)})
+                res.raise_for_status()
+            bench.edited.append((user, note_id))
+    return [bench.edited[i % len(bench.edited)] for i in range(count)]
+
+
+async def import_archives(bench, count):
+    """One small archive in export format, sent by every request."""
+    rng = random.Random(f"{bench.args.seed}:import")
+    records = [{"title": words(rng, 2, 5), "content": words(rng, 20, 80)} for _ in range(IMPORT_NOTES)]
+    records[0].update(filename="scan.bin", attachment="attachments/scan")
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(NOTES_MEMBER, "".join(json.dumps(record) + "\n" for record in records))
+        archive.writestr("attachments/scan", rng.randbytes(bench.args.attachment_kb * 1024), zipfile.ZIP_STORED)
+    return [buffer.getvalue()] * count
+
+
+# ---- scenarios, one per route (method + path template) ----
+
+# routes that need no login and no data
+for _path in ("/", "/register", "/login", "/forgot-password", "/ping", "/metrics"):
+    route("GET", _path)(lambda bench, rng, item, path=_path: (path, {}))
+
+
+@route("POST", "/register")
+def register_form(bench, rng, item):
+    n = bench.unique()
+    return "/register", {"data": {"username": f"new{n}", "email": f"new{n}@example.com", "password": PASSWORD}}
+
+
+@route("POST", "/login", ok=(302,))
+def login_form(bench, rng, item):
+    return "/login", {"data": {"email": rng.choice(bench.users).email, "password": PASSWORD}}
+
+
+@route("GET", "/logout", ok=(302,), prepare=create_sessions)
+def logout(bench, rng, cookie):
+    return "/logout", {"headers": {"Cookie": f"{SESSION_COOKIE}={cookie}"}}
+
+
+@route("GET", "/dashboard")
+def dashboard(bench, rng, item):
+    return "/dashboard", {"headers": rng.choice(bench.users).headers}
+
+
+@route("POST", "/notes", ok=(302,))
+def upload_note(bench, rng, item):
+    return "/notes", {"data": {"title": words(rng, 2, 5), "content": words(rng, 20, 80)},
+                      "files": attachment_file(rng, bench), "headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/notes")
+def list_notes(bench, rng, item):
+    return "/notes", {"headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/mynotes")
+def my_notes(bench, rng, item):
+    return "/mynotes", {"headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/viewfile/{note_id}")
+def view_file(bench, rng, item):
+    user = rng.choice(bench.users)
+    return f"/viewfile/{pick_note(rng, user)}", {"headers": user.headers}
+
+
+@route("GET", "/attachments/{note_id}")
+@route("HEAD", "/attachments/{note_id}")
+def attachment(bench, rng, item):
+    user, note_id = pick_attachment(rng, bench)
+    return f"/attachments/{note_id}", {"headers": user.headers}
+
+
+@route("GET", "/editnote/{note_id}")
+def edit_note_page(bench, rng, item):
+    user = rng.choice(bench.users)
+    return f"/editnote/{pick_note(rng, user)}", {"headers": user.headers}
+
+
+@route("POST", "/editnote/{note_id}", ok=(303,))
+def edit_note(bench, rng, item):
+    user = rng.choice(bench.users)
+    return f"/editnote/{pick_note(rng, user)}", {
+        "data": {"title": words(rng, 2, 5), "content": words(rng, 20, 80)}, "headers": user.headers}
+
+
+@route("GET", "/deletenote/{note_id}", ok=(303,), prepare=create_notes)
+def delete_note(bench, rng, item):
+    user, note_id = item
+    return f"/deletenote/{note_id}", {"headers": user.headers}
+
+
+@route("POST", "/api/register")
+def api_register(bench, rng, item):
+    n = bench.unique()
+    return "/api/register", {"json": {"username": f"new{n}", "email": f"new{n}@example.com", "password": PASSWORD}}
+
+
+@route("POST", "/api/login")
+def api_login(bench, rng, item):
+    return "/api/login", {"json": {"email": rng.choice(bench.users).email, "password": PASSWORD}}
+
+
+@route("POST", "/api/logout", prepare=create_sessions)
+def api_logout(bench, rng, cookie):
+    return "/api/logout", {"headers": {"Cookie": f"{SESSION_COOKIE}={cookie}"}}
+
+
+@route("POST", "/api/notes")
+def api_create_note(bench, rng, item):
+    return "/api/notes", {"json": {"title": words(rng, 2, 5), "content": words(rng, 20, 80)},
+                          "headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/api/notes")
+def api_list_notes(bench, rng, item):
+    return "/api/notes", {"headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/api/notes/search")
+def api_search(bench, rng, item):
+    return "/api/notes/search", {"params": {"q": rng.choice(WORDS)}, "headers": rng.choice(bench.users).headers}
+
+
+@route("POST", "/api/notes/batch")
+def api_batch(bench, rng, item):
+    user = rng.choice(bench.users)
+    if not user.note_ids:
+        raise Skip("no notes seeded")
+    ops = [{"op": "update", "id": note_id, "title": words(rng, 2, 5), "content": words(rng, 20, 80)}
+           for note_id in rng.sample(user.note_ids, min(BATCH_UPDATES, len(user.note_ids)))]
+    return "/api/notes/batch", {"json": {"ops": ops}, "headers": user.headers}
+
+
+@route("GET", "/api/notes/export")
+def api_export(bench, rng, item):
+    return "/api/notes/export", {"headers": rng.choice(bench.users).headers}
+
+
+@route("POST", "/api/notes/import", prepare=import_archives)
+def api_import(bench, rng, archive):
+    return "/api/notes/import", {"files": {"file": ("notes.zip", archive, "application/zip")},
+                                 "headers": rng.choice(bench.users).headers}
+
+
+@route("GET", "/api/notes/{note_id}")
+def api_get_note(bench, rng, item):
+    user = rng.choice(bench.users)
+    return f"/api/notes/{pick_note(rng, user)}", {"headers": user.headers}
+
+
+@route("GET", "/api/notes/{note_id}/revisions", prepare=edited_notes)
+def api_revisions(bench, rng, item):
+    user, note_id = item
+    return f"/api/notes/{note_id}/revisions", {"headers": user.headers}
+
+
+@route("GET", "/api/notes/{note_id}/revisions/{number}", prepare=edited_notes)
+def api_revision(bench, rng, item):
+    user, note_id = item
+    return f"/api/notes/{note_id}/revisions/{rng.randint(1, REVISION_EDITS + 1)}", {"headers": user.headers}
+
+
+@route("POST", "/api/notes/{note_id}/revisions/{number}/restore", prepare=edited_notes)
+def api_restore_revision(bench, rng, item):
+    user, note_id = item
+    return f"/api/notes/{note_id}/revisions/{rng.randint(1, REVISION_EDITS + 1)}/restore", {"headers": user.headers}
+
+
+@route("PUT", "/api/notes/{note_id}")
+def api_update_note(bench, rng, item):
+    user = rng.choice(bench.users)
+    return f"/api/notes/{pick_note(rng, user)}", {
+        "json": {"title": words(rng, 2, 5), "content": words(rng, 20, 80)}, "headers": user.headers}
+
+
+@route("DELETE", "/api/notes/{note_id}", prepare=create_notes)
+def api_delete_note(bench, rng, item):
+    user, note_id = item
+    return f"/api/notes/{note_id}", {"headers": user.headers}
+
+
+@route("POST", "/forgot-password")
+def forgot_password(bench, rng, item):
+    return "/forgot-password", {"data": {"email": rng.choice(bench.users).email}}
+
+
+@route("GET", "/reset-password/{token}", prepare=reset_tokens)
+def reset_password_page(bench, rng, token):
+    return f"/reset-password/{token}", {}
+
+
+@route("POST", "/reset-password/{token}", prepare=reset_tokens)
+def reset_password(bench, rng, token):
+    return f"/reset-password/{token}", {"data": {"password": PASSWORD}}
+
+
+def check_coverage():
+    declared = {f"{method} {r.path}" for r in main.app.routes if isinstance(r, APIRoute) for method in r.methods}
+    missing, stale = sorted(declared - SCENARIOS.keys()), sorted(SCENARIOS.keys() - declared)
+    if missing or stale:
+        sys.exit("bench_routes.py is out of step with main.py:\n"
+                 + "".join(f"  no scenario for {key}\n" for key in missing)
+                 + "".join(f"  scenario for a route that no longer exists: {key}\n" for key in stale))
+
+
+# ---- seeding and running ----
+
+async def seed(bench, rng):
+    args = bench.args
+    async with AsyncSessionLocal() as db:
+        users = [User(username=f"bench{i}", email=f"bench{i}@example.com", password=bench.password_hash)
+                 for i in range(args.users)]
+        db.add_all(users)
+        await db.commit()
+        for user in users:
+            bench.users.append(SeededUser(user.id, user.username, user.email, await main.session_store.create(db, user)))
+
+    for user in bench.users:
+        ops = [{"op": "create", "title": words(rng, 2, 5), "content": words(rng, 20, 80)} for _ in range(args.notes)]
+        for start in range(0, len(ops), MAX_BATCH_OPS):
+            res = await bench.client.post("/api/notes/batch", json={"ops": ops[start:start + MAX_BATCH_OPS]},
+                                          headers=user.headers)
+            res.raise_for_status()
+        for _ in range(args.attachments):
+            res = await bench.client.post("/notes", data={"title": words(rng, 2, 5), "content": words(rng, 5, 20)},
+                                          files=attachment_file(rng, bench), headers=user.headers)
+            assert res.status_code == 302, res.text
+
+    async with AsyncSessionLocal() as db:
+        by_id = {user.id: user for user in bench.users}
+        for row in await db.execute(select(Note.id, Note.user_id, Note.filename).order_by(Note.id)):
+            user = by_id[row.user_id]
+            (user.attachment_ids if row.filename else user.note_ids).append(row.id)
+
+
+async def run_scenario(bench, scenario):
+    args = bench.args
+    rng = random.Random(f"{args.seed}:{scenario.key}")
+    count = args.warmup + args.requests
+    try:
+        items = await scenario.prepare(bench, count) if scenario.prepare else [None] * count
+        # built up front, so the requests don't depend on how the event loop interleaves them
+        calls = [scenario.build(bench, rng, item) for item in items]
+    except Skip as reason:
+        return {"skipped": str(reason)}
+
+    latencies, errors = [], []
+
+    async def drain(pending, record):
+        async def client_loop():
+            for url, kwargs in pending:
+                started = time.perf_counter()
+                try:
+                    res = await bench.client.request(scenario.method, url, **kwargs)
+                    ok = res.status_code in scenario.ok
+                except Exception:
+                    ok = False
+                if record:
+                    (latencies if ok else errors).append(time.perf_counter() - started)
+        await asyncio.gather(*(client_loop() for _ in range(args.concurrency)))
+
+    await drain(iter(calls[:args.warmup]), record=False)
+    started = time.perf_counter()
+    await drain(iter(calls[args.warmup:]), record=True)
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": args.requests,
+        "errors": len(errors),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies, default=0) * 1000, 3),
+    }
+
+
+async def run(args):
+    selected = [s for s in SCENARIOS.values() if not args.only or re.search(args.only, s.key)]
+    transport = httpx.ASGITransport(app=main.app)
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            bench = Bench(client, args, await main.password_hasher.hash(PASSWORD))
+            started = time.perf_counter()
+            await seed(bench, random.Random(args.seed))
+            print(f"seeded {args.users} users x {args.notes} notes x {args.attachments} attachments "
+                  f"in {time.perf_counter() - started:.1f}s")
+
+            routes = {}
+            for scenario in selected:
+                routes[scenario.key] = stats = await run_scenario(bench, scenario)
+                print_row(scenario.key, stats)
+        return routes
+    finally:
+        # the pools' connection threads would keep the process alive, even after an error
+        await async_engine.dispose()
+        await read_engine.dispose()
+        main.password_hasher.shutdown()
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_row(key, stats):
+    if "skipped" in stats:
+        print(f"  {key:<36} skipped: {stats['skipped']}")
+        return
+    print(f"  {key:<36} {stats['throughput']:>9,.1f}/s   p50={stats['p50_ms']:7.2f}ms   "
+          f"p95={stats['p95_ms']:7.2f}ms   p99={stats['p99_ms']:7.2f}ms   errors={stats['errors']}")
+
+
+def change(before, after):
+    return (after - before) / before if before else 0.0
+
+
+def compare(baseline, current, threshold, min_delta_ms):
+    """Print how `current` differs from `baseline` and return the regressed routes."""
+    if baseline["config"] != current["config"]:
+        print(f"warning: the runs used different settings\n  baseline {baseline['config']}\n"
+              f"  current  {current['config']}")
+    print(f"compared with {baseline['meta'].get('git_revision') or 'baseline'} "
+          f"(regression: >{threshold:.0%} worse p95 or throughput):")
+    regressions = []
+    for key, now in current["routes"].items():
+        before = baseline["routes"].get(key)
+        if before is None or "skipped" in before or "skipped" in now:
+            print(f"  {key:<36} not comparable")
+            continue
+        p95, throughput = change(before["p95_ms"], now["p95_ms"]), change(before["throughput"], now["throughput"])
+        reasons = []
+        if p95 > threshold and now["p95_ms"] - before["p95_ms"] >= min_delta_ms:
+            reasons.append("p95")
+        if throughput < -threshold:
+            reasons.append("throughput")
+        if now["errors"] > before["errors"]:
+            reasons.append("errors")
+        if reasons:
+            regressions.append(key)
+        print(f"  {key:<36} p95 {before['p95_ms']:7.2f} -> {now['p95_ms']:7.2f}ms ({p95:+6.1%})   "
+              f"{before['throughput']:>9,.1f} -> {now['throughput']:>9,.1f}/s ({throughput:+6.1%})"
+              + (f"   REGRESSED ({', '.join(reasons)})" if reasons else ""))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--notes", type=int, default=200, help="notes per user")
+    parser.add_argument("--attachments", type=int, default=2, help="attachment notes per user")
+    parser.add_argument("--attachment-kb", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", help="regex; run just the routes whose 'METHOD /path' matches")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--load", help="read results from this JSON file instead of running")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative change that counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="ignore p95 increases smaller than this, however large relatively")
+    args = parser.parse_args()
+    if args.users < 1:
+        parser.error("--users must be at least 1")
+
+    if args.load:
+        with open(args.load) as f:
+            results = json.load(f)
+    else:
+        check_coverage()
+        main.Base.metadata.drop_all(bind=main.engine)
+        main.Base.metadata.create_all(bind=main.engine)
+        main.engine.dispose()
+        results = {
+            "meta": {"git_revision": git_revision(), "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                     "python": platform.python_version(), "platform": platform.platform(),
+                     "sqlite": db_settings.model_dump()},
+            "config": {name: getattr(args, name) for name in ("users", "notes", "attachments", "attachment_kb",
+                                                              "requests", "warmup", "concurrency", "seed")},
+            "routes": asyncio.run(run(args)),
+        }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold, args.min_delta_ms)
+        if regressions:
+            sys.exit(f"{len(regressions)} route(s) regressed: {', '.join(regressions)}")
@@ -0,0 +1,142 @@
+"""Write throughput as note storage is spread over more shards.
+
+For each shard count (0: every note in notes.db), PROCESSES worker
+processes run WRITERS clients each against a fresh scratch directory. Every
+client is logged in as its own user and, for SECONDS, saves notes as fast
+as it is answered: POST /api/notes, then a PUT to the note it created.
+Reports writes/s, p50/p99 write latency and failed writes per shard count.
+
+    python bench/bench_shards.py [--shards 0 1 2 4 8] [--processes 4] [--writers 8] [--seconds 10]
+
+Each shard count runs in its own interpreter, since SQLITE_SHARDS is read
+when the app is imported.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from _common import ROOT, percentile, scratch_app, scratch_dir
+
+PASSWORD = "secret123"
+
+
+def email(process, writer):
+    return f"writer{process}-{writer}@example.com"
+
+
+async def write_loop(client, deadline, latencies, errors):
+    i = 0
+    while time.perf_counter() < deadline:
+        for attempt in ("create", "update"):
+            started = time.perf_counter()
+            try:
+                if attempt == "create":
+                    res = await client.post("/api/notes", json={"title": f"Note {i}", "content": "load test " * 20})
+                    note_id = res.json().get("id")
+                else:
+                    res = await client.put(f"/api/notes/{note_id}", json={"title": f"Note {i}",
+                                                                          "content": "edited " * 20})
+                ok = res.status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors.append(attempt)
+                break
+        i += 1
+
+
+async def run_worker(main, process, writers, seconds):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    clients = [httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) for _ in range(writers)]
+    for writer, client in enumerate(clients):
+        res = await client.post("/api/login", json={"email": email(process, writer), "password": PASSWORD})
+        res.raise_for_status()
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(write_loop(client, deadline, latencies, errors) for client in clients))
+    for client in clients:
+        await client.aclose()
+    await main.shards.dispose()
+    await main.async_engine.dispose()
+    await main.read_engine.dispose()
+    main.password_hasher.shutdown()
+    return latencies, errors
+
+
+def worker(args):
+    # runs in a spawned process (forking would copy the parent's idle thread pools)
+    return asyncio.run(run_worker(scratch_app(), *args))
+
+
+async def register(main, processes, writers):
+    import httpx
+
+    # done up front and one at a time, so setup can't fail under the load being measured
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for process in range(processes):
+            for writer in range(writers):
+                res = await client.post("/api/register", json={"username": f"writer{process}-{writer}",
+                                                               "email": email(process, writer), "password": PASSWORD})
+                res.raise_for_status()
+    await main.async_engine.dispose()
+    await main.read_engine.dispose()
+
+
+def run(args):
+    """One shard count, in this interpreter: SQLITE_SHARDS and NOTES_BENCH_DIR are already set."""
+    main = scratch_app()
+    from migrations import init_database
+
+    init_database(main.engine)
+    main.shards.init()
+    asyncio.run(register(main, args.processes, args.writers))
+    main.engine.dispose()
+    jobs = [(process, args.writers, args.seconds) for process in range(args.processes)]
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.map(worker, jobs)
+    latencies = [t for process_latencies, _ in results for t in process_latencies]
+    errors = sum(len(process_errors) for _, process_errors in results)
+    print(json.dumps({"writes": len(latencies), "p50": percentile(latencies, 50),
+                      "p99": percentile(latencies, 99), "errors": errors}))
+
+
+def compare(args):
+    print(f"{args.processes} processes x {args.writers} writers, {args.seconds:g}s per shard count")
+    print(f"  {'shards':>6} {'writes/s':>10} {'p50':>9} {'p99':>9} {'failed':>7}")
+    for shards in args.shards:
+        workdir = os.path.join(scratch_dir(), f"shards-{shards}")
+        os.makedirs(workdir)
+        os.symlink(os.path.join(ROOT, "templates"), os.path.join(workdir, "templates"))
+        env = {**os.environ, "SQLITE_SHARDS": str(shards), "NOTES_BENCH_DIR": workdir}
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", "--processes", str(args.processes),
+                              "--writers", str(args.writers), "--seconds", str(args.seconds)],
+                             env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"  {shards:>6} {result['writes'] / args.seconds:>10,.0f} {result['p50'] * 1000:>7.1f}ms "
+              f"{result['p99'] * 1000:>7.1f}ms {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4, 8])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args)
+    else:
+        compare(args)
@@ -0,0 +1,107 @@
+"""Concurrent read/write load against the SQLite engine profile.
+
+Each of PROCESSES worker processes runs READERS clients hammering GET
+/api/notes and WRITERS clients creating notes, all against one scratch
+notes.db, for SECONDS. Reports reads/s, writes/s, p50/p99 latencies and how
+many requests failed (e.g. "database is locked").
+
+Compare profiles by overriding the SQLITE_* settings, e.g. the old
+rollback-journal behaviour:
+
+    python bench/bench_sqlite.py [--processes 2] [--readers 8] [--writers 4] [--seconds 10]
+    SQLITE_JOURNAL_MODE=delete SQLITE_BUSY_TIMEOUT_MS=0 python bench/bench_sqlite.py
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from _common import percentile, scratch_app
+
+main = scratch_app()
+
+import httpx  # noqa: E402
+
+from database import async_engine, db_settings, read_engine  # noqa: E402
+
+PASSWORD = "secret123"
+
+
+async def client_loop(client, kind, deadline, latencies, errors):
+    i = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if kind == "write":
+                res = await client.post("/api/notes", json={"title": f"Note {i}", "content": "load test"})
+            else:
+                res = await client.get("/api/notes", params={"limit": 50})
+            ok = res.status_code == 200
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(kind)
+        i += 1
+
+
+async def run_worker(index, readers, writers, seconds):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        email = f"bench{index}@example.com"
+        (await client.post("/api/login", json={"email": email, "password": PASSWORD})).raise_for_status()
+
+        reads, writes, errors = [], [], []
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(client_loop(client, "read", deadline, reads, errors) for _ in range(readers)),
+                             *(client_loop(client, "write", deadline, writes, errors) for _ in range(writers)))
+    await async_engine.dispose()
+    await read_engine.dispose()
+    main.password_hasher.shutdown()
+    return reads, writes, errors
+
+
+async def register(processes):
+    # done up front and one at a time, so setup can't fail under the profile being measured
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for index in range(processes):
+            await client.post("/api/register", json={"username": f"bench{index}",
+                                                     "email": f"bench{index}@example.com", "password": PASSWORD})
+    await async_engine.dispose()
+    await read_engine.dispose()
+
+
+def worker(args):
+    # runs in a spawned process (forking would copy the parent's idle thread pools)
+    return asyncio.run(run_worker(*args))
+
+
+def report(label, latencies, seconds):
+    print(f"  {label:<6} {len(latencies) / seconds:>8,.0f}/s   p50={percentile(latencies, 50) * 1000:6.1f}ms   "
+          f"p99={percentile(latencies, 99) * 1000:6.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    main.Base.metadata.create_all(bind=main.engine)
+    asyncio.run(register(args.processes))
+    main.engine.dispose()
+    jobs = [(i, args.readers, args.writers, args.seconds) for i in range(args.processes)]
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.map(worker, jobs)
+
+    print(f"journal_mode={db_settings.JOURNAL_MODE} synchronous={db_settings.SYNCHRONOUS} "
+          f"busy_timeout={db_settings.BUSY_TIMEOUT_MS}ms, {args.processes} processes x "
+          f"({args.readers} readers + {args.writers} writers):")
+    report("reads", [t for reads, _, _ in results for t in reads], args.seconds)
+    report("writes", [t for _, writes, _ in results for t in writes], args.seconds)
+    errors = [e for _, _, errs in results for e in errs]
+    print(f"  failed {len(errors)} ({errors.count('read')} reads, {errors.count('write')} writes)")
@@ -0,0 +1,78 @@
+"""Cold start: how long a new worker takes to import and answer its first request.
+
+Each run starts a fresh interpreter, as a scale-to-zero host does, in a
+scratch directory. It measures:
+  import   `import main` alone, in its own interpreter
+  ready    from starting uvicorn until GET /ping first answers
+  first    the first GET PATH after that (cold templates, caches and pools)
+
+The first run also creates the database; later runs find it in place.
+
+    python bench/bench_startup.py [--runs 5] [--path /login]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from _common import ROOT, scratch_dir
+
+PORT = 8765
+IMPORT_SNIPPET = (f"import sys, time; sys.path.insert(0, {ROOT!r}); started = time.perf_counter(); "
+                  "import main; print(time.perf_counter() - started)")
+
+
+def time_import(workdir):
+    out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=workdir, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def time_first_response(workdir, path, timeout=30.0):
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT,
+                               "--port", str(PORT), "--log-level", "warning"], cwd=workdir)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{PORT}") as client:
+            while True:
+                try:
+                    client.get("/ping").raise_for_status()
+                    break
+                except httpx.TransportError:
+                    if server.poll() is not None or time.perf_counter() - started > timeout:
+                        raise RuntimeError("uvicorn didn't start")
+                    time.sleep(0.005)
+            ready = time.perf_counter() - started
+            first_started = time.perf_counter()
+            client.get(path)
+            return ready, time.perf_counter() - first_started
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(label, samples):
+    print(f"  {label:<7} median {statistics.median(samples) * 1000:7.1f}ms   min {min(samples) * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/login")
+    args = parser.parse_args()
+
+    workdir = scratch_dir()
+    imports, ready, first = [], [], []
+    for _ in range(args.runs):
+        imports.append(time_import(workdir))
+        r, f = time_first_response(workdir, args.path)
+        ready.append(r)
+        first.append(f)
+    print(f"{args.runs} cold starts ({'with' if os.environ.get('MAIL_USERNAME') else 'without'} MAIL_* set):")
+    report("import", imports)
+    report("ready", ready)
+    report("first", first)
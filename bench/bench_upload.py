@@ -0,0 +1,97 @@
+"""Attachment write throughput: old shutil.copyfileobj path vs uploads.save_upload.
+
+Writes FILES uploads of SIZE_MB each, CONCURRENCY at a time, while probing
+event-loop lag. The old path copies synchronously inside the coroutine, so
+its throughput looks fine but nothing else in the worker runs meanwhile.
+
+    python bench/bench_upload.py [--files 20] [--size-mb 50] [--concurrency 4]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from _common import ROOT, percentile
+
+sys.path.insert(0, ROOT)
+
+from starlette.datastructures import UploadFile  # noqa: E402
+
+from uploads import save_upload  # noqa: E402
+
+PROBE_INTERVAL = 0.005
+
+
+def make_upload(source_path: str) -> UploadFile:
+    return UploadFile(open(source_path, "rb"), filename="bench.bin")
+
+
+async def old_path(upload: UploadFile, directory: str, name: str):
+    with open(os.path.join(directory, name), "wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer)
+
+
+async def new_path(upload: UploadFile, directory: str, name: str):
+    stored = await save_upload(upload, directory, max_bytes=1 << 40)
+    os.replace(stored.path, os.path.join(directory, name))
+
+
+async def run(label, write, source_path, files, concurrency, directory):
+    lags, stop = [], asyncio.Event()
+
+    async def probe():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            lags.append(time.perf_counter() - started - PROBE_INTERVAL)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            upload = make_upload(source_path)
+            try:
+                await write(upload, directory, f"{label}-{i}.bin")
+            finally:
+                await upload.close()
+
+    probe_task = asyncio.create_task(probe())
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(files)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await probe_task
+
+    total_mb = files * os.path.getsize(source_path) / 1e6
+    print(f"{label:>4}: {total_mb:.0f} MB in {elapsed:.2f}s ({total_mb / elapsed:.0f} MB/s), "
+          f"loop lag p99={percentile(lags, 99) * 1000:.1f}ms max={max(lags, default=0) * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-mb", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="notes-bench-upload-")
+    try:
+        source_path = os.path.join(workdir, "source.bin")
+        with open(source_path, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        for label, write in (("old", old_path), ("new", new_path)):
+            directory = os.path.join(workdir, label)
+            os.makedirs(directory)
+            asyncio.run(run(label, write, source_path, args.files, args.concurrency, directory))
+            shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import case, delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+from starlette.concurrency import run_in_threadpool
+
+from models import Blob, Note, utcnow
+from uploads import save_upload
+
+logger = logging.getLogger(__name__)
+
+BLOB_ROOT = "uploads"
+
+# an orphaned blob is kept this long in case the same content is uploaded again
+ORPHAN_GRACE = timedelta(hours=1)
+SWEEP_BATCH_SIZE = 200
+
+
+def blob_key(sha256: str) -> str:
+    """Path of a blob relative to the store root: ab/cd/abcd...
+
+    Two levels of 256-way sharding keep every directory small no matter how
+    many attachments are stored.
+    """
+    return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+
+def blob_path(sha256: str, root: str = BLOB_ROOT) -> str:
+    return os.path.join(root, blob_key(sha256))
+
+
+def legacy_upload_path(filename: str, root: str = BLOB_ROOT) -> Optional[str]:
+    """uploads/<filename> of a note from before the blob store, or None if that leaves `root`.
+
+    Those names were stored exactly as the client sent them, so one like
+    "../notes.db" must not be followed.
+    """
+    root_path = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, filename))
+    if os.path.dirname(path) != root_path:
+        return None
+    return path
+
+
+def attachment_path(note, root: str = BLOB_ROOT) -> Optional[str]:
+    """Where a note's attachment lives: the blob store, or uploads/<name> for legacy notes."""
+    if note.sha256:
+        return blob_path(note.sha256, root)
+    return legacy_upload_path(note.filename, root)
+
+
+async def store_upload(db, upload, max_bytes: int, root: str = BLOB_ROOT):
+    """Stream an upload into the store and take a reference on its blob.
+
+    Identical content is kept once: if the blob already exists the new copy
+    is discarded and only the reference count goes up. Returns the
+    StoredUpload (sha256, size, created). The caller commits, or calls
+    discard_upload() if it doesn't.
+    """
+    stored = await save_upload(upload, os.path.join(root, "tmp"), max_bytes)
+    await add_blob(db, stored, root)
+    return stored
+
+
+async def add_blob(db, stored, root: str = BLOB_ROOT, references: int = 1):
+    """Move a file saved by save_upload() into the store and take `references` on its blob.
+
+    The temp file is gone afterwards, moved into place or deleted as a
+    duplicate, also when this raises.
+    """
+    try:
+        await acquire(db, stored.sha256, stored.size, references)
+        path = blob_path(stored.sha256, root)
+        if os.path.exists(path):
+            os.unlink(stored.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(stored.path, path)
+            stored.created = True
+    except BaseException:
+        if os.path.exists(stored.path):
+            os.unlink(stored.path)
+        raise
+
+
+async def discard_upload(db, stored, root: str = BLOB_ROOT):
+    """Undo store_upload() when whatever was to reference the blob isn't saved.
+
+    The file is removed (if this upload created it) before rolling back:
+    until then the transaction holds the write lock, so no other upload of
+    the same content can have started relying on the file.
+    """
+    await discard_uploads(db, [stored], root)
+
+
+async def discard_uploads(db, stored_uploads, root: str = BLOB_ROOT):
+    """discard_upload() for several uploads added in the same transaction."""
+    created = [stored.sha256 for stored in stored_uploads if stored.created]
+    if created:
+        await run_in_threadpool(_unlink_blobs, created, root)
+    await db.rollback()
+
+
+def acquire_statement(sha256: str, size: int, count: int = 1):
+    return (insert(Blob)
+            .values(sha256=sha256, size=size, refcount=count, created_at=utcnow())
+            .on_conflict_do_update(index_elements=[Blob.sha256],
+                                   set_={"refcount": Blob.refcount + count, "orphaned_at": None}))
+
+
+def release_statement(sha256: str, count: int = 1):
+    return (update(Blob)
+            .where(Blob.sha256 == sha256)
+            .values(refcount=Blob.refcount - count,
+                    orphaned_at=case((Blob.refcount <= count, utcnow()), else_=Blob.orphaned_at)))
+
+
+async def acquire(db, sha256: str, size: int, count: int = 1):
+    await db.execute(acquire_statement(sha256, size, count))
+
+
+async def release(db, sha256: str, count: int = 1):
+    """Drop `count` references; the sweeper reclaims the file once nothing uses it."""
+    await db.execute(release_statement(sha256, count))
+
+
+async def sweep_orphans(session_factory, root: str = BLOB_ROOT, batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """Delete unreferenced blobs past their grace period, one batch per transaction.
+
+    Rows are deleted (re-checking refcount in the DELETE itself, so a blob
+    that was just referenced again survives), then the files, and only then
+    is the transaction committed. Until the commit an upload of the same
+    content waits in acquire(); afterwards it finds no row and no file and
+    puts its own copy in place. Returns the number of blobs reclaimed.
+    """
+    reclaimed = 0
+    while True:
+        async with session_factory() as db:
+            cutoff = utcnow() - ORPHAN_GRACE
+            candidates = (await db.scalars(
+                select(Blob.sha256)
+                .where(Blob.refcount <= 0, Blob.orphaned_at < cutoff)
+                .limit(batch_size))).all()
+            if not candidates:
+                return reclaimed
+            deleted = (await db.scalars(
+                delete(Blob)
+                .where(Blob.sha256.in_(candidates), Blob.refcount <= 0)
+                .returning(Blob.sha256))).all()
+            await run_in_threadpool(_unlink_blobs, deleted, root)
+            await db.commit()
+
+        reclaimed += len(deleted)
+        if len(candidates) < batch_size:
+            return reclaimed
+
+
+def _unlink_blobs(sha256s, root):
+    for sha256 in sha256s:
+        try:
+            os.unlink(blob_path(sha256, root))
+        except FileNotFoundError:
+            pass
+
+
+async def run_sweeper(session_factory, interval: float, root: str = BLOB_ROOT):
+    """Background task: sweep orphaned blobs every `interval` seconds."""
+    while True:
+        try:
+            reclaimed = await sweep_orphans(session_factory, root)
+            if reclaimed:
+                logger.info("Reclaimed %d orphaned blobs", reclaimed)
+        except Exception:
+            logger.exception("Blob sweep failed")
+        await asyncio.sleep(interval)
+
+
+def import_legacy_uploads(session, root: str = BLOB_ROOT) -> int:
+    """Move uploads/<filename> attachments of older notes into the blob store.
+
+    Notes that pointed at the same file name all end up referencing the
+    same blob. Returns the number of notes migrated.
+    """
+    notes = session.scalars(select(Note).where(Note.filename.is_not(None), Note.sha256.is_(None))).all()
+    hashed = {}
+    migrated = 0
+    for note in notes:
+        legacy_path = legacy_upload_path(note.filename, root)
+        if note.filename not in hashed:
+            if legacy_path is None or not os.path.isfile(legacy_path):
+                continue
+            digest = hashlib.sha256()
+            with open(legacy_path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+            hashed[note.filename] = (digest.hexdigest(), os.path.getsize(legacy_path))
+
+        sha256, size = hashed[note.filename]
+        session.execute(acquire_statement(sha256, size))
+        note.sha256, note.size = sha256, size
+        migrated += 1
+    session.commit()
+
+    for filename, (sha256, _) in hashed.items():
+        path = blob_path(sha256, root)
+        legacy_path = legacy_upload_path(filename, root)
+        if os.path.exists(path):
+            os.unlink(legacy_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(legacy_path, path)
+    return migrated
+
+
+if __name__ == "__main__":
+    # python blobs.py import-legacy  -> move uploads/<name> files into the blob store
+    from database import SessionLocal, engine
+    from migrations import init_database
+
+    if sys.argv[1:] != ["import-legacy"]:
+        sys.exit("usage: python blobs.py import-legacy")
+
+    init_database(engine)
+    with SessionLocal() as session:
+        count = import_legacy_uploads(session)
+    print(f"Moved {count} note attachments into the blob store")
@@ -0,0 +1,72 @@
+"""Single-flight reads: concurrent requests for the same thing share one fetch.
+
+A burst of identical requests (several tabs, a client retrying) would
+otherwise run the same queries and serialise the same JSON once each.
+SingleFlight.run() starts the fetch for the first caller of a key; callers
+that arrive while it runs await the same task, and for `ttl` seconds
+afterwards they get its result without fetching at all.
+
+Keys are tuples starting with the user id. Callers put everything the
+result depends on in the key, the user's notes_version included, so a
+cached result is never served for a newer version of the notes, even
+one written by another worker. invalidate() additionally drops what this
+worker holds for a user as soon as it changes something of theirs.
+"""
+import asyncio
+from functools import partial
+
+from cache import TTLCache
+from metrics import COALESCED_READS
+
+_MISSING = object()
+
+
+class SingleFlight:
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 2.0, enabled: bool = True):
+        self.enabled = enabled
+        self._in_flight = {}
+        # key -> (user id, result), so invalidate() can find a user's entries
+        self._recent = TTLCache(maxsize, ttl)
+
+    async def run(self, key: tuple, fetch, remember: bool = True):
+        """The result of `fetch()` for `key`, shared with concurrent callers of the same key.
+
+        `fetch` must not use the caller's database session: it may outlive
+        the request that started it, and its result goes to every waiter.
+        With `remember=False` the result is only shared while in flight.
+        """
+        if not self.enabled:
+            return await fetch()
+        if remember:
+            entry = self._recent.get(key, _MISSING)
+            if entry is not _MISSING:
+                COALESCED_READS.labels("cached").inc()
+                return entry[1]
+        task = self._in_flight.get(key)
+        if task is None:
+            task = self._in_flight[key] = asyncio.ensure_future(fetch())
+            task.add_done_callback(partial(self._done, key, remember))
+            COALESCED_READS.labels("fetched").inc()
+        else:
+            COALESCED_READS.labels("shared").inc()
+        # shielded: a caller that goes away doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: tuple, remember: bool, task: asyncio.Future):
+        failed = task.cancelled() or task.exception() is not None  # also marks the exception as seen
+        if self._in_flight.get(key) is not task:
+            return  # invalidated while it ran: its result may already be out of date
+        del self._in_flight[key]
+        if remember and not failed:
+            self._recent.set(key, (key[0], task.result()))
+
+    def invalidate(self, user_id: int):
+        """Forget fetches in flight and recent results for `user_id`; later callers fetch again."""
+        for key in [key for key in self._in_flight if key[0] == user_id]:
+            del self._in_flight[key]
+        self._recent.discard_if(lambda entry: entry[0] == user_id)
+
+    def clear(self):
+        self._in_flight.clear()
+        self._recent.clear()
@@ -1,10 +1,203 @@
-from sqlalchemy import create_engine, Column, Integer, String
+import asyncio
+import weakref
+from dataclasses import dataclass
+
+from pydantic_settings import BaseSettings
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DATABASE_PATH = "./notes.db"
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
+
+
+class DatabaseSettings(BaseSettings):
+    """SQLite engine profile. Each field can be overridden with a SQLITE_* variable."""
+    JOURNAL_MODE: str = "wal"  # readers and the writer don't block each other
+    SYNCHRONOUS: str = "normal"  # in WAL mode: durable except the last commits on power loss
+    CACHE_SIZE_KIB: int = 16 * 1024  # page cache per connection
+    MMAP_SIZE: int = 256 * 1024 * 1024
+    BUSY_TIMEOUT_MS: int = 5000  # how long to wait for another process's write lock
+    WRITE_POOL_SIZE: int = 5
+    READ_POOL_SIZE: int = 10
+    # notes, their revisions, search index and attachments in this many files (see shards.py);
+    # 0 keeps them in notes.db with the users
+    SHARDS: int = 0
+    SHARD_DIR: str = "shards"
+
+    class Config:
+        env_prefix = "SQLITE_"
+        env_file = ".env"
+        extra = "ignore"
+
+
+db_settings = DatabaseSettings()
+
+
+def _apply_pragmas(query_only: bool = False):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode = {db_settings.JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {db_settings.SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size = -{db_settings.CACHE_SIZE_KIB}")
+        cursor.execute(f"PRAGMA mmap_size = {db_settings.MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout = {db_settings.BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store = memory")
+        if query_only:
+            cursor.execute("PRAGMA query_only = on")
+        cursor.close()
+    return on_connect
+
+
+class WriteQueue:
+    """Serialises write transactions to each database file within this process, first come first served.
+
+    SQLite has one writer at a time. Without this, concurrent requests in a
+    worker each start a write and all but one sleep in SQLite's busy handler
+    on a pool thread; with it they wait their turn on the event loop and
+    busy_timeout only comes into play between worker processes. Writes to
+    different files (shards) don't wait for each other.
+    """
+
+    def __init__(self):
+        # asyncio locks belong to one event loop; scripts and tests run several
+        self._locks = weakref.WeakKeyDictionary()
+
+    def lock(self, database: str) -> asyncio.Lock:
+        locks = self._locks.setdefault(asyncio.get_running_loop(), {})
+        lock = locks.get(database)
+        if lock is None:
+            lock = locks[database] = asyncio.Lock()
+        return lock
+
+
+write_queue = WriteQueue()
+
+_DML_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def _is_write(statement) -> bool:
+    if getattr(statement, "is_dml", False):
+        return True
+    sql = getattr(statement, "text", None)
+    return isinstance(sql, str) and sql.lstrip().upper().startswith(_DML_PREFIXES)
+
+
+class WriteSession(AsyncSession):
+    """AsyncSession that joins the write queue just before its first write.
 
-DATABASE_URL = "sqlite:///./notes.db"
+    sqlite3 only opens a transaction in front of a write, so reads before
+    that run without the lock (a login can verify a password without
+    holding up other writers). From the first INSERT/UPDATE/DELETE or flush
+    until commit, rollback or close the session is the process's only writer.
+    """
+    _write_lock = None
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    async def _join_write_queue(self):
+        if self._write_lock is None:
+            lock = write_queue.lock(self.bind.url.database)
+            await lock.acquire()
+            self._write_lock = lock
+
+    def _leave_write_queue(self):
+        if self._write_lock is not None:
+            self._write_lock.release()
+            self._write_lock = None
+
+    async def begin_write(self):
+        """Join the write queue now, before reads that the coming writes depend on."""
+        await self._join_write_queue()
+
+    def _has_changes(self) -> bool:
+        return bool(self.new or self.dirty or self.deleted)
+
+    async def execute(self, statement, *args, **kw):
+        if _is_write(statement):
+            await self._join_write_queue()
+        return await super().execute(statement, *args, **kw)
+
+    async def scalar(self, statement, *args, **kw):
+        if _is_write(statement):
+            await self._join_write_queue()
+        return await super().scalar(statement, *args, **kw)
+
+    async def flush(self, objects=None):
+        if self._has_changes():
+            await self._join_write_queue()
+        await super().flush(objects)
+
+    async def commit(self):
+        if self._has_changes():
+            await self._join_write_queue()
+        try:
+            await super().commit()
+        finally:
+            self._leave_write_queue()
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            self._leave_write_queue()
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._leave_write_queue()
+
+
+@dataclass
+class Database:
+    """The engines and session factories of one SQLite file."""
+    path: str
+    engine: Engine  # sync: schema setup and maintenance scripts
+    async_engine: AsyncEngine
+    read_engine: AsyncEngine
+    sessions: async_sessionmaker  # WriteSession
+    read_sessions: async_sessionmaker
+
+    async def dispose(self):
+        await self.async_engine.dispose()
+        await self.read_engine.dispose()
+
+
+def open_database(path: str, **session_info) -> Database:
+    """Engines for the SQLite file at `path`. Nothing is opened until first use.
+
+    `session_info` ends up in the `info` dict of every async session.
+    """
+    # sync engine: schema setup and maintenance scripts (search.py rebuild, ...)
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", _apply_pragmas())
+
+    # async engines: used by every request handler so queries never block the event loop.
+    # aiosqlite runs each connection on its own thread; pool them instead of the
+    # NullPool default so a request doesn't pay for opening the file.
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=AsyncAdaptedQueuePool,
+                                       pool_size=db_settings.WRITE_POOL_SIZE)
+    event.listen(async_engine.sync_engine, "connect", _apply_pragmas())
+    sessions = async_sessionmaker(bind=async_engine, class_=WriteSession, autoflush=False, expire_on_commit=False,
+                                  info=session_info)
+
+    # read-only pool for GET routes: in WAL mode these never wait for the writer
+    read_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", poolclass=AsyncAdaptedQueuePool,
+                                      pool_size=db_settings.READ_POOL_SIZE)
+    event.listen(read_engine.sync_engine, "connect", _apply_pragmas(query_only=True))
+    read_sessions = async_sessionmaker(bind=read_engine, class_=AsyncSession, autoflush=False,
+                                       expire_on_commit=False, info=session_info)
+    return Database(path, engine, async_engine, read_engine, sessions, read_sessions)
+
+
+# notes.db: users, sessions, the outbox and rate limits, and the notes too unless they are sharded
+directory = open_database(DATABASE_PATH)
+engine = directory.engine
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+async_engine = directory.async_engine
+AsyncSessionLocal = directory.sessions
+read_engine = directory.read_engine
+ReadSessionLocal = directory.read_sessions
 
 Base = declarative_base()
-
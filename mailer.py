@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from email.message import EmailMessage
+from typing import Callable, Optional, Union
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from metrics import MAIL_SEND_SECONDS
+from models import OutboxMessage, utcnow
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 30  # seconds; doubles with every failed attempt
+BACKOFF_MAX = 3600
+# a claimed message isn't picked up again for this long, so a crashed
+# worker's batch is retried but two workers never send the same batch
+CLAIM_LEASE = timedelta(minutes=5)
+
+
+@dataclass(frozen=True)
+class SmtpConfig:
+    hostname: str
+    port: int
+    sender: str
+    username: Optional[str] = None
+    password: Optional[str] = None
+    start_tls: bool = False
+    use_tls: bool = False
+    timeout: float = 30
+
+
+async def enqueue(db, recipient: str, subject: str, body: str, dedupe_key: Optional[str] = None):
+    """Queue an email. The caller commits; the worker sends it.
+
+    If a message with the same `dedupe_key` is still pending it is replaced
+    instead, so a user hammering "forgot password" gets one email (with the
+    latest link) rather than one per click.
+    """
+    now = utcnow()
+    statement = insert(OutboxMessage).values(
+        recipient=recipient, subject=subject, body=body, dedupe_key=dedupe_key,
+        status="pending", revision=1, attempts=0, next_attempt_at=now, created_at=now)
+    if dedupe_key is not None:
+        statement = statement.on_conflict_do_update(
+            index_elements=[OutboxMessage.dedupe_key],
+            index_where=OutboxMessage.status == "pending",
+            set_={"recipient": recipient, "subject": subject, "body": body,
+                  "revision": OutboxMessage.revision + 1})
+    await db.execute(statement)
+
+
+def backoff(attempts: int) -> timedelta:
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+class MailWorker:
+    """Drains the outbox in batches over one SMTP connection per batch.
+
+    Runs as a background task; `wake()` makes it drain right away instead of
+    waiting for the next poll, so a queued reset mail usually leaves within
+    milliseconds of the request that queued it having returned.
+
+    `smtp` may be a function returning the SmtpConfig. It is then called
+    when the first email is about to be sent, so an app with mail not
+    configured starts fine and only fails (and keeps the emails queued) if
+    it actually has something to send.
+    """
+
+    def __init__(self, session_factory, smtp: Union[SmtpConfig, Callable[[], SmtpConfig]],
+                 poll_interval: float = 10.0, batch_size: int = BATCH_SIZE, max_attempts: int = MAX_ATTEMPTS):
+        self.session_factory = session_factory
+        self._smtp = smtp
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+
+    @property
+    def smtp(self) -> SmtpConfig:
+        if callable(self._smtp):
+            self._smtp = self._smtp()
+        return self._smtp
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                while await self.drain_once() == self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Mail outbox drain failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def drain_once(self) -> int:
+        """Send one batch of due messages. Returns how many were claimed."""
+        batch = await self._claim_batch()
+        if not batch:
+            return 0
+
+        import aiosmtplib  # only once there is mail to send; most workers never need it
+
+        results = {}
+        client = aiosmtplib.SMTP(hostname=self.smtp.hostname, port=self.smtp.port,
+                                 username=self.smtp.username, password=self.smtp.password,
+                                 start_tls=self.smtp.start_tls, use_tls=self.smtp.use_tls,
+                                 timeout=self.smtp.timeout)
+        try:
+            await client.connect()
+            for message in batch:
+                started = time.perf_counter()
+                try:
+                    await client.send_message(self._build(message))
+                    results[message.id] = None
+                    MAIL_SEND_SECONDS.labels("sent").observe(time.perf_counter() - started)
+                except aiosmtplib.SMTPException as exc:
+                    results[message.id] = str(exc)
+                    MAIL_SEND_SECONDS.labels("failed").observe(time.perf_counter() - started)
+                    if isinstance(exc, aiosmtplib.SMTPServerDisconnected):
+                        break
+        except (aiosmtplib.SMTPException, OSError) as exc:
+            logger.warning("SMTP connection failed: %s", exc)
+            error = str(exc) or exc.__class__.__name__
+        else:
+            error = "Not attempted: SMTP connection lost"
+        finally:
+            if client.is_connected:
+                try:
+                    await client.quit()
+                except aiosmtplib.SMTPException:
+                    client.close()
+
+        for message in batch:
+            results.setdefault(message.id, error)
+        await self._record(batch, results)
+        return len(batch)
+
+    async def _claim_batch(self):
+        now = utcnow()
+        async with self.session_factory() as db:
+            due = (select(OutboxMessage.id)
+                   .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+                   .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+                   .limit(self.batch_size)
+                   .scalar_subquery())
+            batch = (await db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(due))
+                .values(next_attempt_at=now + CLAIM_LEASE)
+                .returning(OutboxMessage.id, OutboxMessage.recipient, OutboxMessage.subject,
+                           OutboxMessage.body, OutboxMessage.revision, OutboxMessage.attempts))).all()
+            await db.commit()
+        return batch
+
+    async def _record(self, batch, results):
+        now = utcnow()
+        async with self.session_factory() as db:
+            for message in batch:
+                error = results[message.id]
+                if error is None:
+                    sent = await db.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id == message.id, OutboxMessage.revision == message.revision)
+                        .values(status="sent", sent_at=now, attempts=message.attempts + 1, last_error=None))
+                    if sent.rowcount == 0:
+                        # replaced while we were sending: send the new body next time round
+                        await db.execute(update(OutboxMessage).where(OutboxMessage.id == message.id)
+                                         .values(next_attempt_at=now))
+                    continue
+
+                attempts = message.attempts + 1
+                values = {"attempts": attempts, "last_error": error[:500]}
+                if attempts >= self.max_attempts:
+                    values["status"] = "failed"
+                    logger.error("Giving up on outbox message %s to %s: %s", message.id, message.recipient, error)
+                else:
+                    values["next_attempt_at"] = now + backoff(attempts)
+                await db.execute(update(OutboxMessage).where(OutboxMessage.id == message.id).values(**values))
+            await db.commit()
+
+    def _build(self, message) -> EmailMessage:
+        email = EmailMessage()
+        email["From"] = self.smtp.sender
+        email["To"] = message.recipient
+        email["Subject"] = message.subject
+        email.set_content(message.body)
+        return email
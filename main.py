@@ -1,71 +1,261 @@
-from fastapi import FastAPI, Query, Request, Form, UploadFile, File, Depends, HTTPException, Body
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Query, Request, Response, Form, UploadFile, File, Depends, HTTPException, Body
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import undefer
 from typing import Optional
-import shutil
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import secrets
-from database import Base, engine, SessionLocal
-from models import User, Note
-from fastapi_mail import ConnectionConfig, FastMail, MessageSchema, MessageType
+from urllib.parse import quote, urlencode
+from database import Base, db_settings, engine, async_engine, read_engine, AsyncSessionLocal, ReadSessionLocal
+from migrations import init_database
+from models import User, Note, utcnow
+from pagination import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NDJSON_MEDIA_TYPE, STREAM_BATCH_SIZE, InvalidFields,
+                        fetch_notes_page, parse_fields, stream_notes_ndjson, wants_ndjson)
+from uploads import FORM_OVERHEAD_BYTES, UploadSizeLimitMiddleware
+from blobs import attachment_path, discard_upload, release, run_sweeper, store_upload
+from attachments import AttachmentResponse
+from sessions import SESSION_COOKIE, Identity, SessionStore, run_purger
+from search import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, InvalidCursor, index_note, search_notes, unindex_note
+from mailer import MailWorker, SmtpConfig, enqueue
+from passwords import PasswordHasher
+from batch import BatchRequest, apply_batch
+from archive import ARCHIVE_MEDIA_TYPE, InvalidArchive, export_archive, import_archive
+from revisions import (DEFAULT_REVISION_LIMIT, MAX_REVISION_LIMIT, delete_revisions, list_revisions, load_revision,
+                       record_revision)
+from rendering import FragmentCache, async_environment, create_templates, stream_template
+from versioning import (bump_notes_version, format_etag, not_modified, notes_etag, notes_version, on_notes_changed,
+                        set_cache_headers)
+from coalesce import SingleFlight
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, MetricsMiddleware, instrument_engine
+from profiling import ProfilerMiddleware, RequestContextMiddleware, SlowQueryLog
+from ratelimit import AdmissionControlMiddleware, MemoryBuckets, RateLimiter, SQLiteBuckets, client_ip, parse_budget
+from shards import Shard, ShardSet, new_note_ids
 from pydantic_settings import BaseSettings
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
 class Settings(BaseSettings):
-    MAIL_USERNAME: str
-    MAIL_PASSWORD: str
-    MAIL_FROM: str
+    # needed only to send email; without them the app runs and reset emails stay queued
+    MAIL_USERNAME: Optional[str] = None
+    MAIL_PASSWORD: Optional[str] = None
+    MAIL_FROM: Optional[str] = None
     MAIL_PORT: int = 587
     MAIL_SERVER: str = "smtp.gmail.com"
     MAIL_STARTTLS: bool = True
     MAIL_SSL_TLS: bool = False
+    SECRET_KEY: str = "change-me-in-production"  # signs session cookies
+    SESSION_MAX_AGE: int = 14 * 24 * 3600
+    SESSION_COOKIE_SECURE: bool = False
+    SESSION_PURGE_INTERVAL: int = 3600  # seconds between deletes of expired sessions
+    MAX_UPLOAD_BYTES: int = 25 * 1024 * 1024
+    MAX_IMPORT_BYTES: int = 1024 * 1024 * 1024  # size of an archive sent to /api/notes/import
+    MAX_IMPORT_EXPANDED_BYTES: int = 4 * 1024 * 1024 * 1024  # what it may uncompress to, all files together
+    IMPORT_BATCH_SIZE: int = 500  # notes per transaction when importing an archive
+    BLOB_SWEEP_INTERVAL: int = 300  # seconds between orphaned-attachment sweeps
+    MAIL_POLL_INTERVAL: int = 10  # seconds between outbox polls when nothing wakes the worker
+    # scrypt cost; raising these re-hashes each password at its next login
+    SCRYPT_N: int = 2 ** 14
+    SCRYPT_R: int = 8
+    SCRYPT_P: int = 1
+    PASSWORD_HASH_WORKERS: int = 4  # threads for hashing, i.e. concurrent logins per worker process
+    TEMPLATE_BYTECODE_DIR: str = ".cache/jinja"  # compiled templates, shared by every worker
+    FRAGMENT_CACHE_SIZE: int = 10_000  # rendered note cards kept per worker
+    # identical concurrent note reads share one query; results are reused for this many seconds
+    COALESCE_READS: bool = True
+    COALESCE_TTL: float = 2.0
+    COALESCE_CACHE_SIZE: int = 1000
+    METRICS_ENABLED: bool = True  # per-request and per-statement instrumentation behind /metrics
+    METRICS_TOKEN: Optional[str] = None  # if set, /metrics wants "Authorization: Bearer <token>"
+    # profiling (off unless one of the first two is set): requests sending "X-Profile: <token>",
+    # or this fraction of all requests, run under cProfile and are saved to PROFILE_DIR
+    PROFILE_TOKEN: Optional[str] = None
+    PROFILE_SAMPLE_RATE: float = 0.0
+    PROFILE_DIR: str = ".cache/profiles"
+    SLOW_QUERY_MS: Optional[float] = None  # log statements slower than this, with their query plan
+    SLOW_QUERY_LOG_PARAMETERS: bool = False  # log the bound values too, not just their types (they hold secrets)
+    # rate limits as "<requests>/<seconds>", per client IP unless noted
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_BACKEND: str = "memory"  # "memory": per worker; "sqlite": shared by every worker
+    LOGIN_RATE_LIMIT: str = "20/60"  # logins and registrations
+    LOGIN_ACCOUNT_RATE_LIMIT: str = "10/600"  # login attempts per email address
+    RESET_RATE_LIMIT: str = "5/600"  # password-reset requests and resets
+    RESET_ACCOUNT_RATE_LIMIT: str = "3/3600"  # reset emails per email address
+    WRITE_RATE_LIMIT: str = "300/60"  # note writes per logged-in user
+    # admission control, per worker: requests handled at once, and how many more may wait and for how long
+    MAX_IN_FLIGHT: int = 64
+    MAX_QUEUED: int = 128
+    QUEUE_TIMEOUT: float = 5.0
 
     class Config:
         env_file = ".env"  # for local dev
+        extra = "ignore"  # .env also holds the SQLITE_* engine settings read by database.py
 
 
+# reads the environment only; everything below that touches disk, the database or the
+# network waits for the lifespan handler or for first use, so importing main stays cheap
 settings = Settings()
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=settings.MAIL_USERNAME,
-    MAIL_PASSWORD=settings.MAIL_PASSWORD,
-    MAIL_FROM=settings.MAIL_FROM,
-    MAIL_PORT=settings.MAIL_PORT,
-    MAIL_SERVER=settings.MAIL_SERVER,
-    MAIL_STARTTLS=settings.MAIL_STARTTLS,
-    MAIL_SSL_TLS=settings.MAIL_SSL_TLS,
-    USE_CREDENTIALS=True,
-    TEMPLATE_FOLDER=os.path.join(BASE_DIR, "templates/email")
-)
 
-# CREATE TABLES
-Base.metadata.create_all(bind=engine)
+def smtp_config() -> SmtpConfig:
+    # called by the mail worker when it first has an email to send
+    if not (settings.MAIL_USERNAME and settings.MAIL_PASSWORD and settings.MAIL_FROM):
+        raise RuntimeError("MAIL_USERNAME, MAIL_PASSWORD and MAIL_FROM must be set to send email")
+    return SmtpConfig(
+        hostname=settings.MAIL_SERVER,
+        port=settings.MAIL_PORT,
+        sender=settings.MAIL_FROM,
+        username=settings.MAIL_USERNAME,
+        password=settings.MAIL_PASSWORD,
+        start_tls=settings.MAIL_STARTTLS,
+        use_tls=settings.MAIL_SSL_TLS,
+    )
+
+
+# emails are queued in the outbox table and sent by this background worker
+mail_worker = MailWorker(AsyncSessionLocal, smtp_config, poll_interval=settings.MAIL_POLL_INTERVAL)
+
+# per-client token buckets for logins, password resets and note writes
+rate_limiter = RateLimiter(
+    {"login": parse_budget(settings.LOGIN_RATE_LIMIT),
+     "login-account": parse_budget(settings.LOGIN_ACCOUNT_RATE_LIMIT),
+     "reset": parse_budget(settings.RESET_RATE_LIMIT),
+     "reset-account": parse_budget(settings.RESET_ACCOUNT_RATE_LIMIT),
+     "write": parse_budget(settings.WRITE_RATE_LIMIT)},
+    SQLiteBuckets(AsyncSessionLocal) if settings.RATE_LIMIT_BACKEND == "sqlite" else MemoryBuckets(),
+    enabled=settings.RATE_LIMIT_ENABLED)
+
+# password hashing runs on its own bounded thread pool (started on first use), never on the event loop
+password_hasher = PasswordHasher(n=settings.SCRYPT_N, r=settings.SCRYPT_R, p=settings.SCRYPT_P,
+                                 workers=settings.PASSWORD_HASH_WORKERS)
 
-app = FastAPI()
+# where each user's notes are kept: notes.db, or one of SQLITE_SHARDS files
+shards = ShardSet(db_settings.SHARDS, db_settings.SHARD_DIR)
 
-# uploads folder
-os.makedirs("uploads", exist_ok=True)
 
-# STATIC + TEMPLATES
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-templates = Jinja2Templates(directory="templates")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # create tables, migrate, open the shards and make the uploads folders before the first request
+    await run_in_threadpool(init_database, engine)
+    await run_in_threadpool(shards.init)
+    background = [
+        asyncio.create_task(mail_worker.run()),
+        asyncio.create_task(run_purger(AsyncSessionLocal, settings.SESSION_PURGE_INTERVAL)),
+    ]
+    for shard in shards.all():
+        os.makedirs(shard.blob_root, exist_ok=True)
+        background.append(asyncio.create_task(
+            run_sweeper(shard.sessions, settings.BLOB_SWEEP_INTERVAL, shard.blob_root)))
+    if isinstance(rate_limiter.store, SQLiteBuckets):
+        background.append(asyncio.create_task(rate_limiter.run_purger(settings.SESSION_PURGE_INTERVAL)))
+    yield
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    password_hasher.shutdown()
+    await shards.dispose()
+    await async_engine.dispose()
+    await read_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=settings.MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=settings.MAX_IMPORT_BYTES, paths=("/api/notes/import",))
+if settings.SLOW_QUERY_MS is not None:
+    app.add_middleware(RequestContextMiddleware)
+    slow_queries = SlowQueryLog(settings.SLOW_QUERY_MS, log_parameters=settings.SLOW_QUERY_LOG_PARAMETERS)
+    for shard in shards.all():
+        slow_queries.instrument(shard.database.async_engine.sync_engine)
+        slow_queries.instrument(shard.database.read_engine.sync_engine)
+if settings.PROFILE_TOKEN or settings.PROFILE_SAMPLE_RATE:
+    app.add_middleware(ProfilerMiddleware, directory=settings.PROFILE_DIR, token=settings.PROFILE_TOKEN,
+                       sample_rate=settings.PROFILE_SAMPLE_RATE)
+if settings.MAX_IN_FLIGHT:
+    app.add_middleware(AdmissionControlMiddleware, max_in_flight=settings.MAX_IN_FLIGHT,
+                       max_queued=settings.MAX_QUEUED, queue_timeout=settings.QUEUE_TIMEOUT)
+if settings.METRICS_ENABLED:
+    # added last, so it is outermost and also sees requests the upload limit rejects
+    app.add_middleware(MetricsMiddleware)
+    for shard in shards.all():
+        instrument_engine(shard.database.async_engine.sync_engine, "write")
+        instrument_engine(shard.database.read_engine.sync_engine, "read")
+
+# TEMPLATES (attachments are served by /attachments/{note_id}, never straight from disk)
+templates = create_templates("templates", settings.TEMPLATE_BYTECODE_DIR)
+async_templates = async_environment(templates.env, settings.TEMPLATE_BYTECODE_DIR)
+# rendered note cards, keyed by (note id, updated_at)
+fragments = FragmentCache(templates.env, maxsize=settings.FRAGMENT_CACHE_SIZE)
+# JSON note reads, keyed by (user id, notes_version, request); any write of the user drops theirs
+note_reads = SingleFlight(settings.COALESCE_CACHE_SIZE, settings.COALESCE_TTL, enabled=settings.COALESCE_READS)
+on_notes_changed(note_reads.invalidate)
 
 
 # DEPENDENCY TO GET DB SESSION
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# read-only session for GET routes: a separate pool that never waits on writers
+async def get_read_db():
+    async with ReadSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-# FAKE SESSION, SIMPLE FOR DEMO (NO JWT)
-session_data = {}
+# LOGIN SESSIONS (signed cookie -> sessions table, shared by every worker)
+session_store = SessionStore(settings.SECRET_KEY, settings.SESSION_MAX_AGE,
+                             secure_cookie=settings.SESSION_COOKIE_SECURE)
+
+
+async def authenticate(db: AsyncSession, email: str, password: str) -> Optional[User]:
+    user = await db.scalar(select(User).where(User.email == email))
+    ok, needs_rehash = await password_hasher.verify(password, user.password if user else None)
+    if not ok:
+        return None
+    if needs_rehash:
+        # plaintext row from before hashing, or hashed with old cost settings
+        user.password = await password_hasher.hash(password)
+        await db.commit()
+    return user
+
+
+# DEPENDENCY TO GET THE LOGGED-IN USER (None when logged out)
+# FastAPI resolves it once per request and the session store caches it across requests,
+# so note routes go straight to their own query.
+async def current_user(request: Request, db: AsyncSession = Depends(get_read_db)) -> Optional[Identity]:
+    return await session_store.resolve(db, request.cookies.get(SESSION_COOKIE))
+
+
+# the shard keeping the logged-in user's notes (None when logged out)
+async def user_shard(user: Optional[Identity] = Depends(current_user)) -> Optional[Shard]:
+    return shards.for_user(user.id) if user else None
+
+
+# DEPENDENCIES TO GET A DB SESSION ON THAT SHARD, for routes that read or change notes
+async def get_notes_db(shard: Optional[Shard] = Depends(user_shard)):
+    if shard is None:
+        yield None  # logged out: the route answers without a session
+        return
+    async with shard.sessions() as db:
+        yield db
+
+
+async def get_notes_read_db(shard: Optional[Shard] = Depends(user_shard)):
+    if shard is None:
+        yield None
+        return
+    async with shard.read_sessions() as db:
+        yield db
+
+
+# routes that change notes draw on the user's "write" budget (the client's, when logged out)
+async def limit_writes(request: Request, user: Optional[Identity] = Depends(current_user)):
+    await rate_limiter.hit({"write": f"user:{user.id}" if user else client_ip(request)})
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -84,10 +274,12 @@ async def register_user(
         username: str = Form(...),
         email: str = Form(...),
         password: str = Form(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
+    await rate_limiter.hit({"login": client_ip(request)})
+
     # check if email already exists
-    existing_user = db.query(User).filter(User.email == email).first()
+    existing_user = await db.scalar(select(User).where(User.email == email))
     if existing_user:
         return templates.TemplateResponse(
             "register.html",
@@ -101,10 +293,10 @@ async def register_user(
         )
 
     # create new user
-    user = User(username=username, email=email, password=password)
+    user = User(username=username, email=email, password=await password_hasher.hash(password))
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
 
     # success message
     return templates.TemplateResponse(
@@ -123,83 +315,146 @@ async def login_user(
         request: Request,
         email: str = Form(...),
         password: str = Form(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.email == email, User.password == password).first()
+    # before the password check, which is what a burst of guesses would cost
+    await rate_limiter.hit({"login": client_ip(request), "login-account": email.lower()})
+    user = await authenticate(db, email, password)
     if user:
-        session_data["user"] = user.username
-        return RedirectResponse("/dashboard", status_code=302)
+        response = RedirectResponse("/dashboard", status_code=302)
+        session_store.set_cookie(response, await session_store.create(db, user))
+        return response
 
     return templates.TemplateResponse(
         "login.html",
         {"request": request, "msg": "❌ Invalid username or password, please try again."})
 
 
+@app.get("/logout")
+async def logout(request: Request, db: AsyncSession = Depends(get_db)):
+    await session_store.revoke(db, request.cookies.get(SESSION_COOKIE))
+    response = RedirectResponse("/login", status_code=302)
+    session_store.delete_cookie(response)
+    return response
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request, success: str = None):
-    username = session_data.get("user")
-    if not username:
+async def dashboard(request: Request, success: str = None, user: Optional[Identity] = Depends(current_user)):
+    if not user:
         return RedirectResponse("/", status_code=302)
 
     msg = "✅ Note successfully uploaded!" if success else None
     return templates.TemplateResponse(
         "dashboard.html",
-        {"request": request, "username": username, "msg": msg})
+        {"request": request, "username": user.username, "msg": msg})
 
 
-@app.post("/notes")
+@app.post("/notes", dependencies=[Depends(limit_writes)])
 async def upload_note(
         title: str = Form(...),
         content: str = Form(None),  # optional text content
         file: Optional[UploadFile] = File(None),  # Optional file
-        db: Session = Depends(get_db)
+        user: Optional[Identity] = Depends(current_user),
+        shard: Optional[Shard] = Depends(user_shard),
+        db: AsyncSession = Depends(get_notes_db)
 ):
-    username = session_data.get("user")
-    if not username:
+    if not user:
         return RedirectResponse("/", status_code=302)
 
-    user = db.query(User).filter(User.username == username).first()
-
-    filename = None
+    [note_id] = await new_note_ids(db, 1)
+    filename = sha256 = size = stored = None
     if file and file.filename:  # check if a file is uploaded
-        os.makedirs("uploads", exist_ok=True)
-        file_location = os.path.join("uploads", file.filename)
-        with open(file_location, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        filename = file.filename
+        # stored by content hash; the client's name is only kept for display
+        stored = await store_upload(db, file, settings.MAX_UPLOAD_BYTES, shard.blob_root)
+        filename, sha256, size = os.path.basename(file.filename), stored.sha256, stored.size
 
     note = Note(
+        id=note_id,
         title=title,
         content=content,
-        filename=file.filename,
+        filename=filename,
+        sha256=sha256,
+        size=size,
         user_id=user.id)
 
-    db.add(note)
-    db.commit()
+    try:
+        db.add(note)
+        await db.flush()
+        await index_note(db, note)
+        await bump_notes_version(db, user.id)
+        await db.commit()
+    except BaseException:
+        if stored:
+            # don't leave a blob file behind that no row points to
+            await discard_upload(db, stored, shard.blob_root)
+        raise
 
     # ✅ redirect with a query param
     return RedirectResponse("/dashboard?success=1", status_code=302)
 
 
-@app.get("/notes")
-async def get_notes(db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
-        return RedirectResponse("/", status_code=302)
+async def shared_notes_version(user_id: int) -> int:
+    """The user's notes_version, looked up once for all of their requests that ask at the same moment."""
+    async def lookup():
+        async with shards.for_user(user_id).read_sessions() as db:
+            return await notes_version(db, user_id)
+    return await note_reads.run((user_id, "version"), lookup, remember=False)
 
-    user = db.query(User).filter(User.username == username).first()
-    notes = db.query(Note).filter(Note.user_id == user.id).all()
 
-    return [
-        {
-            "id": note.id,
-            "title": note.title,
-            "content": note.content,
-            "filename": note.filename
-        }
+def json_body(data) -> bytes:
+    # what FastAPI would send for `data`, serialised once for every request that shares it
+    return JSONResponse(jsonable_encoder(data)).body
 
-        for note in notes
-    ]
+
+async def list_notes_response(request: Request, user: Identity, cursor: Optional[int], limit: int, stream: bool,
+                              fields: Optional[str]):
+    try:
+        columns = parse_fields(fields)
+    except InvalidFields as exc:
+        raise HTTPException(status_code=400, detail=f"Unknown field: {exc}")
+    ndjson = wants_ndjson(request, stream)
+    shard = shards.for_user(user.id)
+    variant = f"{cursor}:{limit}:{ndjson}:{','.join(columns)}"
+    # polling clients get a 304 from one version lookup, before any note is read
+    version = await shared_notes_version(user.id)
+    etag = format_etag(user.id, version, variant)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    # NDJSON: every note after the cursor, streamed from a server-side cursor
+    if ndjson:
+        streaming = StreamingResponse(stream_notes_ndjson(shard.read_sessions, user.id, cursor, columns), media_type=NDJSON_MEDIA_TYPE)
+        set_cache_headers(streaming, etag)
+        return streaming
+
+    # JSON: one keyset page, the cursor for the next page goes in a header
+    async def page():
+        async with shard.read_sessions() as db:
+            notes, next_cursor = await fetch_notes_page(db, user.id, cursor, limit, columns)
+        return json_body(notes), next_cursor
+
+    body, next_cursor = await note_reads.run((user.id, version, variant), page)
+    response = Response(body, media_type="application/json")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    set_cache_headers(response, etag)
+    return response
+
+
+@app.get("/notes")
+async def get_notes(
+        request: Request,
+        cursor: Optional[int] = Query(None, ge=0),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        stream: bool = Query(False),
+        fields: Optional[str] = Query(None),
+        user: Optional[Identity] = Depends(current_user)
+):
+    if not user:
+        return RedirectResponse("/", status_code=302)
+
+    return await list_notes_response(request, user, cursor, limit, stream, fields)
 
 
 # MY NOTES
@@ -207,51 +462,123 @@ async def get_notes(db: Session = Depends(get_db)):
 async def my_notes(
         request: Request,
         updated: str = Query(None),
-        db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)):
+    if not user:
         return RedirectResponse("/login", status_code=303)
 
-    user = db.query(User).filter(User.username == username).first()
-    notes = db.query(Note).filter(Note.user_id == user.id).all()
+    has_notes = await db.scalar(select(Note.id).where(Note.user_id == user.id).limit(1)) is not None
 
     msg = "✅ Note successfully updated!" if updated else None
 
-    return templates.TemplateResponse(
-        "mynotes.html",
-        {"request": request, "username": username, "notes": notes, "msg": msg}
-    )
+    # streamed: the page head goes out at once and cards follow as rows are read
+    context = {"request": request, "username": user.username, "has_notes": has_notes,
+               "cards": note_cards(user.id), "msg": msg}
+    return StreamingResponse(stream_template(async_templates, "mynotes.html", context),
+                             media_type="text/html; charset=utf-8")
+
+
+async def note_cards(user_id: int):
+    """Each of a user's notes as rendered HTML, re-rendering only notes that changed."""
+    async with shards.for_user(user_id).read_sessions() as db:
+        result = await db.stream(
+            select(Note.id, Note.title, Note.excerpt, Note.filename, Note.updated_at)
+            .where(Note.user_id == user_id)
+            .order_by(Note.id)
+            .execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for note in result:
+            yield fragments.render("_note_card.html", (note.id, note.updated_at), note=note)
 
 
 @app.get("/viewfile/{note_id}", response_class=HTMLResponse)
-async def view_file(request: Request, note_id: int, db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+async def view_file(
+        request: Request,
+        note_id: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
         return RedirectResponse("/login", status_code=303)
 
     # fetch note
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).options(undefer(Note.content))
+                          .where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
+    file_url = attachment_url(note) if note.filename else None
+    download_url = attachment_url(note, download=True) if note.filename else None
+
     return templates.TemplateResponse(
         "viewfile.html",
-        {"request": request, "note": note}
+        {"request": request, "note": note, "file_url": file_url, "download_url": download_url}
     )
 
 
+def attachment_url(note: Note, download: bool = False) -> str:
+    # v= names the content, so the response can be cached for good: a note id is reused after a delete
+    params = {"v": note.sha256} if note.sha256 else {}
+    if download:
+        params["download"] = 1
+    return f"/attachments/{note.id}" + (f"?{urlencode(params)}" if params else "")
+
+
+@app.api_route("/attachments/{note_id}", methods=["GET", "HEAD"])
+async def get_attachment(
+        note_id: int,
+        download: bool = Query(False),
+        v: Optional[str] = Query(None),
+        user: Optional[Identity] = Depends(current_user),
+        shard: Optional[Shard] = Depends(user_shard),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
+    if not note or not note.filename:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    path = attachment_path(note, shard.blob_root)
+    if note.sha256:
+        etag = f'"{note.sha256}"'
+    else:
+        # legacy upload outside the blob store (see `python blobs.py import-legacy`)
+        if path is None or not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Attachment not found")
+        stat_result = os.stat(path)
+        etag = f'W/"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+    return AttachmentResponse(path, etag, filename=note.filename, download=download,
+                              immutable=note.sha256 is not None and v == note.sha256)
+
+
 @app.get("/ping")
 def ping():
     return {"status": "ok"}
 
 
+# async, so it reads the metrics on the event loop thread that updates them
+@app.get("/metrics")
+async def metrics(request: Request):
+    if settings.METRICS_TOKEN and not secrets.compare_digest(
+            request.headers.get("authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return Response(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/editnote/{note_id}", response_class=HTMLResponse)
-async def edit_note_page(request: Request, note_id: int, db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+async def edit_note_page(
+        request: Request,
+        note_id: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
         return RedirectResponse("/login", status_code=303)
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).options(undefer(Note.content))
+                          .where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
@@ -259,44 +586,54 @@ async def edit_note_page(request: Request, note_id: int, db: Session = Depends(g
 
 
 # EDIT NOTE SUBMIT (POST)
-@app.post("/editnote/{note_id}")
+@app.post("/editnote/{note_id}", dependencies=[Depends(limit_writes)])
 async def update_note(
         request: Request,
         note_id: int,
         title: str = Form(...),
         content: str = Form(...),
-        db: Session = Depends(get_db)
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
 ):
-    username = session_data.get("user")
-    if not username:
+    if not user:
         return RedirectResponse("/login", status_code=303)
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    # update values
+    # update values, keeping the version they replace in the revision history
+    await record_revision(db, note.id, title, content)
     note.title = title
     note.content = content
-    db.commit()
-    db.refresh(note)
+    await index_note(db, note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
 
     # redirect with ?updated=1
     return RedirectResponse("/mynotes?updated=1", status_code=303)
 
 
-@app.get("/deletenote/{note_id}")
-async def delete_note(note_id: int, db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+@app.get("/deletenote/{note_id}", dependencies=[Depends(limit_writes)])
+async def delete_note(
+        note_id: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
+):
+    if not user:
         return RedirectResponse("/login", status_code=303)
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    db.delete(note)
-    db.commit()
+    await unindex_note(db, note.id)
+    await delete_revisions(db, [note.id])
+    if note.sha256:
+        await release(db, note.sha256)
+    await db.delete(note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
 
     return RedirectResponse("/mynotes", status_code=303)
 
@@ -308,22 +645,24 @@ async def delete_note(note_id: int, db: Session = Depends(get_db)):
 # REGISTER
 @app.post("/api/register")
 async def api_register_user(
+        request: Request,
         username: str = Body(...),
         email: str = Body(...),
         password: str = Body(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    existing_user = db.query(User).filter(User.email == email).first()
+    await rate_limiter.hit({"login": client_ip(request)})
+    existing_user = await db.scalar(select(User).where(User.email == email))
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
 
     if len(password) < 6:
         raise HTTPException(status_code=400, detail="Password too short")
 
-    user = User(username=username, email=email, password=password)
+    user = User(username=username, email=email, password=await password_hasher.hash(password))
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
 
     return {"id": user.id, "username": user.username, "email": user.email}
 
@@ -331,105 +670,298 @@ async def api_register_user(
 # LOGIN
 @app.post("/api/login")
 async def api_login(
+        request: Request,
+        response: Response,
         email: str = Body(...),
         password: str = Body(...),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    user = db.query(User).filter(User.email == email, User.password == password).first()
+    await rate_limiter.hit({"login": client_ip(request), "login-account": email.lower()})
+    user = await authenticate(db, email, password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
 
-    session_data["user"] = user.username
+    session_store.set_cookie(response, await session_store.create(db, user))
     return {"message": "Login successful", "username": user.username}
 
 
+# LOGOUT
+@app.post("/api/logout")
+async def api_logout(request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    await session_store.revoke(db, request.cookies.get(SESSION_COOKIE))
+    session_store.delete_cookie(response)
+    return {"message": "Logged out"}
+
+
+def saved_note(note: Note, content: Optional[str]) -> dict:
+    # the response to a create or an edit. Note.content is deferred, so it is passed in: it's the text
+    # just saved, and reading it back from the note could mean another query
+    return {"id": note.id, "title": note.title, "content": content}
+
+
 # CREATE NOTE
-@app.post("/api/notes")
+@app.post("/api/notes", dependencies=[Depends(limit_writes)])
 async def api_upload_note(
         title: str = Body(...),
         content: Optional[str] = Body(None),
-        db: Session = Depends(get_db)
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
 ):
-    username = session_data.get("user")
-    if not username:
+    if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    user = db.query(User).filter(User.username == username).first()
-    note = Note(title=title, content=content, user_id=user.id)
+    [note_id] = await new_note_ids(db, 1)
+    note = Note(id=note_id, title=title, content=content, user_id=user.id)
     db.add(note)
-    db.commit()
-    db.refresh(note)
-
-    return {"id": note.id, "title": note.title, "content": note.content}
+    await db.flush()
+    await index_note(db, note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
+    return saved_note(note, content)
 
 
 # GET ALL NOTES
 @app.get("/api/notes")
-async def api_get_notes(db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+async def api_get_notes(
+        request: Request,
+        cursor: Optional[int] = Query(None, ge=0),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        stream: bool = Query(False),
+        fields: Optional[str] = Query(None),
+        user: Optional[Identity] = Depends(current_user)
+):
+    if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    user = db.query(User).filter(User.username == username).first()
-    notes = db.query(Note).filter(Note.user_id == user.id).all()
+    return await list_notes_response(request, user, cursor, limit, stream, fields)
 
-    return [
-        {"id": n.id, "title": n.title, "content": n.content, "filename": n.filename}
-        for n in notes
-    ]
+
+# SEARCH NOTES (declared before /api/notes/{note_id} so "search" isn't read as an id)
+@app.get("/api/notes/search")
+async def api_search_notes(
+        response: Response,
+        q: str = Query(..., min_length=1),
+        cursor: Optional[str] = Query(None),
+        limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        results, next_cursor = await search_notes(db, user.id, q, cursor, limit)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return results
+
+
+# BATCH CREATE / UPDATE / DELETE
+@app.post("/api/notes/batch", dependencies=[Depends(limit_writes)])
+async def api_batch_notes(
+        batch: BatchRequest,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    committed, results = await apply_batch(db, user.id, batch)
+    body = {"mode": batch.mode, "committed": committed, "results": results}
+    if not committed:
+        return JSONResponse(body, status_code=400)
+    return body
+
+
+# EXPORT EVERYTHING AS A ZIP (generated while it is sent)
+@app.get("/api/notes/export")
+async def api_export_notes(user: Optional[Identity] = Depends(current_user)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    filename = f"notes-{user.username}-{utcnow():%Y%m%d}.zip"
+    shard = shards.for_user(user.id)
+    return StreamingResponse(export_archive(shard.read_sessions, user.id, shard.blob_root),
+                             media_type=ARCHIVE_MEDIA_TYPE,
+                             headers={"Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}"})
+
+
+# IMPORT AN EXPORTED ZIP (committed in batches)
+@app.post("/api/notes/import", dependencies=[Depends(limit_writes)])
+async def api_import_notes(
+        file: UploadFile = File(...),
+        user: Optional[Identity] = Depends(current_user)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        shard = shards.for_user(user.id)
+        result = await import_archive(shard.sessions, user.id, file.file, settings.MAX_UPLOAD_BYTES,
+                                      shard.blob_root, batch_size=settings.IMPORT_BATCH_SIZE,
+                                      max_expanded_bytes=settings.MAX_IMPORT_EXPANDED_BYTES)
+    except InvalidArchive as exc:
+        return JSONResponse({"detail": str(exc), "imported": exc.imported}, status_code=400)
+    return {"imported": result.notes, "attachments": result.attachments}
 
 
 # GET SINGLE NOTE
 @app.get("/api/notes/{note_id}")
-async def api_get_note(note_id: int, db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+async def api_get_note(
+        note_id: int,
+        request: Request,
+        user: Optional[Identity] = Depends(current_user)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    variant = f"note:{note_id}"
+    version = await shared_notes_version(user.id)
+    etag = format_etag(user.id, version, variant)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    async def fetch():
+        async with shards.for_user(user.id).read_sessions() as db:
+            note = await db.scalar(select(Note).options(undefer(Note.content))
+                                  .where(Note.id == note_id, Note.user_id == user.id))
+        if not note:
+            return None
+        return json_body({"id": note.id, "title": note.title, "content": note.content, "filename": note.filename})
+
+    body = await note_reads.run((user.id, version, variant), fetch)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    response = Response(body, media_type="application/json")
+    set_cache_headers(response, etag)
+    return response
+
+
+# REVISION HISTORY OF A NOTE (newest first)
+@app.get("/api/notes/{note_id}/revisions")
+async def api_note_revisions(
+        note_id: int,
+        request: Request,
+        response: Response,
+        cursor: Optional[int] = Query(None, ge=1),
+        limit: int = Query(DEFAULT_REVISION_LIMIT, ge=1, le=MAX_REVISION_LIMIT),
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    etag = await notes_etag(db, user.id, variant=f"revisions:{note_id}:{cursor}:{limit}")
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+
+    if await db.scalar(select(Note.id).where(Note.id == note_id, Note.user_id == user.id)) is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+
+    revisions, next_cursor = await list_revisions(db, note_id, cursor, limit)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    set_cache_headers(response, etag)
+    return revisions
+
+
+# ONE REVISION, REBUILT FROM ITS SNAPSHOT AND DELTAS
+@app.get("/api/notes/{note_id}/revisions/{number}")
+async def api_note_revision(
+        note_id: int,
+        number: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_read_db)
+):
+    if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    if await db.scalar(select(Note.id).where(Note.id == note_id, Note.user_id == user.id)) is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    revision = await load_revision(db, note_id, number)
+    if not revision:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    return revision
+
+
+# PUT A NOTE BACK TO AN EARLIER REVISION (itself saved as a new revision)
+@app.post("/api/notes/{note_id}/revisions/{number}/restore", dependencies=[Depends(limit_writes)])
+async def api_restore_note_revision(
+        note_id: int,
+        number: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
+):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
+    revision = await load_revision(db, note_id, number)
+    if not revision:
+        raise HTTPException(status_code=404, detail="Revision not found")
 
-    return {"id": note.id, "title": note.title, "content": note.content, "filename": note.filename}
+    await record_revision(db, note.id, revision["title"], revision["content"])
+    note.title = revision["title"]
+    note.content = revision["content"]
+    await index_note(db, note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
+    return saved_note(note, revision["content"])
 
 
 # UPDATE NOTE
-@app.put("/api/notes/{note_id}")
+@app.put("/api/notes/{note_id}", dependencies=[Depends(limit_writes)])
 async def api_update_note(
         note_id: int,
         title: str = Body(...),
         content: str = Body(...),
-        db: Session = Depends(get_db)
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
 ):
-    username = session_data.get("user")
-    if not username:
+    if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
+    await record_revision(db, note.id, title, content)
     note.title = title
     note.content = content
-    db.commit()
-    db.refresh(note)
-
-    return {"id": note.id, "title": note.title, "content": note.content}
+    await index_note(db, note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
+    return saved_note(note, content)
 
 
 # DELETE NOTE
-@app.delete("/api/notes/{note_id}")
-async def api_delete_note(note_id: int, db: Session = Depends(get_db)):
-    username = session_data.get("user")
-    if not username:
+@app.delete("/api/notes/{note_id}", dependencies=[Depends(limit_writes)])
+async def api_delete_note(
+        note_id: int,
+        user: Optional[Identity] = Depends(current_user),
+        db: AsyncSession = Depends(get_notes_db)
+):
+    if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    note = db.query(Note).filter(Note.id == note_id).first()
+    note = await db.scalar(select(Note).where(Note.id == note_id, Note.user_id == user.id))
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    db.delete(note)
-    db.commit()
+    await unindex_note(db, note.id)
+    await delete_revisions(db, [note.id])
+    if note.sha256:
+        await release(db, note.sha256)
+    await db.delete(note)
+    await bump_notes_version(db, user.id)
+    await db.commit()
     return {"message": "Note deleted successfully"}
 
 
@@ -440,23 +972,27 @@ async def forget_password_page(request: Request):
 
 
 @app.post("/forgot-password")
-async def forget_password(request: Request, email: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.email == email).first()
+async def forget_password(request: Request, email: str = Form(...), db: AsyncSession = Depends(get_db)):
+    # per address too, so nobody can flood one inbox (or the SMTP quota) from many IPs
+    await rate_limiter.hit({"reset": client_ip(request), "reset-account": email.lower()})
+    user = await db.scalar(select(User).where(User.email == email))
     if not user:
         return templates.TemplateResponse("forgot_password.html", {"request": request, "msg": "❌ Email not found."})
 
     # generate reset token
     token = secrets.token_urlsafe(32)
     user.reset_token = token
-    db.commit()
 
     # reset password link
     reset_link = f"{os.getenv('APP_DOMAIN', 'http://127.0.0.1:8000')}/reset-password/{token}"    # Use your domain in production
 
-    # send email via FastAPI-mail
-    message = MessageSchema(
+    # queue the email in the same transaction as the token; the mail worker sends it.
+    # repeat requests replace the pending email, so only the latest link goes out
+    await enqueue(
+        db,
+        recipient=user.email,
         subject="Reset Your My Note Password",
-        recipients=[user.email],
+        dedupe_key=f"password-reset:{user.email}",
         body=f"""
         Hello {user.username},
         
@@ -468,12 +1004,10 @@ async def forget_password(request: Request, email: str = Form(...), db: Session
         
         Regards, 
         My Note Team By ENGR. IPAYE
-        """,
-        subtype=MessageType.plain
+        """
     )
-
-    fm = FastMail(conf)
-    await fm.send_message(message)
+    await db.commit()
+    mail_worker.wake()
 
     return templates.TemplateResponse(
         "forgot_password.html",
@@ -485,16 +1019,17 @@ async def forget_password(request: Request, email: str = Form(...), db: Session
 
 # RESET PASSWORD PAGE
 @app.get("/reset-password/{token}", response_class=HTMLResponse)
-async def reset_password_page(request: Request, token: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.reset_token == token).first()
+async def reset_password_page(request: Request, token: str, db: AsyncSession = Depends(get_read_db)):
+    user = await db.scalar(select(User).where(User.reset_token == token))
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
     return templates.TemplateResponse("reset_password.html", {"request": request, "token": token})
 
 
 @app.post("/reset-password/{token}")
-async def reset_password(request: Request, token: str, password: str = Form(...), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.reset_token == token).first()
+async def reset_password(request: Request, token: str, password: str = Form(...), db: AsyncSession = Depends(get_db)):
+    await rate_limiter.hit({"reset": client_ip(request)})
+    user = await db.scalar(select(User).where(User.reset_token == token))
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
 
@@ -503,10 +1038,11 @@ async def reset_password(request: Request, token: str, password: str = Form(...)
             "request": request, "token": token, "msg": "❌ Password must be at least 6 characters"
         })
 
-    # update password
-    user.password = password
+    # update password and sign out every existing session
+    user.password = await password_hasher.hash(password)
     user.reset_token = None
-    db.commit()
+    await session_store.revoke_user(db, user.id)
+    await db.commit()
 
     return templates.TemplateResponse("login.html",
                                       {"request": request, "msg": "✅ Password reset successful! Kindly log in."})
@@ -0,0 +1,262 @@
+"""In-process metrics, served in the Prometheus text format by GET /metrics.
+
+Counters, gauges and histograms are plain dicts of floats keyed by label
+values, so recording a sample is a dict lookup and an addition. They are
+only updated from the event loop thread, so there is no locking. Each
+worker process keeps and reports its own numbers; Prometheus adds them up
+when every worker is scraped (or use one worker per scrape target).
+"""
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 500)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """The series for these label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _label_text(self, values, extra=()) -> str:
+        pairs = [*zip(self.labelnames, values), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for values, child in self._children.items():
+            yield from self._render_child(values, child)
+
+    def _render_child(self, values, child):
+        yield f"{self.name}{self._label_text(values)} {_format(child.value)}"
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+    _new_child = _Value
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else _format(bound)
+            yield f"{self.name}_bucket{self._label_text(values, [('le', le)])} {cumulative}"
+        yield f"{self.name}_sum{self._label_text(values)} {_format(child.sum)}"
+        yield f"{self.name}_count{self._label_text(values)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time from request to the end of the response body.",
+                            ("method", "route"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled right now.")
+REQUEST_STATEMENTS = Histogram("http_request_sql_statements", "SQL statements run per request.", ("route",),
+                               buckets=COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram("http_request_sql_seconds", "Time spent in SQL per request.", ("route",))
+SQL_STATEMENTS = Counter("db_statements_total", "SQL statements executed.", ("engine",))
+SQL_SECONDS = Counter("db_statement_seconds_total", "Time spent executing SQL statements.", ("engine",))
+POOL_CHECKOUTS = Counter("db_pool_checkouts_total", "Connections handed out by the pool.", ("engine",))
+POOL_IN_USE = Gauge("db_pool_connections_in_use", "Pool connections checked out right now.", ("engine",))
+UPLOAD_BYTES = Counter("upload_bytes_total", "Attachment bytes received.")
+RATE_LIMITED = Counter("rate_limited_requests_total", "Requests refused with a 429, by the route's first budget.",
+                       ("budget",))
+SHED_REQUESTS = Counter("http_requests_shed_total", "Requests refused with a 503 by admission control.")
+ADMISSION_QUEUED = Gauge("http_requests_queued", "Requests waiting for admission.")
+COALESCED_READS = Counter("coalesced_reads_total",
+                          "Note reads by how they were served: fetched, shared with one in flight, or cached.",
+                          ("outcome",))
+MAIL_SEND_SECONDS = Histogram("mail_send_seconds", "Time to hand one email to the SMTP server.", ("result",))
+
+
+def route_template(scope) -> str:
+    """The path template of the route serving `scope`, e.g. /api/notes/{note_id}."""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # answered before routing (a 404, or a 413 from the upload limit): look the template up
+    app = scope.get("app")
+    for candidate in app.router.routes if app is not None else ():
+        if candidate.matches(scope)[0] == Match.FULL:
+            return getattr(candidate, "path", "unmatched")
+    return "unmatched"
+
+
+class _RequestStats:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+# SQL done on behalf of the current request; SQLAlchemy carries the context into its greenlets
+_request_stats: ContextVar[Optional[_RequestStats]] = ContextVar("request_sql_stats", default=None)
+
+
+def instrument_engine(engine, name: str):
+    """Count statements, SQL time and pool checkouts of `engine` (the sync_engine of an async one)."""
+    statements, seconds = SQL_STATEMENTS.labels(name), SQL_SECONDS.labels(name)
+    checkouts, in_use = POOL_CHECKOUTS.labels(name), POOL_IN_USE.labels(name)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["metrics_started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("metrics_started")
+        statements.value += 1
+        seconds.value += elapsed
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.seconds += elapsed
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checkouts.value += 1
+        in_use.value += 1
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        in_use.value -= 1
+
+
+class MetricsMiddleware:
+    """Times every request and counts it by route template and status.
+
+    Routes are labelled by their path template (/api/notes/{note_id}), never
+    by the raw path, so the number of series stays bounded. Latency runs
+    until the last byte of the body is sent, so streamed pages are measured
+    in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500  # if the app fails before starting a response
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = _RequestStats()
+        token = _request_stats.set(stats)
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            IN_FLIGHT.dec()
+            _request_stats.reset(token)
+            route, method = route_template(scope), scope["method"]
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_SECONDS.labels(method, route).observe(elapsed)
+            REQUEST_STATEMENTS.labels(route).observe(stats.statements)
+            REQUEST_SQL_SECONDS.labels(route).observe(stats.seconds)
@@ -0,0 +1,148 @@
+"""Schema migrations for notes.db, tracked in SQLite's PRAGMA user_version.
+
+create_all() only creates tables that don't exist yet, so every change to an
+existing table is a numbered step here. Each step runs in one transaction
+together with the user_version bump, and is written so that it is a no-op on
+a database create_all() has just built with the latest schema.
+
+    python migrations.py  -> upgrade ./notes.db in place
+
+The app runs init_database() from its lifespan handler, i.e. when a worker
+starts serving rather than when main.py is imported.
+
+Shard files (see shards.py) are created at LATEST_VERSION and only run the
+steps added after that, so a new step that touches users, sessions or
+another table that stays in notes.db must check that the table is there.
+"""
+import logging
+import sys
+
+from sqlalchemy import bindparam, inspect, select, text
+
+from database import Base
+from models import Note, make_excerpt, utcnow
+from search import ensure_index
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version: int):
+    def register(step):
+        MIGRATIONS.append((version, step))
+        return step
+    return register
+
+
+def add_column(conn, table: str, column: str, ddl: str):
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN "{column}" {ddl}')
+
+
+@migration(1)
+def attachment_columns(conn):
+    """Columns added before there were migrations: attachments in the blob store."""
+    add_column(conn, "notes", "sha256", "VARCHAR(64)")
+    add_column(conn, "notes", "size", "INTEGER")
+
+
+@migration(2)
+def owner_indexes(conn):
+    """Every note query filters on user_id; without an index each one scanned the table."""
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_notes_user_id_id ON notes (user_id, id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_sessions_expires_at ON sessions (expires_at)")
+
+
+@migration(3)
+def note_timestamps(conn):
+    """created_at/updated_at on notes. Existing notes get the time of the upgrade."""
+    add_column(conn, "notes", "created_at", "DATETIME")
+    add_column(conn, "notes", "updated_at", "DATETIME")
+    conn.exec_driver_sql("UPDATE notes SET created_at = ? WHERE created_at IS NULL", (utcnow().isoformat(" "),))
+    conn.exec_driver_sql("UPDATE notes SET updated_at = created_at WHERE updated_at IS NULL")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_notes_user_id_created_at ON notes (user_id, created_at)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_notes_user_id_updated_at ON notes (user_id, updated_at)")
+
+
+@migration(4)
+def notes_version(conn):
+    """Per-user change counter behind the ETags of note responses.
+
+    Superseded by user_notes_versions (step 6), which create_all() has made by
+    now: there's no counter to add, and none to move, below version 4.
+    """
+    if not inspect(conn).has_table("user_notes_versions"):
+        add_column(conn, "users", "notes_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(5)
+def note_excerpts(conn, batch_size: int = 1000):
+    """The excerpt column behind list views; long content is rewritten compressed on the way."""
+    add_column(conn, "notes", "excerpt", "VARCHAR")
+    notes = Note.__table__
+    update = (notes.update().where(notes.c.id == bindparam("note_id"))
+              .values(content=bindparam("content"), excerpt=bindparam("excerpt")))
+    last_id = 0
+    while True:
+        rows = conn.execute(select(notes.c.id, notes.c.content)
+                            .where(notes.c.id > last_id, notes.c.excerpt.is_(None), notes.c.content.is_not(None))
+                            .order_by(notes.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        conn.execute(update, [{"note_id": row.id, "content": row.content, "excerpt": make_excerpt(row.content)}
+                              for row in rows])
+        last_id = rows[-1].id
+
+
+@migration(6)
+def user_notes_versions(conn):
+    """users.notes_version moves to user_notes_versions, next to the notes, so a shard can bump it."""
+    if "notes_version" not in {c["name"] for c in inspect(conn).get_columns("users")}:
+        return
+    conn.execute(text("INSERT OR IGNORE INTO user_notes_versions (user_id, version) "
+                      "SELECT id, notes_version FROM users WHERE notes_version > 0"))
+    conn.exec_driver_sql("ALTER TABLE users DROP COLUMN notes_version")
+
+
+LATEST_VERSION = max(version for version, _ in MIGRATIONS)
+
+
+def schema_version(conn) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine) -> int:
+    """Apply every migration newer than the database. Returns the resulting version."""
+    for version, step in sorted(MIGRATIONS, key=lambda m: m[0]):
+        with engine.connect() as conn:
+            if schema_version(conn) >= version:
+                continue
+            # IMMEDIATE takes the write lock up front: workers starting at the
+            # same time queue here, and the loser sees the new version and skips
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            if schema_version(conn) < version:
+                step(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {version}")
+                logger.info("Migrated notes.db to version %d (%s)", version, step.__name__)
+            conn.commit()
+    with engine.connect() as conn:
+        return schema_version(conn)
+
+
+def init_database(engine) -> int:
+    """Create missing tables, apply migrations and make sure the search index exists."""
+    Base.metadata.create_all(bind=engine)
+    version = migrate(engine)
+    ensure_index(engine)
+    return version
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    if sys.argv[1:]:
+        sys.exit("usage: python migrations.py")
+    print(f"notes.db is at schema version {init_database(engine)}")
@@ -1,6 +1,55 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, DateTime, Float, Index, Integer, LargeBinary, String, ForeignKey, text
+from sqlalchemy.types import TypeDecorator
 from database import Base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship, validates
+from datetime import datetime, timezone
+from typing import Optional
+import zlib
+
+# note content longer than this (UTF-8 bytes) is stored compressed
+COMPRESS_ABOVE = 4096
+EXCERPT_LENGTH = 200
+
+
+def utcnow():
+    # naive UTC, which is what SQLite's DATETIME columns round-trip
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def make_excerpt(content: Optional[str]) -> Optional[str]:
+    """The start of `content` on one line, cut at a word and ended with … when there is more."""
+    if not content:
+        return content
+    # only the start is needed, however long the note
+    text = " ".join(content[:EXCERPT_LENGTH * 4].split())
+    if len(text) <= EXCERPT_LENGTH and len(content) <= EXCERPT_LENGTH * 4:
+        return text
+    cut = text[:EXCERPT_LENGTH + 1]
+    return (cut.rsplit(" ", 1)[0] if " " in cut else cut[:EXCERPT_LENGTH]) + "…"
+
+
+class CompressedText(TypeDecorator):
+    """Text that is stored zlib-compressed, as a BLOB, once it is longer than COMPRESS_ABOVE bytes.
+
+    Shorter text is stored as it is. Reads tell the two apart by type, so
+    a column can hold both and existing rows need no rewrite.
+    """
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            encoded = value.encode()
+            if len(encoded) > COMPRESS_ABOVE:
+                compressed = zlib.compress(encoded)
+                if len(compressed) < len(encoded):
+                    return compressed
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode()
+        return value
 
 
 class User(Base):
@@ -16,12 +65,122 @@ class User(Base):
 
 class Note(Base):
     __tablename__ = "notes"
+    __table_args__ = (
+        # existing databases get these from migrations.py
+        Index("ix_notes_user_id_id", "user_id", "id"),
+        Index("ix_notes_user_id_created_at", "user_id", "created_at"),
+        Index("ix_notes_user_id_updated_at", "user_id", "updated_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String, nullable=False)
-    content = Column(String, nullable=True)
+    # loaded only when asked for (undefer() or selecting the column), so list views never read note bodies
+    content = deferred(Column(CompressedText, nullable=True))
+    excerpt = Column(String, nullable=True)  # make_excerpt(content), for list views
     filename = Column(String, nullable=True)
+    sha256 = Column(String(64), nullable=True)  # of the attachment, computed while uploading
+    size = Column(Integer, nullable=True)  # attachment size in bytes
     user_id = Column(Integer, ForeignKey("users.id"))
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
 
     user = relationship("User", back_populates="notes")
 
+    @validates("content")
+    def _update_excerpt(self, key, content):
+        # ORM writes; bulk INSERT/UPDATE statements set the excerpt themselves
+        self.excerpt = make_excerpt(content)
+        return content
+
+
+class NoteRevision(Base):
+    """One saved version of a note; see revisions.py for what `data` holds."""
+    __tablename__ = "note_revisions"
+    __table_args__ = (
+        Index("ux_note_revisions_note_id_number", "note_id", "number", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    note_id = Column(Integer, ForeignKey("notes.id"), nullable=False)
+    number = Column(Integer, nullable=False)  # 1, 2, ... for each note
+    title = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)  # zlib-compressed content, or a delta from the revision before
+    created_at = Column(DateTime, nullable=False)
+
+
+class NotesVersion(Base):
+    """Bumped by every write to a user's notes; the ETag of their note responses.
+
+    Kept next to the notes rather than on the user, so that it changes in
+    the same transaction as they do, whichever shard they are in.
+    """
+    __tablename__ = "user_notes_versions"
+
+    user_id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+
+class LoginSession(Base):
+    __tablename__ = "sessions"
+
+    # sha256 of the session token; the token itself only lives in the client's cookie
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, index=True, nullable=False)
+
+
+class RateLimitBucket(Base):
+    """A token bucket of ratelimit.SQLiteBuckets, shared by every worker."""
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)  # "<budget>:<client>"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, index=True, nullable=False)  # unix time the tokens were counted at
+
+
+class ShardLayout(Base):
+    """The one row saying where notes are kept (see shards.py); only in notes.db."""
+    __tablename__ = "shard_layout"
+
+    id = Column(Integer, primary_key=True)  # always 1
+    shards = Column(Integer, nullable=False)  # 0: in notes.db itself
+    rebalancing_to = Column(Integer, nullable=True)  # set while `python shards.py rebalance` runs
+    next_note_id = Column(Integer, nullable=False)  # note ids are handed out from here when sharded
+
+
+class Blob(Base):
+    """One stored attachment file, shared by every note with the same content."""
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    # set when refcount drops to 0; the sweeper deletes the file once this is old enough
+    orphaned_at = Column(DateTime, nullable=True, index=True)
+
+
+class OutboxMessage(Base):
+    """An email waiting to be sent (or already sent) by the mail worker."""
+    __tablename__ = "outbox"
+    __table_args__ = (
+        # at most one pending message per dedupe key, e.g. one reset mail per address
+        Index("ux_outbox_pending_dedupe", "dedupe_key", unique=True,
+              sqlite_where=text("status = 'pending'")),
+        Index("ix_outbox_due", "status", "next_attempt_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    dedupe_key = Column(String, nullable=True)
+    status = Column(String, nullable=False, default="pending")  # pending | sent | failed
+    # bumped whenever a pending message is replaced, so a send of the old body doesn't mark it sent
+    revision = Column(Integer, nullable=False, default=1)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
@@ -0,0 +1,94 @@
+import json
+from typing import AsyncIterator, Optional, Sequence
+
+from sqlalchemy import select
+
+from models import Note
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# rows fetched per round trip when streaming NDJSON
+STREAM_BATCH_SIZE = 500
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# what ?fields= can ask for
+NOTE_FIELDS = {
+    "id": Note.id, "title": Note.title, "excerpt": Note.excerpt, "content": Note.content,
+    "filename": Note.filename, "size": Note.size, "created_at": Note.created_at, "updated_at": Note.updated_at,
+}
+# without ?fields=, as before there was a choice
+DEFAULT_FIELDS = ("id", "title", "content", "filename")
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+def parse_fields(fields: Optional[str]) -> tuple:
+    """`title,excerpt` -> ("id", "title", "excerpt"). The id is always included: it is the page cursor."""
+    if fields is None:
+        return DEFAULT_FIELDS
+    names = ["id"]
+    for name in (name.strip() for name in fields.split(",")):
+        if name not in NOTE_FIELDS:
+            raise InvalidFields(name)
+        if name not in names:
+            names.append(name)
+    return tuple(names)
+
+
+def notes_query(user_id: int, cursor: Optional[int] = None, limit: Optional[int] = None,
+                fields: Sequence[str] = DEFAULT_FIELDS):
+    """SELECT of `fields` of a user's notes in id order, starting after `cursor`.
+
+    Keyset pagination: the next page is always `id > last id seen`, so the
+    cost of a page does not grow with how deep into the list the client is.
+    Only the requested columns are read, so a list without content never
+    touches note bodies.
+    """
+    query = select(*(NOTE_FIELDS[name] for name in fields)).where(Note.user_id == user_id)
+    if cursor is not None:
+        query = query.where(Note.id > cursor)
+    query = query.order_by(Note.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+async def fetch_notes_page(db, user_id: int, cursor: Optional[int], limit: int,
+                           fields: Sequence[str] = DEFAULT_FIELDS):
+    """Return (notes, next_cursor) for one page.
+
+    One extra row is fetched to know whether another page exists, so no
+    COUNT(*) is needed. `next_cursor` is None on the last page.
+    """
+    rows = (await db.execute(notes_query(user_id, cursor, limit + 1, fields))).all()
+    notes = [dict(row._mapping) for row in rows[:limit]]
+    next_cursor = notes[-1]["id"] if len(rows) > limit else None
+    return notes, next_cursor
+
+
+def wants_ndjson(request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def _json_default(value):
+    return value.isoformat()  # created_at/updated_at
+
+
+async def stream_notes_ndjson(session_factory, user_id: int, cursor: Optional[int] = None,
+                              fields: Sequence[str] = DEFAULT_FIELDS) -> AsyncIterator[bytes]:
+    """Yield every note after `cursor` as NDJSON, one batch at a time.
+
+    Opens its own session from `session_factory` because the request's
+    session is closed once the handler returns, before the body is streamed.
+    `stream()` with `yield_per` keeps a server-side cursor open, so only one
+    batch of rows is held in memory.
+    """
+    async with session_factory() as db:
+        result = await db.stream(
+            notes_query(user_id, cursor, fields=fields).execution_options(yield_per=STREAM_BATCH_SIZE))
+        async for rows in result.partitions():
+            yield "".join(json.dumps(dict(row._mapping), default=_json_default) + "\n" for row in rows).encode()
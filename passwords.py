@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+SCHEME = "scrypt"
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class PasswordHasher:
+    """Salted scrypt hashing on a dedicated, bounded thread pool.
+
+    scrypt is deliberately slow and memory hungry, so it never runs on the
+    event loop; hashlib releases the GIL while it works, so concurrent logins
+    spread across up to `workers` cores. Hashes are stored as
+    `scrypt$n$r$p$salt$key`, which keeps the cost of each hash next to it and
+    lets the parameters be raised later without breaking existing rows.
+    """
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, workers: int = 4):
+        self.n, self.r, self.p = n, r, p
+        self.workers = workers
+        # both made on first use, so creating a hasher (importing the app) costs nothing
+        self._pool = None
+        self._dummy_hash = None
+
+    def _derive(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES,
+                              maxmem=256 * n * r + 1024 * 1024)
+
+    def _hash_sync(self, password: str, salt: bytes) -> str:
+        key = self._derive(password, salt, self.n, self.r, self.p)
+        return f"{SCHEME}${self.n}${self.r}${self.p}${_b64(salt)}${_b64(key)}"
+
+    def _verify_sync(self, password: str, stored: str):
+        if not stored.startswith(SCHEME + "$"):
+            # legacy row from before hashing: plaintext
+            return hmac.compare_digest(password.encode(), stored.encode()), True
+        _, n, r, p, salt, key = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        derived = self._derive(password, base64.b64decode(salt), n, r, p)
+        ok = hmac.compare_digest(derived, base64.b64decode(key))
+        return ok, (n, r, p) != (self.n, self.r, self.p)
+
+    def _verify_unknown_sync(self, password: str):
+        # verified against when an account doesn't exist, so both cases cost the same
+        if self._dummy_hash is None:
+            self._dummy_hash = self._hash_sync("dummy password", os.urandom(SALT_BYTES))
+        self._verify_sync(password, self._dummy_hash)
+
+    async def _run(self, fn, *args):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self._hash_sync, password, os.urandom(SALT_BYTES))
+
+    async def verify(self, password: str, stored):
+        """Return (matches, needs_rehash).
+
+        `needs_rehash` is True for plaintext rows and for hashes made with
+        other cost parameters; callers re-hash the password after a
+        successful login so old rows upgrade themselves.
+        """
+        if stored is None:
+            await self._run(self._verify_unknown_sync, password)
+            return False, False
+        return await self._run(self._verify_sync, password, stored)
+
+    def shutdown(self):
+        """Stop the pool's threads. A later hash or verify starts a new pool."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
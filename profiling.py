@@ -0,0 +1,170 @@
+"""Opt-in diagnostics for slow requests: cProfile dumps and a slow-query log.
+
+Both are off by default, and then nothing here is installed: no middleware
+in front of the app and no listeners on the engines.
+
+    python -m pstats .cache/profiles/<file>.pstats   -> browse a saved profile
+"""
+import cProfile
+import logging
+import os
+import random
+import re
+import secrets
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from starlette.concurrency import run_in_threadpool
+
+from metrics import route_template
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+
+# the request whose code is running, for the slow-query log
+_current_scope: ContextVar[Optional[dict]] = ContextVar("current_request_scope", default=None)
+
+
+def _profile_name(scope) -> str:
+    path = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-") or "root"
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{scope['method']}-{path[:60]}-{secrets.token_hex(4)}.pstats"
+
+
+class ProfilerMiddleware:
+    """Run chosen requests under cProfile and save the stats to `directory`.
+
+    A request is profiled if it sends `X-Profile: <token>`, or at random with
+    probability `sample_rate`. The saved file's name comes back in the
+    response's X-Profile header. cProfile sees the whole thread, so other
+    requests running at the same time show up in the profile as well. Only
+    one request per process is profiled at a time; others run normally.
+    """
+
+    def __init__(self, app, directory: str, token: Optional[str] = None, sample_rate: float = 0.0):
+        self.app = app
+        self.directory = directory
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        self._busy = False
+
+    def _wanted(self, scope) -> bool:
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER.encode() and secrets.compare_digest(value, self.token):
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._busy or not self._wanted(scope):
+            return await self.app(scope, receive, send)
+
+        name = _profile_name(scope)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (PROFILE_HEADER.encode(), name.encode())]
+            await send(message)
+
+        self._busy = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send_with_header)
+        finally:
+            profile.disable()
+            self._busy = False
+            os.makedirs(self.directory, exist_ok=True)
+            await run_in_threadpool(profile.dump_stats, os.path.join(self.directory, name))
+            logger.info("Profiled %s %s into %s", scope["method"], scope["path"], name)
+
+
+class RequestContextMiddleware:
+    """Makes the current request visible to code that has no access to it (the slow-query log)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_scope.reset(token)
+
+
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def _format_plan(rows) -> str:
+    # rows are (id, parent, notused, detail); indent each step under its parent
+    depth, lines = {0: 0}, []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, 0) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return "\n".join(lines)
+
+
+def _parameter_types(parameters, executemany: bool) -> str:
+    # the values can be reset tokens, password hashes or email addresses: only their types are logged
+    if executemany:
+        return f"{len(parameters)} rows"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+
+
+class SlowQueryLog:
+    """Log statements slower than `threshold_ms`, with their query plan and the route that ran them.
+
+    Bound parameters are logged as their types, unless `log_parameters` is set.
+    """
+
+    def __init__(self, threshold_ms: float, explain: bool = True, log_parameters: bool = False):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.log_parameters = log_parameters
+        # bound once, so remove() can find the same listeners again
+        self._listeners = (("before_cursor_execute", self._before), ("after_cursor_execute", self._after))
+
+    def instrument(self, engine):
+        """Watch `engine` (the sync_engine of an async one)."""
+        for name, listener in self._listeners:
+            event.listen(engine, name, listener)
+
+    def remove(self, engine):
+        for name, listener in self._listeners:
+            event.remove(engine, name, listener)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["slow_query_started"] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop("slow_query_started")
+        if elapsed < self.threshold:
+            return
+        scope = _current_scope.get()
+        source = f"{scope['method']} {route_template(scope)} ({scope['path']})" if scope else "no request"
+        plan = self._plan(conn, statement, parameters) if self.explain and not executemany else None
+        shown = repr(parameters) if self.log_parameters else _parameter_types(parameters, executemany)
+        logger.warning("Slow query, %.1fms, from %s:\n%s\nparameters: %s%s", elapsed * 1000, source,
+                       statement, shown, f"\nquery plan:\n{plan}" if plan else "")
+
+    @staticmethod
+    def _plan(conn, statement: str, parameters) -> Optional[str]:
+        if not statement.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        # a separate cursor on the same connection, so the slow statement's results are untouched
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return _format_plan(cursor.fetchall())
+        except Exception as exc:
+            return f"(EXPLAIN QUERY PLAN failed: {exc})"
+        finally:
+            cursor.close()
@@ -0,0 +1,254 @@
+"""Per-client rate limits and admission control.
+
+RateLimiter keeps a token bucket per (budget, client), e.g. ("login",
+"203.0.113.7") or ("login-account", "ann@example.com"). A budget of
+"10/60" holds up to 10 tokens and refills at 10 per 60 seconds, so it
+allows bursts of 10 and 10 a minute after that. Every request takes a
+token from each of its buckets; once one is empty the request gets a 429
+with Retry-After, before the route does any work.
+
+Buckets live in memory by default, so each worker process counts on its
+own. SQLiteBuckets keeps them in the rate_limits table instead, shared by
+every worker, at the cost of a small write transaction per request.
+
+AdmissionControlMiddleware caps the requests a worker handles at once.
+Requests over the cap wait in a short queue; once the queue is full, or a
+request has waited too long, it is turned away with a 503, so the ones
+already admitted keep their latency.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete, text
+from starlette.responses import JSONResponse
+
+from metrics import ADMISSION_QUEUED, RATE_LIMITED, SHED_REQUESTS
+from models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# buckets kept per worker by MemoryBuckets; the least recently used are dropped (i.e. refilled) first
+MEMORY_BUCKETS = 100_000
+
+
+@dataclass(frozen=True)
+class Budget:
+    capacity: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.seconds
+
+
+def parse_budget(value: str) -> Budget:
+    """"10/60" -> 10 requests per 60 seconds."""
+    capacity, _, seconds = value.partition("/")
+    try:
+        budget = Budget(int(capacity), float(seconds))
+    except ValueError:
+        raise ValueError(f"rate limit {value!r} is not <requests>/<seconds>")
+    if budget.capacity < 1 or budget.seconds <= 0:
+        raise ValueError(f"rate limit {value!r} must allow at least one request per positive period")
+    return budget
+
+
+class RateLimited(HTTPException):
+    # an HTTPException, like UploadTooLarge, so it becomes a 429 wherever it is raised
+    def __init__(self, retry_after: float):
+        super().__init__(status_code=429, detail="Too many requests",
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+def _refill(tokens: float, elapsed: float, budget: Budget) -> float:
+    return min(budget.capacity, tokens + max(elapsed, 0.0) * budget.rate)
+
+
+class MemoryBuckets:
+    """Token buckets in this process: {key: (tokens, monotonic time they were counted at)}."""
+
+    def __init__(self, maxsize: int = MEMORY_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    async def take(self, buckets: Dict[str, Budget]) -> float:
+        wait = 0.0
+        now = time.monotonic()
+        for key, budget in buckets.items():
+            tokens, counted_at = self._buckets.pop(key, (budget.capacity, now))
+            tokens = _refill(tokens, now - counted_at, budget)
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = max(wait, (1 - tokens) / budget.rate)
+            self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+_REFILLED = "min(:capacity, tokens + max(:now - updated_at, 0) * :rate)"
+# plain SQL: a text statement compiles once, an upsert construct every time it is built
+_TAKE = text(f"""
+    INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :capacity - 1, :now)
+    ON CONFLICT (key) DO UPDATE SET tokens = {_REFILLED} - 1, updated_at = :now WHERE {_REFILLED} >= 1
+    RETURNING key
+""")
+_TOKENS = text(f"SELECT {_REFILLED} FROM rate_limits WHERE key = :key")
+
+
+class SQLiteBuckets:
+    """Token buckets in the rate_limits table, so every worker draws on the same ones.
+
+    Each take is one upsert per bucket that only succeeds while the bucket
+    has a token, all in one transaction. Times are wall-clock seconds,
+    the one clock all workers share.
+    """
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+
+    async def take(self, buckets: Dict[str, Budget]) -> float:
+        wait = 0.0
+        now = time.time()
+        async with self.session_factory() as db:
+            for key, budget in buckets.items():
+                params = {"key": key, "capacity": budget.capacity, "rate": budget.rate, "now": now}
+                if await db.scalar(_TAKE, params) is None:
+                    tokens = await db.scalar(_TOKENS, params)
+                    wait = max(wait, (1 - tokens) / budget.rate)
+            await db.commit()
+        return wait
+
+    async def purge(self, max_seconds: float) -> int:
+        """Delete buckets that have refilled completely, i.e. untouched for `max_seconds`."""
+        async with self.session_factory() as db:
+            result = await db.execute(delete(RateLimitBucket)
+                                      .where(RateLimitBucket.updated_at < time.time() - max_seconds))
+            await db.commit()
+        return result.rowcount
+
+    def clear(self):
+        pass  # shared with other workers; expired rows go through purge()
+
+
+class RateLimiter:
+    """Named budgets over a bucket store.
+
+        await limiter.hit({"login": client_ip(request), "login-account": email})
+
+    takes a token from the "login" bucket of this IP and from the
+    "login-account" bucket of this email address, and raises RateLimited if
+    either was empty.
+    """
+
+    def __init__(self, budgets: Dict[str, Budget], store, enabled: bool = True):
+        self.budgets = budgets
+        self.store = store
+        self.enabled = enabled
+
+    async def hit(self, keys: Dict[str, Optional[str]]):
+        if not self.enabled:
+            return
+        buckets = {f"{name}:{key}": self.budgets[name] for name, key in keys.items() if key is not None}
+        wait = await self.store.take(buckets)
+        if wait > 0:
+            RATE_LIMITED.labels(next(iter(keys))).inc()
+            raise RateLimited(wait)
+
+    async def run_purger(self, interval: float):
+        """Background task for a SQLiteBuckets store: drop full buckets every `interval` seconds."""
+        longest = max((budget.seconds for budget in self.budgets.values()), default=0)
+        while True:
+            try:
+                purged = await self.store.purge(longest)
+                if purged:
+                    logger.info("Purged %d idle rate-limit buckets", purged)
+            except Exception:
+                logger.exception("Rate-limit purge failed")
+            await asyncio.sleep(interval)
+
+    def clear(self):
+        self.store.clear()
+
+
+def client_ip(request) -> str:
+    # the peer address; behind a proxy run uvicorn with --proxy-headers so this is the real client
+    return request.client.host if request.client else "unknown"
+
+
+class AdmissionControlMiddleware:
+    """Handle at most `max_in_flight` requests at once; queue up to `max_queued` more.
+
+    Queued requests are admitted first come first served as others finish.
+    A request that finds the queue full, or waits longer than
+    `queue_timeout` seconds, gets a 503 with Retry-After. Requests to
+    `exempt` paths (health checks, metrics) are always let through. A
+    request counts as in flight until its response body has been sent.
+    """
+
+    def __init__(self, app, max_in_flight: int, max_queued: int, queue_timeout: float, retry_after: int = 1,
+                 exempt=("/ping", "/metrics")):
+        self.app = app
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.exempt = set(exempt)
+        self.in_flight = 0
+        self._waiters = deque()
+
+    async def _admit(self) -> bool:
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return True
+        if len(self._waiters) >= self.max_queued:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUED.inc()
+        try:
+            # _release() hands the slot over by resolving the future, in_flight stays as it is
+            await asyncio.wait_for(waiter, self.queue_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # admitted just as the client went away
+            raise
+        finally:
+            ADMISSION_QUEUED.dec()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt:
+            return await self.app(scope, receive, send)
+
+        if not await self._admit():
+            SHED_REQUESTS.inc()
+            response = JSONResponse({"detail": "Server busy, retry later"}, status_code=503,
+                                    headers={"Retry-After": str(self.retry_after)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._release()
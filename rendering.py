@@ -0,0 +1,79 @@
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from markupsafe import Markup
+from starlette.templating import Jinja2Templates
+
+from cache import TTLCache
+
+
+class _BytecodeCache(FileSystemBytecodeCache):
+    # the directory is made when the first template is compiled, not at import
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+
+def _bytecode_cache(directory: str) -> FileSystemBytecodeCache:
+    return _BytecodeCache(os.path.abspath(directory))
+
+
+def create_templates(directory: str, bytecode_dir: str) -> Jinja2Templates:
+    """Jinja2Templates whose compiled templates persist in `bytecode_dir`.
+
+    Every worker shares the directory, so only the first one to load a
+    template after a deploy compiles it; the rest (and restarted workers)
+    load the bytecode instead.
+    """
+    env = Environment(loader=FileSystemLoader(directory), autoescape=True,
+                      bytecode_cache=_bytecode_cache(bytecode_dir))
+    return Jinja2Templates(env=env)
+
+
+def async_environment(env: Environment, bytecode_dir: str) -> Environment:
+    """An async-enabled copy of `env` for stream_template().
+
+    Async templates compile to different code under the same cache keys,
+    so they get their own template and bytecode caches.
+    """
+    return env.overlay(enable_async=True, cache_size=400,
+                       bytecode_cache=_bytecode_cache(os.path.join(bytecode_dir, "async")))
+
+
+class FragmentCache:
+    """Rendered HTML of small templates, e.g. one note card, kept in-process.
+
+    The caller's `key` must change whenever the output would (a note's id
+    and updated_at for a card), so entries never need invalidating; old
+    ones just fall out of the LRU.
+    """
+
+    def __init__(self, env: Environment, maxsize: int = 10_000, ttl: float = 3600.0):
+        self._env = env
+        self._cache = TTLCache(maxsize, ttl)
+
+    def render(self, template_name: str, key, **context) -> Markup:
+        cache_key = (template_name, key)
+        html = self._cache.get(cache_key)
+        if html is None:
+            html = Markup(self._env.get_template(template_name).render(**context))
+            self._cache.set(cache_key, html)
+        return html
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+async def stream_template(env: Environment, template_name: str, context: dict):
+    """Yield a template's output piece by piece, as UTF-8 for a StreamingResponse.
+
+    Async iterables in `context` are consumed as the template reaches them,
+    so a long list is sent while its rows are still being read. `env` must
+    be async-enabled (see async_environment()).
+    """
+    template = env.get_template(template_name)
+    async for chunk in template.generate_async(**context):
+        yield chunk.encode()
@@ -0,0 +1,153 @@
+"""Revision history of notes, stored as compressed deltas.
+
+Every save that changes a note's title or content adds a revision, numbered
+from 1 for each note; the newest revision is the note as it is now. A note
+that has never been edited has no revisions: its first edit saves the
+version it replaces as revision 1.
+
+Revision 1, and every SNAPSHOT_INTERVAL-th one after it, holds the whole
+content. The others hold a word-level diff from the revision before: runs
+copied from it as [start, end) token ranges, and new text as strings.
+Either way the JSON is zlib-compressed. Rebuilding any revision reads one
+snapshot and at most SNAPSHOT_INTERVAL - 1 deltas.
+"""
+import json
+import re
+import zlib
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+from sqlalchemy import delete, func, insert, select
+from starlette.concurrency import run_in_threadpool
+
+from models import Note, NoteRevision, utcnow
+
+SNAPSHOT_INTERVAL = 16
+
+DEFAULT_REVISION_LIMIT = 50
+MAX_REVISION_LIMIT = 200
+
+# a word with the whitespace after it, or leading whitespace; joined, the tokens are the text again
+_TOKEN = re.compile(r"\s+|\S+\s*")
+
+
+def _tokens(text: Optional[str]) -> List[str]:
+    return _TOKEN.findall(text or "")
+
+
+def encode_snapshot(content: Optional[str]) -> bytes:
+    return zlib.compress(json.dumps({"content": content}).encode())
+
+
+def encode_delta(old: Optional[str], new: Optional[str]) -> bytes:
+    """`new` as a diff from `old`, or as a snapshot when that is smaller (or either is None)."""
+    snapshot = encode_snapshot(new)
+    if old is None or new is None:
+        return snapshot
+    old_tokens, new_tokens = _tokens(old), _tokens(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old_tokens, new_tokens).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(new_tokens[j1:j2]))
+    delta = zlib.compress(json.dumps({"ops": ops}).encode())
+    return delta if len(delta) < len(snapshot) else snapshot
+
+
+def apply(previous: Optional[str], data: bytes) -> Optional[str]:
+    """The content stored in `data`, given the content of the revision before it."""
+    payload = json.loads(zlib.decompress(data))
+    if "content" in payload:
+        return payload["content"]
+    tokens = _tokens(previous)
+    return "".join("".join(tokens[op[0]:op[1]]) if isinstance(op, list) else op for op in payload["ops"])
+
+
+def rebuild(chain: List[bytes]) -> Optional[str]:
+    """The content at the end of a chain of revisions that starts with a snapshot."""
+    content = None
+    for data in chain:
+        content = apply(content, data)
+    return content
+
+
+def snapshot_number(number: int) -> int:
+    """The snapshot that revision `number` is rebuilt from."""
+    return number - (number - 1) % SNAPSHOT_INTERVAL
+
+
+def _revision_rows(current, edits: dict, latest: dict, now) -> List[dict]:
+    rows = []
+    for note in current:
+        title, content = edits[note.id]
+        if (title, content) == (note.title, note.content):
+            continue
+        number = latest.get(note.id)
+        if number is None:
+            # first edit: keep the version it replaces
+            number = 1
+            rows.append({"note_id": note.id, "number": number, "title": note.title,
+                         "data": encode_snapshot(note.content), "created_at": note.updated_at or now})
+        number += 1
+        data = encode_snapshot(content) if snapshot_number(number) == number else encode_delta(note.content, content)
+        rows.append({"note_id": note.id, "number": number, "title": title, "data": data, "created_at": now})
+    return rows
+
+
+async def record_revisions(db, edits: dict):
+    """Add a revision for each note about to be saved with a new title or content.
+
+    `edits` maps note id -> (title, content) as they are about to be saved.
+    Call before updating the notes, in the same transaction. The notes are
+    read again under the write lock, so each delta starts from the version
+    that is really being replaced.
+    """
+    if not edits:
+        return
+    await db.begin_write()
+    current = (await db.execute(select(Note.id, Note.title, Note.content, Note.updated_at)
+                                .where(Note.id.in_(edits)))).all()
+    latest = dict((await db.execute(select(NoteRevision.note_id, func.max(NoteRevision.number))
+                                    .where(NoteRevision.note_id.in_(edits))
+                                    .group_by(NoteRevision.note_id))).all())
+    # diffing and compressing a long note takes a while: off the event loop
+    rows = await run_in_threadpool(_revision_rows, current, edits, latest, utcnow())
+    if rows:
+        await db.execute(insert(NoteRevision), rows)
+
+
+async def record_revision(db, note_id: int, title: str, content: Optional[str]):
+    await record_revisions(db, {note_id: (title, content)})
+
+
+async def delete_revisions(db, note_ids):
+    if note_ids:
+        await db.execute(delete(NoteRevision).where(NoteRevision.note_id.in_(list(note_ids))))
+
+
+async def list_revisions(db, note_id: int, cursor: Optional[int], limit: int):
+    """Return (revisions, next_cursor), newest first; keyset-paginated on the revision number."""
+    query = (select(NoteRevision.number, NoteRevision.title, NoteRevision.created_at,
+                    func.length(NoteRevision.data).label("stored_bytes"))
+             .where(NoteRevision.note_id == note_id))
+    if cursor is not None:
+        query = query.where(NoteRevision.number < cursor)
+    rows = (await db.execute(query.order_by(NoteRevision.number.desc()).limit(limit + 1))).all()
+    revisions = [dict(row._mapping) for row in rows[:limit]]
+    next_cursor = revisions[-1]["number"] if len(rows) > limit else None
+    return revisions, next_cursor
+
+
+async def load_revision(db, note_id: int, number: int) -> Optional[dict]:
+    """Revision `number` of a note with its content rebuilt, or None if there is no such revision."""
+    rows = (await db.execute(select(NoteRevision.number, NoteRevision.title, NoteRevision.data,
+                                    NoteRevision.created_at)
+                             .where(NoteRevision.note_id == note_id,
+                                    NoteRevision.number.between(snapshot_number(number), number))
+                             .order_by(NoteRevision.number))).all()
+    if not rows or rows[-1].number != number:
+        return None
+    content = await run_in_threadpool(rebuild, [row.data for row in rows])
+    last = rows[-1]
+    return {"number": last.number, "title": last.title, "content": content, "created_at": last.created_at}
@@ -0,0 +1,173 @@
+import html
+import sys
+from typing import Optional
+
+from sqlalchemy import DDL, bindparam, event, select, text
+
+from models import Note
+
+FTS_TABLE = "notes_fts"
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# notes read per round trip by rebuild_index()
+REBUILD_BATCH_SIZE = 1000
+
+# snippet() markers; private-use characters so they survive html.escape
+# and can't be forged by note content
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"
+
+CREATE_FTS_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    "USING fts5(title, content, user_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+)
+
+_INSERT_ROW = text(f"INSERT INTO {FTS_TABLE} (rowid, title, content, user_id) "
+                   "VALUES (:id, :title, :content, :user_id)")
+
+# keep the index in step with create_all()/drop_all() on the notes table
+event.listen(Note.__table__, "after_create", DDL(CREATE_FTS_TABLE))
+event.listen(Note.__table__, "before_drop", DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def ensure_index(engine):
+    """Create the FTS table on an existing database and fill it if it is new."""
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": FTS_TABLE}).first()
+        if not exists:
+            conn.execute(text(CREATE_FTS_TABLE))
+            rebuild_index(conn)
+
+
+def rebuild_index(conn):
+    """Re-index every note from the notes table. Returns the number of rows indexed."""
+    conn.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    # read through the ORM column so compressed content comes back as text, not as a BLOB
+    result = conn.execution_options(yield_per=REBUILD_BATCH_SIZE).execute(
+        select(Note.id, Note.title, Note.content, Note.user_id))
+    indexed = 0
+    for rows in result.partitions():
+        index_rows(conn, [row._mapping for row in rows])
+        indexed += len(rows)
+    return indexed
+
+
+def index_rows(conn, notes):
+    """Add notes (mappings with id/title/content/user_id) that aren't indexed yet, on a sync connection."""
+    if notes:
+        conn.execute(_INSERT_ROW, [{**note, "content": note["content"] or ""} for note in notes])
+
+
+async def index_note(db, note):
+    """Add or replace `note` in the index. Call after the note has an id."""
+    await index_notes(db, [{"id": note.id, "title": note.title, "content": note.content, "user_id": note.user_id}])
+
+
+async def index_notes(db, notes):
+    """Add or replace many notes (dicts with id/title/content/user_id) in two statements."""
+    if not notes:
+        return
+    await unindex_notes(db, [note["id"] for note in notes])
+    await db.execute(_INSERT_ROW, [{**note, "content": note["content"] or ""} for note in notes])
+
+
+async def unindex_note(db, note_id: int):
+    await unindex_notes(db, [note_id])
+
+
+async def unindex_notes(db, note_ids):
+    if note_ids:
+        await db.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN :ids").bindparams(
+            bindparam("ids", expanding=True)), {"ids": list(note_ids)})
+
+
+def build_match_query(q: str) -> Optional[str]:
+    """Turn free text into an FTS5 query: every word must match, as a literal.
+
+    Quoting each term stops user input from being parsed as FTS5 syntax
+    (AND/OR/NEAR, column filters, stray quotes), which would otherwise
+    surface as SQL errors.
+    """
+    terms = ['"' + term.replace('"', '""') + '"' for term in q.split()]
+    return " ".join(terms) or None
+
+
+def encode_cursor(score: float, note_id: int) -> str:
+    return f"{score!r}:{note_id}"
+
+
+def decode_cursor(cursor: str):
+    try:
+        score, note_id = cursor.rsplit(":", 1)
+        return float(score), int(note_id)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+def _render_snippet(raw: str) -> str:
+    return html.escape(raw).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>")
+
+
+async def search_notes(db, user_id: int, q: str, cursor: Optional[str], limit: int):
+    """Return (results, next_cursor) for a user's notes matching `q`.
+
+    Results are ordered by bm25 (best first), with the note id as a tie
+    breaker so that (score, id) is a stable keyset cursor.
+    """
+    match = build_match_query(q)
+    if match is None:
+        return [], None
+
+    params = {"match": match, "user_id": user_id, "limit": limit + 1}
+    after = ""
+    if cursor:
+        params["score"], params["after_id"] = decode_cursor(cursor)
+        after = "WHERE score > :score OR (score = :score AND id > :after_id)"
+
+    rows = (await db.execute(text(f"""
+        SELECT id, title, score, snippet FROM (
+            SELECT rowid AS id, title, bm25({FTS_TABLE}) AS score,
+                   snippet({FTS_TABLE}, -1, '{_MARK_OPEN}', '{_MARK_CLOSE}', '…', 12) AS snippet
+            FROM {FTS_TABLE}
+            WHERE {FTS_TABLE} MATCH :match AND user_id = :user_id
+        )
+        {after}
+        ORDER BY score, id
+        LIMIT :limit
+    """), params)).all()
+
+    results = [
+        {"id": row.id, "title": row.title, "snippet": _render_snippet(row.snippet), "score": row.score}
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last.score, last.id)
+    return results, next_cursor
+
+
+if __name__ == "__main__":
+    # python search.py rebuild  -> re-index every note in ./notes.db, or in every shard (SQLITE_SHARDS)
+    from database import db_settings, engine
+    from migrations import init_database
+    from shards import ShardSet
+
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python search.py rebuild")
+
+    init_database(engine)
+    shards = ShardSet(db_settings.SHARDS, db_settings.SHARD_DIR)
+    shards.init()
+    for shard in shards.shards:
+        with shard.database.engine.begin() as conn:
+            conn.execute(text(CREATE_FTS_TABLE))
+            count = rebuild_index(conn)
+        print(f"Indexed {count} notes into {FTS_TABLE} of {shard.name}")
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import secrets
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import delete, event, select
+
+from cache import TTLCache
+from models import LoginSession, User, utcnow
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "notes_session"
+PURGE_BATCH_SIZE = 500
+
+
+@dataclass(frozen=True)
+class Identity:
+    """The logged-in user as seen by request handlers; no ORM state attached."""
+    id: int
+    username: str
+    email: str
+
+
+def _token_id(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionStore:
+    """Login sessions kept in the `sessions` table, behind a signed cookie.
+
+    Any worker can resolve any session because the table is shared. A small
+    TTL/LRU cache of session -> Identity in front means a busy client usually
+    costs no query at all; the price is that a session revoked (or a user
+    changed) on another worker stays visible here for at most `cache_ttl`
+    seconds.
+    """
+
+    def __init__(self, secret_key: str, max_age: int, cache_size: int = 10_000, cache_ttl: float = 30.0,
+                 secure_cookie: bool = False):
+        self._key = secret_key.encode()
+        self.max_age = max_age
+        self.secure_cookie = secure_cookie
+        self._cache = TTLCache(cache_size, cache_ttl)
+
+    # cookie value is "<token>.<hmac>", so forged cookies are rejected before any lookup
+    def _sign(self, token: str) -> str:
+        return hmac.new(self._key, token.encode(), hashlib.sha256).hexdigest()
+
+    def _unsign(self, value: str) -> Optional[str]:
+        token, _, signature = value.rpartition(".")
+        if not token or not hmac.compare_digest(signature, self._sign(token)):
+            return None
+        return token
+
+    async def create(self, db, user) -> str:
+        """Start a session for `user` and return the cookie value."""
+        token = secrets.token_urlsafe(32)
+        now = utcnow()
+        expires_at = now + timedelta(seconds=self.max_age)
+        db.add(LoginSession(id=_token_id(token), user_id=user.id, created_at=now, expires_at=expires_at))
+        await db.commit()
+        self._cache.set(_token_id(token), (Identity(user.id, user.username, user.email), expires_at))
+        return f"{token}.{self._sign(token)}"
+
+    async def resolve(self, db, cookie: Optional[str]) -> Optional[Identity]:
+        """Return who a cookie belongs to, or None if it isn't a live session."""
+        token = self._unsign(cookie) if cookie else None
+        if token is None:
+            return None
+
+        session_id = _token_id(token)
+        entry = self._cache.get(session_id)
+        if entry is None:
+            row = (await db.execute(
+                select(User.id, User.username, User.email, LoginSession.expires_at)
+                .join(LoginSession, LoginSession.user_id == User.id)
+                .where(LoginSession.id == session_id))).first()
+            if row is None:
+                return None
+            entry = (Identity(row.id, row.username, row.email), row.expires_at)
+            self._cache.set(session_id, entry)
+
+        identity, expires_at = entry
+        if expires_at <= utcnow():
+            self._cache.pop(session_id)
+            return None
+        return identity
+
+    async def revoke(self, db, cookie: Optional[str]):
+        token = self._unsign(cookie) if cookie else None
+        if token is None:
+            return
+        session_id = _token_id(token)
+        await db.execute(delete(LoginSession).where(LoginSession.id == session_id))
+        await db.commit()
+        # after the commit: a request resolving the cookie meanwhile could have cached the row again
+        self._cache.pop(session_id)
+
+    async def revoke_user(self, db, user_id: int):
+        """End every session of a user (e.g. after a password reset). Caller commits.
+
+        The cache is cleared now and again once `db` commits: until then the
+        sessions are still live to other requests, which may cache them again.
+        """
+        self.invalidate_user(user_id)
+        await db.execute(delete(LoginSession).where(LoginSession.user_id == user_id))
+        event.listen(db.sync_session, "after_commit", lambda session: self.invalidate_user(user_id), once=True)
+
+    def invalidate_user(self, user_id: int):
+        """Forget cached identities of `user_id`; call whenever their user row changes."""
+        self._cache.discard_if(lambda entry: entry[0].id == user_id)
+
+    def set_cookie(self, response, cookie: str):
+        response.set_cookie(SESSION_COOKIE, cookie, max_age=self.max_age, httponly=True, samesite="lax",
+                            secure=self.secure_cookie)
+
+    def delete_cookie(self, response):
+        response.delete_cookie(SESSION_COOKIE, httponly=True, samesite="lax", secure=self.secure_cookie)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+
+async def purge_expired(session_factory, batch_size: int = PURGE_BATCH_SIZE) -> int:
+    """Delete expired sessions, one batch per transaction. Returns how many were deleted."""
+    purged = 0
+    while True:
+        async with session_factory() as db:
+            expired = (select(LoginSession.id)
+                       .where(LoginSession.expires_at <= utcnow())
+                       .limit(batch_size)
+                       .scalar_subquery())
+            result = await db.execute(delete(LoginSession).where(LoginSession.id.in_(expired)))
+            await db.commit()
+        purged += result.rowcount
+        if result.rowcount < batch_size:
+            return purged
+
+
+async def run_purger(session_factory, interval: float):
+    """Background task: drop expired sessions every `interval` seconds."""
+    while True:
+        try:
+            purged = await purge_expired(session_factory)
+            if purged:
+                logger.info("Purged %d expired sessions", purged)
+        except Exception:
+            logger.exception("Session purge failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,351 @@
+"""Per-user sharding of note storage across several SQLite files.
+
+SQLite has one writer per file, so with every note in notes.db all workers
+together commit one write at a time. With SQLITE_SHARDS=N each user's notes,
+with their revisions, search index, version and attachment references,
+live in one of N files, shards/<n>/notes.db, and writes to different shards
+go ahead side by side. Users, login sessions, the outbox and rate limits
+stay in notes.db, the directory.
+
+A user's shard is jump_hash(user id, N), so routing a request needs no
+lookup, and going from N to N + 1 shards moves only about 1/(N + 1) of the
+users. Note ids are unique across shards (see NoteIds), so notes keep their
+ids, and their URLs, when they move. Each shard has its own attachment
+store, shards/<n>/uploads, because blob reference counts are kept per file.
+
+notes.db records the number of shards the notes were last laid out for,
+and the app refuses to start with a different SQLITE_SHARDS. To change it,
+stop the app and run
+
+    python shards.py rebalance N  -> move every user's notes to their shard of N (0: back into notes.db)
+
+then start it with SQLITE_SHARDS=N. An interrupted rebalance can be run again.
+"""
+import logging
+import os
+import shutil
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List
+
+from sqlalchemy import delete, func, insert, select, text, update
+
+from blobs import BLOB_ROOT, acquire_statement, blob_path, release_statement
+from database import DATABASE_PATH, Base, Database, db_settings, directory, open_database
+from migrations import LATEST_VERSION, init_database, migrate, schema_version
+from models import Blob, Note, NoteRevision, NotesVersion, ShardLayout
+from search import FTS_TABLE, ensure_index, index_rows
+
+logger = logging.getLogger(__name__)
+
+# what a shard file holds; everything else is only in notes.db
+SHARD_TABLES = [Note.__table__, NoteRevision.__table__, NotesVersion.__table__, Blob.__table__]
+
+# note ids a worker reserves from notes.db at a time
+NOTE_ID_BLOCK = 1000
+# rows copied per statement by rebalance()
+MOVE_BATCH_SIZE = 1000
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach): the bucket in range(buckets) of `key`.
+
+    When `buckets` grows by one, the only keys that change bucket are the
+    ones that move to the new bucket.
+    """
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+@dataclass
+class Shard:
+    """Where some users' notes are kept: a database file and an attachment store."""
+    name: str  # its directory, or notes.db
+    database: Database
+    blob_root: str
+
+    @property
+    def sessions(self):
+        return self.database.sessions
+
+    @property
+    def read_sessions(self):
+        return self.database.read_sessions
+
+
+def shard_path(shard_dir: str, index: int) -> str:
+    return os.path.join(shard_dir, str(index))
+
+
+def open_shard(path: str, **session_info) -> Shard:
+    return Shard(path, open_database(os.path.join(path, "notes.db"), **session_info), os.path.join(path, "uploads"))
+
+
+class NoteIds:
+    """Note ids that are unique across every shard, so notes keep theirs when they move.
+
+    Each worker reserves `block` ids at a time from shard_layout in
+    notes.db, i.e. one small write to notes.db per `block` notes created.
+    """
+
+    def __init__(self, session_factory, block: int = NOTE_ID_BLOCK):
+        self.session_factory = session_factory
+        self.block = block
+        self._next = self._end = 0
+
+    async def take(self, count: int) -> List[int]:
+        if self._end - self._next < count:
+            size = max(self.block, count)
+            start = await self._reserve(size)
+            # if another caller reserved a block meanwhile, the rest of whichever was set first goes unused
+            self._next, self._end = start, start + size
+        ids = list(range(self._next, self._next + count))
+        self._next += count
+        return ids
+
+    async def _reserve(self, size: int) -> int:
+        async with self.session_factory() as db:
+            end = await db.scalar(update(ShardLayout).where(ShardLayout.id == 1)
+                                  .values(next_note_id=ShardLayout.next_note_id + size)
+                                  .returning(ShardLayout.next_note_id))
+            await db.commit()
+        if end is None:
+            raise RuntimeError("notes.db has no shard layout; the app creates it when it starts")
+        return end - size
+
+
+async def new_note_ids(db, count: int) -> list:
+    """Ids for `count` notes about to be created in `db`, or Nones (SQLite picks) when notes aren't sharded."""
+    note_ids = db.info.get("note_ids")
+    if note_ids is None:
+        return [None] * count
+    return await note_ids.take(count)
+
+
+class ShardSet:
+    """The shards of this deployment, and which one keeps a given user's notes.
+
+    With `count` 0 there is one, notes.db itself, as before there were shards.
+    Nothing is opened until first use.
+    """
+
+    def __init__(self, count: int, shard_dir: str, directory: Database = directory):
+        self.count = count
+        self.directory = Shard(DATABASE_PATH, directory, BLOB_ROOT)
+        if count:
+            note_ids = NoteIds(directory.sessions)
+            self.shards = [open_shard(shard_path(shard_dir, index), note_ids=note_ids) for index in range(count)]
+        else:
+            self.shards = [self.directory]
+
+    def for_user(self, user_id: int) -> Shard:
+        return self.shards[jump_hash(user_id, self.count)] if self.count else self.directory
+
+    def all(self) -> List[Shard]:
+        """Every database with notes in it, notes.db included (notes moved out of it leave attachments to sweep)."""
+        return [self.directory, *self.shards] if self.count else self.shards
+
+    def init(self):
+        """Create missing shard files and check the layout in notes.db. Runs after init_database()."""
+        if self.count:
+            for shard in self.shards:
+                init_shard(shard)
+        check_layout(self.directory.database.engine, self.count)
+
+    async def dispose(self):
+        for shard in self.shards:
+            if shard is not self.directory:
+                await shard.database.dispose()
+
+
+def init_shard(shard: Shard) -> int:
+    """Create a shard's file and tables at the latest schema version, or migrate an existing one."""
+    os.makedirs(shard.name, exist_ok=True)
+    engine = shard.database.engine
+    with engine.connect() as conn:
+        new = schema_version(conn) == 0
+    Base.metadata.create_all(bind=engine, tables=SHARD_TABLES)
+    if new:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version = {LATEST_VERSION}")
+    ensure_index(engine)
+    return migrate(engine)
+
+
+def _layout(conn):
+    # created on first use: the notes so far, if any, are in notes.db
+    max_id = conn.scalar(select(func.max(Note.id)))
+    conn.execute(insert(ShardLayout).prefix_with("OR IGNORE")
+                 .values(id=1, shards=0, next_note_id=(max_id or 0) + 1))
+    return conn.execute(select(ShardLayout.__table__).where(ShardLayout.id == 1)).one()
+
+
+def check_layout(engine, count: int):
+    """Refuse to run with SQLITE_SHARDS=`count` unless that is where the notes are."""
+    with engine.begin() as conn:
+        layout = _layout(conn)
+        if (count and layout.shards == 0 and layout.rebalancing_to is None
+                and conn.scalar(select(Note.id).limit(1)) is None):
+            # no notes yet, so none to move: a new deployment starts out sharded
+            conn.execute(update(ShardLayout).where(ShardLayout.id == 1).values(shards=count))
+            return
+    if layout.rebalancing_to is not None:
+        raise RuntimeError(f"A rebalance to {layout.rebalancing_to} shards didn't finish; "
+                           f"run `python shards.py rebalance {layout.rebalancing_to}` again")
+    if layout.shards != count:
+        raise RuntimeError(f"The notes are laid out for {layout.shards} shards, not SQLITE_SHARDS={count}; "
+                           f"stop every worker and run `python shards.py rebalance {count}`")
+
+
+# ---- rebalancing ----
+
+def _existing_shards(shard_dir: str) -> List[int]:
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(shard_dir)
+                  if name.isdigit() and os.path.exists(os.path.join(shard_dir, name, "notes.db")))
+
+
+def _users(shard: Shard) -> List[int]:
+    with shard.database.engine.connect() as conn:
+        return conn.scalars(select(Note.user_id).where(Note.user_id.is_not(None))
+                            .union(select(NotesVersion.user_id))).all()
+
+
+def _delete_user(conn, user_id: int):
+    """Delete a user's notes from a shard and release the blobs they referenced."""
+    notes = Note.__table__
+    note_ids = select(notes.c.id).where(notes.c.user_id == user_id)
+    references = conn.execute(select(notes.c.sha256, func.count())
+                              .where(notes.c.user_id == user_id, notes.c.sha256.is_not(None))
+                              .group_by(notes.c.sha256)).all()
+    for sha256, count in references:
+        conn.execute(release_statement(sha256, count))
+    conn.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM notes WHERE user_id = :user_id)"),
+                 {"user_id": user_id})
+    conn.execute(delete(NoteRevision).where(NoteRevision.note_id.in_(note_ids)))
+    conn.execute(delete(Note).where(Note.user_id == user_id))
+    conn.execute(delete(NotesVersion).where(NotesVersion.user_id == user_id))
+
+
+def _copy_blob(sha256: str, source_root: str, target_root: str):
+    target = blob_path(sha256, target_root)
+    if os.path.exists(target):
+        return
+    source = blob_path(sha256, source_root)
+    if not os.path.exists(source):
+        logger.warning("Attachment %s is missing from %s", sha256, source_root)
+        return
+    tmp_dir = os.path.join(target_root, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f".rebalance-{sha256}")
+    try:
+        os.link(source, tmp_path)  # same file system: no copy
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def move_user(user_id: int, source: Shard, target: Shard):
+    """Copy a user's notes from `source` to `target` in one transaction, then delete them from `source`.
+
+    If this stops between the two, running it again replaces the copy.
+    """
+    notes, revisions = Note.__table__, NoteRevision.__table__
+    revision_columns = [column for column in revisions.c if column.name != "id"]
+    with target.database.engine.begin() as out, source.database.engine.connect() as conn:
+        _delete_user(out, user_id)
+
+        references, sizes = Counter(), {}
+        result = conn.execution_options(yield_per=MOVE_BATCH_SIZE).execute(
+            select(notes).where(notes.c.user_id == user_id).order_by(notes.c.id))
+        for rows in result.partitions():
+            rows = [dict(row._mapping) for row in rows]
+            for row in rows:
+                if row["filename"] and not row["sha256"]:
+                    raise RuntimeError(f"User {user_id} has attachments from before the blob store; "
+                                       "run `python blobs.py import-legacy` first")
+                if row["sha256"]:
+                    references[row["sha256"]] += 1
+                    sizes[row["sha256"]] = row["size"]
+            out.execute(insert(notes), rows)
+            index_rows(out, [{key: row[key] for key in ("id", "title", "content", "user_id")} for row in rows])
+
+        result = conn.execution_options(yield_per=MOVE_BATCH_SIZE).execute(
+            select(*revision_columns).where(revisions.c.note_id.in_(
+                select(notes.c.id).where(notes.c.user_id == user_id))))
+        for rows in result.partitions():
+            out.execute(insert(revisions), [dict(row._mapping) for row in rows])
+
+        # bumped, so no ETag from before the move matches
+        version = conn.scalar(select(NotesVersion.version).where(NotesVersion.user_id == user_id)) or 0
+        out.execute(insert(NotesVersion).values(user_id=user_id, version=version + 1))
+
+        for sha256, count in references.items():
+            out.execute(acquire_statement(sha256, sizes[sha256], count))
+            _copy_blob(sha256, source.blob_root, target.blob_root)
+
+    with source.database.engine.begin() as conn:
+        _delete_user(conn, user_id)
+
+
+def rebalance(count: int, shard_dir: str = db_settings.SHARD_DIR, directory: Database = directory) -> int:
+    """Move every user's notes to where a layout of `count` shards keeps them. Returns the users moved.
+
+    Looks in notes.db and every shard there is, so it also finishes a
+    rebalance that was interrupted, whatever it was rebalancing to. Run it
+    with the app stopped: a user's notes are briefly in two places.
+    """
+    init_database(directory.engine)
+    with directory.engine.begin() as conn:
+        _layout(conn)
+        conn.execute(update(ShardLayout).where(ShardLayout.id == 1).values(rebalancing_to=count))
+
+    home = Shard(DATABASE_PATH, directory, BLOB_ROOT)
+    shards: Dict[int, Shard] = {index: open_shard(shard_path(shard_dir, index))
+                                for index in set(_existing_shards(shard_dir)) | set(range(count))}
+    for shard in shards.values():
+        init_shard(shard)
+
+    # notes keep their ids: ids handed out from now on must be above every one there is
+    highest = 0
+    for shard in [home, *shards.values()]:
+        with shard.database.engine.connect() as conn:
+            highest = max(highest, conn.scalar(select(func.max(Note.id))) or 0)
+    with directory.engine.begin() as conn:
+        conn.execute(update(ShardLayout).where(ShardLayout.id == 1)
+                     .values(next_note_id=func.max(ShardLayout.next_note_id, highest + 1)))
+
+    moved = 0
+    for source in [home, *shards.values()]:
+        for user_id in _users(source):
+            target = shards[jump_hash(user_id, count)] if count else home
+            if target is not source:
+                move_user(user_id, source, target)
+                moved += 1
+        logger.info("%s: done", source.name)
+
+    with directory.engine.begin() as conn:
+        conn.execute(update(ShardLayout).where(ShardLayout.id == 1).values(shards=count, rebalancing_to=None))
+    for index, shard in shards.items():
+        shard.database.engine.dispose()
+        if index >= count:
+            logger.info("%s no longer holds any notes and can be deleted", shard.name)
+    return moved
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "rebalance" or not sys.argv[2].isdigit():
+        sys.exit("usage: python shards.py rebalance N")
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    shards = int(sys.argv[2])
+    users = rebalance(shards)
+    print(f"Moved the notes of {users} users; start the app with SQLITE_SHARDS={shards}")
@@ -1,3 +1,4 @@
+import json
 import os
 import sys
 
@@ -9,24 +10,23 @@ import sys
 # Add parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from fastapi_mail import FastMail
 import pytest
 from fastapi.testclient import TestClient
 from starlette.responses import HTMLResponse, JSONResponse
-from main import app, Base, engine, get_db, session_data
-from sqlalchemy.orm import sessionmaker
+from main import app, Base, engine, get_db, note_reads, rate_limiter, session_store
+from models import User
+from database import WriteSession, async_engine, read_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+TestingSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine,
+                                         class_=WriteSession)
 
 
 # Override DB
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 app.dependency_overrides[get_db] = override_get_db
@@ -37,7 +37,10 @@ client = TestClient(app)
 def setup_and_teardown():
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
-    session_data.clear()
+    session_store.clear_cache()
+    rate_limiter.clear()
+    note_reads.clear()
+    client.cookies.clear()
     yield
     Base.metadata.drop_all(bind=engine)
 
@@ -235,10 +238,8 @@ def test_create_and_get_notes():
 
 
 def test_forgot_and_reset_password(monkeypatch):
-    # ✅ Mock email sending
-    async def fake_send_message(*args, **kwargs):
-        return True
-    monkeypatch.setattr(FastMail, "send_message", fake_send_message)
+    from database import SessionLocal
+    from models import OutboxMessage
 
     # ✅ Mock TemplateResponse to return JSON instead of HTML
     monkeypatch.setattr("main.templates.TemplateResponse",
@@ -255,4 +256,1179 @@ def test_forgot_and_reset_password(monkeypatch):
     # Forgot password request
     response = client.post("/forgot-password", data={"email": "reset@example.com"})
     assert response.status_code == 200
-    assert response.json()["message"] == "Reset link sent"
\ No newline at end of file
+    assert response.json()["message"] == "Reset link sent"
+
+    # the email is queued for the mail worker rather than sent inline
+    with SessionLocal() as db:
+        message = db.query(OutboxMessage).one()
+        assert message.recipient == "reset@example.com"
+        assert message.status == "pending"
+
+def test_get_notes_keyset_pagination():
+    client.post("/api/register", json={"username": "kate", "email": "kate@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "kate@example.com", "password": "secret123"})
+    for i in range(5):
+        client.post("/api/notes", json={"title": f"Note {i}", "content": "c"})
+
+    res = client.get("/api/notes", params={"limit": 2})
+    assert res.status_code == 200
+    assert [n["title"] for n in res.json()] == ["Note 0", "Note 1"]
+
+    titles = [n["title"] for n in res.json()]
+    while "X-Next-Cursor" in res.headers:
+        res = client.get("/api/notes", params={"limit": 2, "cursor": res.headers["X-Next-Cursor"]})
+        titles += [n["title"] for n in res.json()]
+    assert titles == [f"Note {i}" for i in range(5)]
+
+
+def test_get_notes_ndjson_stream():
+    client.post("/api/register", json={"username": "liam", "email": "liam@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "liam@example.com", "password": "secret123"})
+    client.post("/api/notes", json={"title": "First", "content": "1"})
+    client.post("/api/notes", json={"title": "Second", "content": "2"})
+
+    res = client.get("/api/notes", headers={"Accept": "application/x-ndjson"})
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert [n["title"] for n in lines] == ["First", "Second"]
+
+
+def test_search_notes():
+    client.post("/api/register", json={"username": "mia", "email": "mia@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "mia@example.com", "password": "secret123"})
+    client.post("/api/notes", json={"title": "Groceries", "content": "apples and pears"})
+    res = client.post("/api/notes", json={"title": "Reading list", "content": "a book about apples"})
+    note_id = res.json()["id"]
+    client.post("/api/notes", json={"title": "Work", "content": "quarterly report"})
+
+    res = client.get("/api/notes/search", params={"q": "apples"})
+    assert res.status_code == 200
+    results = res.json()
+    assert len(results) == 2
+    assert all("<mark>apples</mark>" in r["snippet"] for r in results)
+
+    # index follows updates and deletes
+    client.put(f"/api/notes/{note_id}", json={"title": "Reading list", "content": "a book about pears"})
+    assert [r["id"] for r in client.get("/api/notes/search", params={"q": "pears"}).json()] != []
+    assert len(client.get("/api/notes/search", params={"q": "apples"}).json()) == 1
+    client.delete(f"/api/notes/{note_id}")
+    assert len(client.get("/api/notes/search", params={"q": "pears"}).json()) == 1
+
+
+def test_search_notes_pagination_and_syntax():
+    client.post("/api/register", json={"username": "noah", "email": "noah@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "noah@example.com", "password": "secret123"})
+    for i in range(5):
+        client.post("/api/notes", json={"title": f"Meeting {i}", "content": "agenda " * (i + 1)})
+
+    res = client.get("/api/notes/search", params={"q": "agenda", "limit": 2})
+    ids = [r["id"] for r in res.json()]
+    while "X-Next-Cursor" in res.headers:
+        res = client.get("/api/notes/search", params={"q": "agenda", "limit": 2, "cursor": res.headers["X-Next-Cursor"]})
+        ids += [r["id"] for r in res.json()]
+    assert len(ids) == len(set(ids)) == 5
+
+    # FTS5 operators in user input are searched literally, not parsed
+    res = client.get("/api/notes/search", params={"q": 'agenda" OR NEAR('})
+    assert res.status_code == 200
+    assert res.json() == []
+    assert client.get("/api/notes/search", params={"q": "agenda", "cursor": "bogus"}).status_code == 400
+
+
+def test_sessions_are_per_client():
+    for name in ("olga", "pete"):
+        client.post("/api/register", json={"username": name, "email": f"{name}@example.com", "password": "secret123"})
+
+    olga, pete = TestClient(app), TestClient(app)
+    olga.post("/api/login", json={"email": "olga@example.com", "password": "secret123"})
+    pete.post("/api/login", json={"email": "pete@example.com", "password": "secret123"})
+    olga.post("/api/notes", json={"title": "Olga's note", "content": "o"})
+
+    assert [n["title"] for n in olga.get("/api/notes").json()] == ["Olga's note"]
+    assert pete.get("/api/notes").json() == []
+    assert client.get("/api/notes").status_code == 401
+
+    # a session survives a cold cache (e.g. a request landing on another worker)
+    session_store.clear_cache()
+    rate_limiter.clear()
+    note_reads.clear()
+    assert olga.get("/api/notes").status_code == 200
+
+    olga.post("/api/logout")
+    assert olga.get("/api/notes").status_code == 401
+    assert pete.get("/api/notes").status_code == 200
+
+
+def test_expired_sessions_are_purged():
+    import asyncio
+    from datetime import timedelta
+    from database import AsyncSessionLocal, SessionLocal
+    from models import LoginSession, utcnow
+    from sessions import purge_expired
+
+    client.post("/api/register", json={"username": "quin", "email": "quin@example.com", "password": "secret123"})
+    for _ in range(3):
+        client.post("/api/login", json={"email": "quin@example.com", "password": "secret123"})
+    with SessionLocal() as db:
+        for login in db.query(LoginSession).limit(2):
+            login.expires_at = utcnow() - timedelta(seconds=1)
+        db.commit()
+
+    async def purge():
+        purged = await purge_expired(AsyncSessionLocal, batch_size=1)
+        await async_engine.dispose()
+        return purged
+
+    assert asyncio.run(purge()) == 2
+    with SessionLocal() as db:
+        assert db.query(LoginSession).count() == 1
+
+
+def test_revoked_sessions_are_not_cached_again_before_commit():
+    import asyncio
+    from database import AsyncSessionLocal, ReadSessionLocal
+    from sessions import SESSION_COOKIE
+
+    user_id = client.post("/api/register", json={"username": "rex", "email": "rex@example.com",
+                                                 "password": "secret123"}).json()["id"]
+    client.post("/api/login", json={"email": "rex@example.com", "password": "secret123"})
+    cookie = client.cookies.get(SESSION_COOKIE)
+
+    async def revoke_racing_a_request():
+        async with AsyncSessionLocal() as db:
+            await session_store.revoke_user(db, user_id)
+            # another request resolves the cookie before the revocation commits, and caches it
+            async with ReadSessionLocal() as other:
+                assert await session_store.resolve(other, cookie) is not None
+            await db.commit()
+        async with ReadSessionLocal() as other:
+            identity = await session_store.resolve(other, cookie)
+        await async_engine.dispose()
+        await read_engine.dispose()
+        return identity
+
+    assert asyncio.run(revoke_racing_a_request()) is None
+
+
+def test_forged_session_cookie_rejected():
+    client.post("/api/register", json={"username": "quinn", "email": "quinn@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "quinn@example.com", "password": "secret123"})
+    token, _, _ = client.cookies["notes_session"].rpartition(".")
+
+    client.cookies.set("notes_session", f"{token}.{'0' * 64}")
+    assert client.get("/api/notes").status_code == 401
+
+
+def test_notes_are_scoped_to_their_owner():
+    client.post("/api/register", json={"username": "rita", "email": "rita@example.com", "password": "secret123"})
+    client.post("/api/register", json={"username": "sam", "email": "sam@example.com", "password": "secret123"})
+    rita, sam = TestClient(app), TestClient(app)
+    rita.post("/api/login", json={"email": "rita@example.com", "password": "secret123"})
+    sam.post("/api/login", json={"email": "sam@example.com", "password": "secret123"})
+    note_id = rita.post("/api/notes", json={"title": "Private", "content": "p"}).json()["id"]
+
+    assert sam.get(f"/api/notes/{note_id}").status_code == 404
+    assert sam.put(f"/api/notes/{note_id}", json={"title": "x", "content": "x"}).status_code == 404
+    assert sam.delete(f"/api/notes/{note_id}").status_code == 404
+    assert rita.get(f"/api/notes/{note_id}").json()["title"] == "Private"
+
+
+def test_identity_cache_skips_user_lookup():
+    from sqlalchemy import event
+
+    client.post("/api/register", json={"username": "tom", "email": "tom@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "tom@example.com", "password": "secret123"})
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(read_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        assert client.get("/api/notes").status_code == 200
+    finally:
+        event.remove(read_engine.sync_engine, "before_cursor_execute", record)
+
+    # the ETag's version lookup and the page itself; nothing for the session
+    assert len(statements) == 2
+    assert "notes_version" in statements[0]
+    assert "FROM notes" in statements[1]
+
+
+def test_concurrent_writers_are_queued_and_readers_are_read_only():
+    import asyncio
+    from sqlalchemy import func, insert, select
+    from sqlalchemy.exc import OperationalError
+    from database import AsyncSessionLocal, ReadSessionLocal
+    from models import Note
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+
+    async def write(i):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(Note).values(title=f"note {i}", user_id=1))
+            await asyncio.sleep(0)  # hold the write open while others queue up
+            await db.commit()
+
+    async def read():
+        async with ReadSessionLocal() as db:
+            return await db.scalar(select(func.count(Note.id)))
+
+    async def run():
+        await asyncio.gather(*(write(i) for i in range(20)), *(read() for _ in range(20)))
+        async with ReadSessionLocal() as db:
+            with pytest.raises(OperationalError, match="readonly"):
+                await db.execute(insert(Note).values(title="nope", user_id=1))
+        count = await read()
+        # pooled aiosqlite threads would otherwise keep the interpreter alive
+        await read_engine.dispose()
+        await async_engine.dispose()
+        return count
+
+    assert asyncio.run(run()) == 20
+
+
+def query_plan(statement):
+    from sqlalchemy.dialects import sqlite
+    sql = str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return " | ".join(row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+
+
+def test_note_queries_use_indexes():
+    from sqlalchemy import select
+    from models import Note
+    from pagination import notes_query
+
+    for statement in (notes_query(1, None, 100), notes_query(1, 500, 100), notes_query(1),
+                      select(Note).where(Note.user_id == 1).order_by(Note.updated_at.desc()).limit(20),
+                      select(Note).where(Note.id == 7, Note.user_id == 1)):
+        plan = query_plan(statement)
+        assert "SCAN notes" not in plan, plan
+        assert "TEMP B-TREE" not in plan, plan
+
+
+def test_migrations_upgrade_an_old_database(tmp_path):
+    from sqlalchemy import create_engine, inspect
+    from migrations import LATEST_VERSION, MIGRATIONS, migrate
+
+    old = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with old.begin() as conn:
+        # the schema notes.db had before any migrations
+        conn.exec_driver_sql("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR, email VARCHAR, "
+                             "password VARCHAR, reset_token VARCHAR)")
+        conn.exec_driver_sql("CREATE TABLE notes (id INTEGER PRIMARY KEY, title VARCHAR NOT NULL, "
+                             "content VARCHAR, filename VARCHAR, user_id INTEGER REFERENCES users (id))")
+        conn.exec_driver_sql("INSERT INTO notes (title, user_id) VALUES ('old note', 1)")
+        conn.exec_driver_sql("INSERT INTO notes (title, content, user_id) VALUES ('long note', ?, 1)",
+                             ("word " * 2000,))
+    Base.metadata.create_all(bind=old)
+
+    assert migrate(old) == LATEST_VERSION
+    assert migrate(old) == LATEST_VERSION  # nothing left to do the second time
+    columns = {c["name"] for c in inspect(old).get_columns("notes")}
+    assert {"sha256", "size", "created_at", "updated_at", "excerpt"} <= columns
+    indexes = {i["name"] for i in inspect(old).get_indexes("notes")}
+    assert {"ix_notes_user_id_id", "ix_notes_user_id_created_at", "ix_notes_user_id_updated_at"} <= indexes
+    with old.connect() as conn:
+        created_at, updated_at = conn.exec_driver_sql("SELECT created_at, updated_at FROM notes").first()
+        assert created_at is not None and updated_at == created_at
+        excerpt, stored = conn.exec_driver_sql("SELECT excerpt, typeof(content) FROM notes WHERE id = 2").one()
+        assert excerpt.startswith("word word") and stored == "blob"
+    assert "notes_version" not in {c["name"] for c in inspect(old).get_columns("users")}
+    old.dispose()
+
+    # each step is a no-op on the schema create_all() builds
+    fresh = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    Base.metadata.create_all(bind=fresh)
+    def columns():
+        return {table: [c["name"] for c in inspect(fresh).get_columns(table)] for table in ("users", "notes")}
+    before = columns()
+    for _, step in MIGRATIONS:
+        with fresh.begin() as conn:
+            step(conn)
+        assert columns() == before, step.__name__
+    fresh.dispose()
+
+
+def test_note_reads_revalidate_with_etags():
+    client.post("/api/register", json={"username": "iris", "email": "iris@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "iris@example.com", "password": "secret123"})
+    note_id = client.post("/api/notes", json={"title": "Poll me", "content": "v1"}).json()["id"]
+
+    res = client.get("/api/notes")
+    etag = res.headers["etag"]
+    assert res.headers["cache-control"] == "private, no-cache"
+    assert client.get("/api/notes", headers={"If-None-Match": etag}).status_code == 304
+    # another page is another representation
+    assert client.get("/api/notes", params={"limit": 1}, headers={"If-None-Match": etag}).status_code == 200
+
+    detail_etag = client.get(f"/api/notes/{note_id}").headers["etag"]
+    res = client.get(f"/api/notes/{note_id}", headers={"If-None-Match": detail_etag})
+    assert res.status_code == 304 and res.content == b""
+
+    # every write path moves the version on
+    client.put(f"/api/notes/{note_id}", json={"title": "Poll me", "content": "v2"})
+    res = client.get("/api/notes", headers={"If-None-Match": etag})
+    assert res.status_code == 200 and res.json()[0]["content"] == "v2"
+    etag = res.headers["etag"]
+    client.post("/api/notes/batch", json={"ops": [{"op": "create", "title": "More"}]})
+    assert client.get("/api/notes", headers={"If-None-Match": etag}).status_code == 200
+    assert client.get(f"/api/notes/{note_id}", headers={"If-None-Match": detail_etag}).status_code == 200
+
+
+def test_identical_concurrent_reads_share_one_query():
+    import asyncio
+    import httpx
+    from metrics import SQL_STATEMENTS
+
+    client.post("/api/register", json={"username": "nina", "email": "nina@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "nina@example.com", "password": "secret123"})
+    note_id = client.post("/api/notes", json={"title": "Tabs", "content": "v1"}).json()["id"]
+    reads = SQL_STATEMENTS.labels("read")
+
+    async def burst(path, count=20):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", cookies=client.cookies) as tabs:
+            before = reads.value
+            responses = await asyncio.gather(*(tabs.get(path) for _ in range(count)))
+            statements = reads.value - before
+        # pooled aiosqlite threads would otherwise keep the interpreter alive
+        await read_engine.dispose()
+        await async_engine.dispose()
+        return responses, statements
+
+    responses, statements = asyncio.run(burst("/api/notes"))
+    assert {res.content for res in responses} == {responses[0].content}
+    assert responses[0].json() == [{"id": note_id, "title": "Tabs", "content": "v1", "filename": None}]
+    assert len({res.headers["etag"] for res in responses}) == 1
+    # the session lookup, one version lookup and one page, instead of 20 of each
+    assert statements <= 3
+    responses, statements = asyncio.run(burst(f"/api/notes/{note_id}"))
+    assert {res.json()["content"] for res in responses} == {"v1"} and statements <= 3
+
+    # a write invalidates what was shared or cached
+    client.put(f"/api/notes/{note_id}", json={"title": "Tabs", "content": "v2"})
+    assert client.get("/api/notes").json()[0]["content"] == "v2"
+    assert client.get(f"/api/notes/{note_id}").json()["content"] == "v2"
+    client.delete(f"/api/notes/{note_id}")
+    assert client.get(f"/api/notes/{note_id}").status_code == 404
+
+    from coalesce import SingleFlight
+    flight, fetched = SingleFlight(), []
+
+    async def invalidated_mid_fetch():
+        gate = asyncio.Event()
+
+        async def fetch():
+            number = len(fetched)
+            fetched.append(number)
+            await gate.wait()
+            return number
+
+        first, second = (asyncio.create_task(flight.run((7, "page"), fetch)) for _ in range(2))
+        await asyncio.sleep(0)
+        flight.invalidate(7)  # a write landed while the page was being read
+        third = asyncio.create_task(flight.run((7, "page"), fetch))
+        await asyncio.sleep(0)
+        gate.set()
+        return await first, await second, await third, await flight.run((7, "page"), fetch)
+
+    assert asyncio.run(invalidated_mid_fetch()) == (0, 0, 1, 1)
+
+
+def test_mynotes_streams_cached_note_cards():
+    import main
+
+    main.fragments.clear()
+    client.post("/api/register", json={"username": "jon", "email": "jon@example.com", "password": "secret123"})
+    client.post("/login", data={"email": "jon@example.com", "password": "secret123"}, follow_redirects=False)
+    assert "No notes uploaded yet" in client.get("/mynotes").text
+
+    first = client.post("/api/notes", json={"title": "First <b>", "content": "one"}).json()["id"]
+    client.post("/api/notes", json={"title": "Second", "content": "two"})
+    page = client.get("/mynotes").text
+    assert "First &lt;b&gt;" in page and "Second" in page
+    assert len(main.fragments) == 2
+
+    # an unchanged card is reused; an edited one is rendered again under a new key
+    client.put(f"/api/notes/{first}", json={"title": "First, edited", "content": "one"})
+    page = client.get("/mynotes").text
+    assert "First, edited" in page and "First &lt;b&gt;" not in page
+    assert len(main.fragments) == 3
+    assert os.listdir(main.settings.TEMPLATE_BYTECODE_DIR)
+
+
+def metric_value(text, series):
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_endpoint_counts_requests_and_sql():
+    client.post("/api/register", json={"username": "kim", "email": "kim@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "kim@example.com", "password": "secret123"})
+    note_id = client.post("/api/notes", json={"title": "Measured", "content": "x"}).json()["id"]
+
+    ok = 'http_requests_total{method="GET",route="/api/notes/{note_id}",status="200"}'
+    missing = 'http_requests_total{method="GET",route="/api/notes/{note_id}",status="404"}'
+    reads = 'db_statements_total{engine="read"}'
+    before = client.get("/metrics").text
+    client.get(f"/api/notes/{note_id}")
+    client.get("/api/notes/999999")
+    client.get("/no/such/page")
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain; version=0.0.4")
+
+    after = res.text
+    assert metric_value(after, ok) == metric_value(before, ok) + 1
+    assert metric_value(after, missing) == metric_value(before, missing) + 1
+    # routes are labelled by template, never by the raw path
+    assert 'route="unmatched",status="404"' in after and "/api/notes/999999" not in after
+    assert metric_value(after, reads) > metric_value(before, reads)
+    assert metric_value(after, 'http_request_sql_statements_count{route="/api/notes/{note_id}"}') >= 2
+    assert metric_value(after, 'db_pool_checkouts_total{engine="write"}') > 0
+    assert metric_value(after, "http_requests_in_flight") == 1  # this scrape
+
+
+def test_metrics_token(monkeypatch):
+    import main
+
+    monkeypatch.setattr(main.settings, "METRICS_TOKEN", "s3cret")
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer s3cret"}).status_code == 200
+
+
+def test_profiled_request_saves_pstats(tmp_path):
+    import pstats
+    from profiling import ProfilerMiddleware
+
+    profiled = TestClient(ProfilerMiddleware(app, directory=str(tmp_path), token="letmein"))
+    assert "x-profile" not in profiled.get("/ping").headers
+    assert "x-profile" not in profiled.get("/ping", headers={"X-Profile": "wrong"}).headers
+    assert not os.listdir(tmp_path)
+
+    res = profiled.get("/login", headers={"X-Profile": "letmein"})
+    assert res.status_code == 200
+    assert os.listdir(tmp_path) == [res.headers["x-profile"]]
+    stats = pstats.Stats(str(tmp_path / res.headers["x-profile"]))
+    assert any(func[2] == "login_page" for func in stats.stats)
+
+
+def test_slow_query_log_explains_and_names_the_route(caplog):
+    from profiling import RequestContextMiddleware, SlowQueryLog
+
+    traced = TestClient(RequestContextMiddleware(app))
+    traced.post("/api/register", json={"username": "lou", "email": "lou@example.com", "password": "secret123"})
+    traced.post("/api/login", json={"email": "lou@example.com", "password": "secret123"})
+    note_id = traced.post("/api/notes", json={"title": "Slow?", "content": "x"}).json()["id"]
+
+    slow_queries = SlowQueryLog(threshold_ms=0)  # everything counts as slow
+    slow_queries.instrument(read_engine.sync_engine)
+    try:
+        with caplog.at_level("WARNING", logger="profiling"):
+            assert traced.get(f"/api/notes/{note_id}").status_code == 200
+    finally:
+        slow_queries.remove(read_engine.sync_engine)
+
+    logged = [r.getMessage() for r in caplog.records if "FROM notes" in r.getMessage()]
+    assert logged
+    assert f"GET /api/notes/{{note_id}} (/api/notes/{note_id})" in logged[0]
+    assert "query plan:" in logged[0] and "SEARCH notes USING" in logged[0]
+    # bound values can be secrets: only their types are logged
+    assert "parameters: (int, int" in logged[0] and f"({note_id}, " not in logged[0]
+
+    caplog.clear()
+    traced.get(f"/api/notes/{note_id}")
+    assert not caplog.records
+
+
+def test_upload_note_with_file(monkeypatch, tmp_path):
+    import hashlib
+    monkeypatch.chdir(tmp_path)
+    client.post("/api/register", json={"username": "uma", "email": "uma@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "uma@example.com", "password": "secret123"})
+
+    data = os.urandom(300_000)
+    res = client.post("/notes", data={"title": "CV", "content": "pdf"}, files={"file": ("../cv.pdf", data)},
+                      follow_redirects=False)
+    assert res.status_code == 302
+
+    note = client.get("/api/notes").json()[0]
+    assert note["filename"] == "cv.pdf"
+    digest = hashlib.sha256(data).hexdigest()
+    assert (tmp_path / "uploads" / digest[:2] / digest[2:4] / digest).read_bytes() == data
+    assert os.listdir(tmp_path / "uploads" / "tmp") == []
+
+    from database import SessionLocal
+    from models import Note
+    with SessionLocal() as db:
+        stored = db.get(Note, note["id"])
+        assert stored.sha256 == hashlib.sha256(data).hexdigest()
+        assert stored.size == len(data)
+
+
+def test_upload_note_too_large(monkeypatch, tmp_path):
+    import main
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main.settings, "MAX_UPLOAD_BYTES", 1000)
+    client.post("/api/register", json={"username": "vic", "email": "vic@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "vic@example.com", "password": "secret123"})
+
+    res = client.post("/notes", data={"title": "Big"}, files={"file": ("big.bin", b"x" * 5000)})
+    assert res.status_code == 413
+    assert client.get("/api/notes").json() == []
+    assert os.listdir(tmp_path / "uploads" / "tmp") == []
+
+    # a malformed Content-Length is the client's error, not a 500
+    import asyncio
+    from uploads import UploadSizeLimitMiddleware
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": "/notes", "headers": [(b"content-length", b"lots")]}
+    asyncio.run(UploadSizeLimitMiddleware(app, max_bytes=1000)(scope, None, send))
+    assert sent[0]["status"] == 400
+
+
+def test_attachments_are_deduplicated_and_swept(monkeypatch, tmp_path):
+    import asyncio
+    import blobs
+    from database import AsyncSessionLocal, SessionLocal
+    from models import Blob
+
+    monkeypatch.chdir(tmp_path)
+    client.post("/api/register", json={"username": "wes", "email": "wes@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "wes@example.com", "password": "secret123"})
+
+    data = b"%PDF same resume"
+    for name in ("resume.pdf", "resume-copy.pdf"):
+        client.post("/notes", data={"title": name}, files={"file": (name, data)}, follow_redirects=False)
+    blob_files = [f for _, _, files in os.walk(tmp_path / "uploads") for f in files]
+    assert len(blob_files) == 1
+
+    def blob():
+        with SessionLocal() as db:
+            return db.get(Blob, blob_files[0])
+
+    assert blob().refcount == 2
+    first, second = [n["id"] for n in client.get("/api/notes").json()]
+    client.get(f"/deletenote/{first}", follow_redirects=False)
+    assert blob().refcount == 1
+    client.delete(f"/api/notes/{second}")
+    assert blob().refcount == 0
+
+    # still inside the grace period: kept
+    assert asyncio.run(blobs.sweep_orphans(AsyncSessionLocal)) == 0
+    monkeypatch.setattr(blobs, "ORPHAN_GRACE", blobs.timedelta(0))
+    assert asyncio.run(blobs.sweep_orphans(AsyncSessionLocal)) == 1
+    assert blob() is None
+    assert [f for _, _, files in os.walk(tmp_path / "uploads") for f in files] == []
+
+
+def test_sweep_racing_a_reupload_keeps_the_file(monkeypatch, tmp_path):
+    import asyncio
+    import io
+    import threading
+    import time
+    import blobs
+    from starlette.datastructures import UploadFile
+    from database import AsyncSessionLocal, SessionLocal
+    from models import Blob
+
+    monkeypatch.setattr(blobs, "ORPHAN_GRACE", blobs.timedelta(0))
+    root = str(tmp_path)
+
+    async def upload(data):
+        async with AsyncSessionLocal() as db:
+            stored = await blobs.store_upload(db, UploadFile(io.BytesIO(data), filename="a.txt"), 1000, root)
+            await db.commit()
+        return stored
+
+    unlinking = threading.Event()
+    unlink_blobs = blobs._unlink_blobs
+
+    def slow_unlink(sha256s, root):
+        unlinking.set()
+        time.sleep(0.2)  # the re-upload runs meanwhile
+        unlink_blobs(sha256s, root)
+
+    async def reupload():
+        await asyncio.to_thread(unlinking.wait)
+        return await upload(b"same bytes")
+
+    async def run():
+        stored = await upload(b"same bytes")
+        async with AsyncSessionLocal() as db:
+            await blobs.release(db, stored.sha256)
+            await db.commit()
+        monkeypatch.setattr(blobs, "_unlink_blobs", slow_unlink)
+        swept, _ = await asyncio.gather(blobs.sweep_orphans(AsyncSessionLocal, root), reupload())
+        monkeypatch.setattr(blobs, "_unlink_blobs", unlink_blobs)
+
+        # a note that fails to save takes its new blob file with it
+        async with AsyncSessionLocal() as db:
+            dropped = await blobs.store_upload(db, UploadFile(io.BytesIO(b"other"), filename="b.txt"), 1000, root)
+            await blobs.discard_upload(db, dropped, root)
+        await async_engine.dispose()
+        return stored, swept, dropped
+
+    stored, swept, dropped = asyncio.run(run())
+    assert swept == 1
+    assert os.path.exists(blobs.blob_path(stored.sha256, root))
+    assert not os.path.exists(blobs.blob_path(dropped.sha256, root))
+    with SessionLocal() as db:
+        assert db.get(Blob, stored.sha256).refcount == 1
+        assert db.get(Blob, dropped.sha256) is None
+
+
+def test_attachment_ranges_and_conditional_get(monkeypatch, tmp_path):
+    import hashlib
+    monkeypatch.chdir(tmp_path)
+    client.post("/api/register", json={"username": "xena", "email": "xena@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "xena@example.com", "password": "secret123"})
+    data = bytes(range(256)) * 1000
+    client.post("/notes", data={"title": "Scan"}, files={"file": ("scan.pdf", data)}, follow_redirects=False)
+    note_id = client.get("/api/notes").json()[0]["id"]
+    url = f"/attachments/{note_id}"
+
+    res = client.get(url)
+    assert res.status_code == 200
+    assert res.content == data
+    assert res.headers["content-type"] == "application/pdf"
+    assert res.headers["etag"] == f'"{hashlib.sha256(data).hexdigest()}"'
+    # a note id can be reused after a delete: only the URL naming the content is cached for good
+    assert res.headers["cache-control"] == "private, no-cache"
+    assert "immutable" in client.get(url, params={"v": hashlib.sha256(data).hexdigest()}).headers["cache-control"]
+    from main import Note, attachment_url
+    assert attachment_url(Note(id=note_id, sha256=hashlib.sha256(data).hexdigest())) == \
+        f"{url}?v={hashlib.sha256(data).hexdigest()}"
+
+    res = client.get(url, headers={"Range": "bytes=1000-1999"})
+    assert res.status_code == 206
+    assert res.content == data[1000:2000]
+    assert res.headers["content-range"] == f"bytes 1000-1999/{len(data)}"
+    assert client.get(url, headers={"Range": "bytes=-10"}).content == data[-10:]
+    assert client.get(url, headers={"Range": f"bytes={len(data)}-"}).status_code == 416
+    # an invalid range is ignored
+    res = client.get(url, headers={"Range": "bytes=2-1"})
+    assert res.status_code == 200 and res.content == data
+
+    etag, last_modified = res.headers["etag"], res.headers["last-modified"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+    # only the owner can fetch it, and the old static mount is gone
+    other = TestClient(app)
+    assert other.get(url).status_code == 401
+    assert client.get(f"/uploads/{hashlib.sha256(data).hexdigest()}").status_code == 404
+
+    # a blob missing from disk is a 404, not a 500
+    from blobs import blob_path
+    os.remove(blob_path(hashlib.sha256(data).hexdigest(), str(tmp_path / "uploads")))
+    assert client.get(url).status_code == 404
+
+
+def test_batch_notes_atomic_and_best_effort():
+    client.post("/api/register", json={"username": "cal", "email": "cal@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "cal@example.com", "password": "secret123"})
+    keep = client.post("/api/notes", json={"title": "Keep", "content": "old"}).json()["id"]
+    drop = client.post("/api/notes", json={"title": "Drop", "content": "bye"}).json()["id"]
+
+    # atomic: one bad item rejects the whole batch
+    res = client.post("/api/notes/batch", json={"ops": [
+        {"op": "create", "title": "New", "content": "fresh"},
+        {"op": "delete", "id": 9999},
+    ]})
+    assert res.status_code == 400
+    assert res.json()["committed"] is False
+    assert [r["status"] for r in res.json()["results"]] == ["error", "error"]
+    assert len(client.get("/api/notes").json()) == 2
+
+    res = client.post("/api/notes/batch", json={"mode": "best_effort", "ops": [
+        {"op": "create", "title": "New", "content": "fresh kiwi"},
+        {"op": "update", "id": keep, "title": "Keep", "content": "new kiwi"},
+        {"op": "delete", "id": drop},
+        {"op": "delete", "id": 9999},
+        {"op": "update", "id": keep, "title": "Twice", "content": "x"},
+    ]})
+    assert res.status_code == 200
+    results = res.json()["results"]
+    assert [r["status"] for r in results] == ["ok", "ok", "ok", "error", "error"]
+    assert results[3]["error"] == "Note not found"
+
+    notes = {n["id"]: n for n in client.get("/api/notes").json()}
+    assert set(notes) == {keep, results[0]["id"]}
+    assert notes[keep]["content"] == "new kiwi"
+    assert len(client.get("/api/notes/search", params={"q": "kiwi"}).json()) == 2
+    assert client.get("/api/notes/search", params={"q": "bye"}).json() == []
+
+
+def test_export_and_import_round_trip(monkeypatch, tmp_path):
+    import io
+    import zipfile
+    import main
+
+    monkeypatch.chdir(tmp_path)
+    client.post("/api/register", json={"username": "ada", "email": "ada@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "ada@example.com", "password": "secret123"})
+    data = os.urandom(50_000)
+    client.post("/notes", data={"title": "Scan", "content": "page one"}, files={"file": ("scan.png", data)},
+                follow_redirects=False)
+    client.post("/notes", data={"title": "Same scan"}, files={"file": ("copy.png", data)}, follow_redirects=False)
+    client.post("/api/notes", json={"title": "Plain", "content": "quince jam"})
+
+    res = client.get("/api/notes/export")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/zip"
+    exported = zipfile.ZipFile(io.BytesIO(res.content))
+    assert exported.testzip() is None
+    # the shared file is in the archive once
+    assert len([name for name in exported.namelist() if name.startswith("attachments/")]) == 1
+
+    client.cookies.clear()
+    client.post("/api/register", json={"username": "bea", "email": "bea@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "bea@example.com", "password": "secret123"})
+    # two notes per transaction, so the import takes two batches
+    monkeypatch.setattr(main.settings, "IMPORT_BATCH_SIZE", 2)
+    res = client.post("/api/notes/import", files={"file": ("backup.zip", res.content, "application/zip")})
+    assert res.json() == {"imported": 3, "attachments": 1}
+
+    notes = client.get("/api/notes").json()
+    assert [(n["title"], n["filename"]) for n in notes] == [("Scan", "scan.png"), ("Same scan", "copy.png"),
+                                                            ("Plain", None)]
+    assert client.get(f"/attachments/{notes[1]['id']}").content == data
+    assert len(client.get("/api/notes/search", params={"q": "quince"}).json()) == 1
+    from database import SessionLocal
+    from models import Blob
+    with SessionLocal() as db:
+        assert [blob.refcount for blob in db.query(Blob)] == [4]
+    assert os.listdir(tmp_path / "uploads" / "tmp") == []
+
+    # a broken line is reported with its number; notes of earlier batches stay imported
+    broken = io.BytesIO()
+    with zipfile.ZipFile(broken, "w") as out:
+        out.writestr("notes.ndjson", '{"title": "a"}\n{"title": "b"}\n{"content": "no title"}\n')
+    res = client.post("/api/notes/import", files={"file": ("broken.zip", broken.getvalue())})
+    assert res.status_code == 400
+    assert res.json() == {"detail": "notes.ndjson line 3: title: Field required", "imported": 2}
+    assert client.post("/api/notes/import", files={"file": ("x.zip", b"not a zip")}).status_code == 400
+
+    # what the files uncompress to is capped for the whole import, not just per file: a file shared by
+    # notes of several batches is read once per batch
+    monkeypatch.setattr(main.settings, "MAX_IMPORT_EXPANDED_BYTES", 1_000_000)
+    monkeypatch.setattr(main.settings, "IMPORT_BATCH_SIZE", 1)
+    bomb = io.BytesIO()
+    with zipfile.ZipFile(bomb, "w", zipfile.ZIP_DEFLATED) as out:
+        out.writestr("notes.ndjson", "".join(json.dumps({"title": f"t{i}", "attachment": "attachments/x"}) + "\n"
+                                             for i in range(3)))
+        out.writestr("attachments/x", b"\0" * 400_000)
+    res = client.post("/api/notes/import", files={"file": ("bomb.zip", bomb.getvalue())})
+    assert res.status_code == 413
+    assert os.listdir(tmp_path / "uploads" / "tmp") == []
+    assert len(client.get("/api/notes").json()) == 5 + 2
+    # and an archive whose headers already say too much is refused before anything is read
+    monkeypatch.setattr(main.settings, "MAX_IMPORT_EXPANDED_BYTES", 100_000)
+    assert client.post("/api/notes/import", files={"file": ("bomb.zip", bomb.getvalue())}).status_code == 413
+    assert len(client.get("/api/notes").json()) == 5 + 2
+
+
+def test_note_revisions_are_kept_as_deltas(monkeypatch):
+    import revisions
+    from database import SessionLocal
+    from models import NoteRevision
+
+    monkeypatch.setattr(revisions, "SNAPSHOT_INTERVAL", 3)
+    client.post("/api/register", json={"username": "rex", "email": "rex@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "rex@example.com", "password": "secret123"})
+    import random
+    rng = random.Random(7)
+    text = "".join(f"{i}: " + " ".join(rng.choice(["fox", "dog", "lazy", "quick", "brown", "jumps", "over"])
+                                       + str(rng.randrange(1000)) for _ in range(10)) + "\n" for i in range(40))
+    note_id = client.post("/api/notes", json={"title": "Fox", "content": text}).json()["id"]
+    assert client.get(f"/api/notes/{note_id}/revisions").json() == []
+
+    versions = [text]
+    for i in range(6):
+        versions.append(versions[-1].replace("lazy", f"sleepy{i}", 1) + f"edit {i}\n")
+        if i == 3:
+            res = client.post("/api/notes/batch", json={"ops": [
+                {"op": "update", "id": note_id, "title": f"Fox {i}", "content": versions[-1]}]})
+            assert res.json()["committed"]
+        else:
+            client.put(f"/api/notes/{note_id}", json={"title": f"Fox {i}", "content": versions[-1]})
+    # saving the same text again is not a revision
+    client.put(f"/api/notes/{note_id}", json={"title": "Fox 5", "content": versions[-1]})
+
+    listed = client.get(f"/api/notes/{note_id}/revisions", params={"limit": 4})
+    assert [r["number"] for r in listed.json()] == [7, 6, 5, 4]
+    assert listed.headers["X-Next-Cursor"] == "4"
+    for number, content in enumerate(versions, 1):
+        revision = client.get(f"/api/notes/{note_id}/revisions/{number}").json()
+        assert revision["content"] == content
+        assert revision["title"] == ("Fox" if number == 1 else f"Fox {number - 2}")
+    assert client.get(f"/api/notes/{note_id}/revisions/8").status_code == 404
+
+    with SessionLocal() as db:
+        stored = {r.number: len(r.data) for r in db.query(NoteRevision)}
+    # 1, 4 and 7 are snapshots; the deltas in between are a fraction of their size
+    assert max(stored[n] for n in (2, 3, 5, 6)) * 3 < min(stored[n] for n in (1, 4, 7))
+
+    res = client.post(f"/api/notes/{note_id}/revisions/1/restore")
+    assert res.json()["content"] == text
+    assert client.get(f"/api/notes/{note_id}/revisions/8").json()["content"] == text
+    assert len(client.get("/api/notes/search", params={"q": "sleepy5"}).json()) == 0
+
+    client.delete(f"/api/notes/{note_id}")
+    with SessionLocal() as db:
+        assert db.query(NoteRevision).count() == 0
+
+
+def test_list_fields_excerpts_and_compressed_content():
+    from sqlalchemy import select
+    from database import SessionLocal
+    from models import COMPRESS_ABOVE, EXCERPT_LENGTH, Note
+
+    client.post("/api/register", json={"username": "lena", "email": "lena@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "lena@example.com", "password": "secret123"})
+    long_text = "The quick brown fox jumps over the lazy dog.\n" * 200
+    big_id = client.post("/api/notes", json={"title": "Big", "content": long_text}).json()["id"]
+    client.post("/api/notes/batch", json={"ops": [{"op": "create", "title": "Small", "content": "Just  a\nline"}]})
+
+    res = client.get("/api/notes", params={"fields": "title,excerpt"})
+    assert [sorted(note) for note in res.json()] == [["excerpt", "id", "title"]] * 2
+    big, small = res.json()
+    assert small["excerpt"] == "Just a line"
+    assert big["excerpt"].endswith("…") and len(big["excerpt"]) <= EXCERPT_LENGTH + 1
+    assert long_text.replace("\n", " ").startswith(big["excerpt"][:-1])
+    # the default is unchanged, and each projection is its own ETag
+    assert sorted(client.get("/api/notes").json()[0]) == ["content", "filename", "id", "title"]
+    assert res.headers["etag"] != client.get("/api/notes").headers["etag"]
+    streamed = client.get("/api/notes", params={"fields": "updated_at", "stream": True}).text.splitlines()
+    assert sorted(json.loads(streamed[0])) == ["id", "updated_at"]
+    assert client.get("/api/notes", params={"fields": "title,password"}).status_code == 400
+
+    with SessionLocal() as db:
+        stored = db.connection().exec_driver_sql("SELECT typeof(content), length(content) FROM notes "
+                                                 "WHERE id = ?", (big_id,)).one()
+        # listing notes leaves the body unloaded
+        note = db.scalars(select(Note).where(Note.id == big_id)).one()
+        assert "content" not in note.__dict__
+    assert len(long_text) > COMPRESS_ABOVE
+    assert stored[0] == "blob" and stored[1] < len(long_text) / 10
+    assert client.get(f"/api/notes/{big_id}").json()["content"] == long_text
+    assert client.put(f"/api/notes/{big_id}", json={"title": "Big", "content": "short now"}).json()["content"] == "short now"
+    assert client.get("/api/notes", params={"fields": "excerpt"}).json()[0]["excerpt"] == "short now"
+    assert len(client.get("/api/notes/search", params={"q": "lazy"}).json()) == 0
+
+
+def test_legacy_attachment_cannot_escape_uploads(monkeypatch, tmp_path):
+    from database import SessionLocal
+    from models import Note
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "old.txt").write_bytes(b"legacy")
+    (tmp_path / "secret.db").write_bytes(b"not yours")
+    client.post("/api/register", json={"username": "yves", "email": "yves@example.com", "password": "secret123"})
+    client.post("/api/login", json={"email": "yves@example.com", "password": "secret123"})
+    with SessionLocal() as db:
+        user = db.query(User).filter(User.email == "yves@example.com").first()
+        ok, evil = Note(title="ok", filename="old.txt", user_id=user.id), \
+            Note(title="evil", filename="../secret.db", user_id=user.id)
+        db.add_all([ok, evil])
+        db.commit()
+        ok_id, evil_id = ok.id, evil.id
+
+    assert client.get(f"/attachments/{ok_id}").content == b"legacy"
+    assert client.get(f"/attachments/{evil_id}").status_code == 404
+
+
+# ------------------------
+# MAIL OUTBOX TESTS
+# ------------------------
+
+def test_logins_and_reset_requests_are_rate_limited(monkeypatch):
+    import asyncio
+    import time
+    from database import AsyncSessionLocal
+    from ratelimit import Budget, RateLimited, RateLimiter, SQLiteBuckets
+
+    client.post("/api/register", json={"username": "olga", "email": "olga@example.com", "password": "secret123"})
+    for _ in range(10):
+        assert client.post("/api/login", json={"email": "olga@example.com", "password": "wrong"}).status_code == 401
+    # the account's budget is spent, whoever asks and whatever the password
+    res = client.post("/login", data={"email": "Olga@example.com", "password": "secret123"})
+    assert res.status_code == 429 and int(res.headers["retry-after"]) >= 1
+    assert client.post("/api/login", json={"email": "nobody@example.com", "password": "x"}).status_code == 401
+
+    for _ in range(3):
+        assert client.post("/forgot-password", data={"email": "olga@example.com"}).status_code == 200
+    assert client.post("/forgot-password", data={"email": "olga@example.com"}).status_code == 429
+    assert "rate_limited_requests_total{budget=\"reset\"} 1" in client.get("/metrics").text
+
+    # shared buckets: two limiters over one table behave as one
+    clock = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: clock[0])
+    budgets = {"login": Budget(2, 10)}
+    first, second = (RateLimiter(budgets, SQLiteBuckets(AsyncSessionLocal)) for _ in range(2))
+
+    async def run():
+        await first.hit({"login": "10.0.0.1"})
+        await second.hit({"login": "10.0.0.1"})
+        with pytest.raises(RateLimited) as refused:
+            await first.hit({"login": "10.0.0.1"})
+        await second.hit({"login": "10.0.0.2"})
+        clock[0] += 5  # one token back
+        await first.hit({"login": "10.0.0.1"})
+        clock[0] += 60
+        purged = await first.store.purge(10)
+        await async_engine.dispose()
+        return refused.value.headers["Retry-After"], purged
+
+    assert asyncio.run(run()) == ("5", 2)
+
+
+def test_admission_control_queues_then_sheds():
+    import asyncio
+    from ratelimit import AdmissionControlMiddleware
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def app(scope, receive, send):
+            await gate.wait()
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        admission = AdmissionControlMiddleware(app, max_in_flight=2, max_queued=2, queue_timeout=0.5)
+
+        async def request(path="/api/notes"):
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+            await admission({"type": "http", "method": "GET", "path": path, "headers": []}, None, send)
+            return sent[0]["status"], dict(sent[0]["headers"]).get(b"retry-after")
+
+        tasks = [asyncio.create_task(request()) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        # two running, two queued: the fifth is turned away at once
+        assert await request() == (503, b"1")
+        gate.set()
+        assert [await task for task in tasks] == [(200, None)] * 4
+        assert admission.in_flight == 0
+
+        gate.clear()
+        tasks = [asyncio.create_task(request()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        ping = asyncio.create_task(request("/ping"))  # exempt, never queued
+        statuses = await asyncio.gather(tasks[2])  # waited past queue_timeout
+        gate.set()
+        return statuses + [await task for task in tasks[:2]] + [await ping], admission.in_flight
+
+    statuses, in_flight = asyncio.run(run())
+    assert statuses == [(503, b"1"), (200, None), (200, None), (200, None)]
+    assert in_flight == 0
+
+
+def test_reset_requests_are_queued_and_deduplicated():
+    import asyncio
+    import email
+    import email.policy
+    import socket
+    from aiosmtpd.controller import Controller
+    from database import AsyncSessionLocal, SessionLocal
+    from mailer import MailWorker, SmtpConfig
+    from models import OutboxMessage
+
+    client.post("/api/register", json={"username": "yara", "email": "yara@example.com", "password": "secret123"})
+    for _ in range(3):
+        assert client.post("/forgot-password", data={"email": "yara@example.com"}).status_code == 200
+
+    with SessionLocal() as db:
+        assert db.query(OutboxMessage).count() == 1
+        token = db.query(User).filter(User.email == "yara@example.com").first().reset_token
+
+    class Inbox:
+        messages = []
+
+        async def handle_DATA(self, server, session, envelope):
+            self.messages.append(envelope)
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        worker = MailWorker(AsyncSessionLocal, SmtpConfig(hostname="127.0.0.1", port=port, sender="notes@example.com"))
+        assert asyncio.run(worker.drain_once()) == 1
+        assert asyncio.run(worker.drain_once()) == 0
+    finally:
+        controller.stop()
+
+    assert len(inbox.messages) == 1
+    assert inbox.messages[0].rcpt_tos == ["yara@example.com"]
+    body = email.message_from_bytes(inbox.messages[0].content, policy=email.policy.default).get_content()
+    assert f"/reset-password/{token}" in body
+    with SessionLocal() as db:
+        assert db.query(OutboxMessage).one().status == "sent"
+
+
+def test_mail_worker_backs_off_when_smtp_is_down():
+    import asyncio
+    from database import AsyncSessionLocal, SessionLocal
+    from mailer import MailWorker, SmtpConfig
+    from models import OutboxMessage, utcnow
+
+    client.post("/api/register", json={"username": "zack", "email": "zack@example.com", "password": "secret123"})
+    client.post("/forgot-password", data={"email": "zack@example.com"})
+
+    worker = MailWorker(AsyncSessionLocal, SmtpConfig(hostname="127.0.0.1", port=1, sender="notes@example.com",
+                                                      timeout=2))
+    assert asyncio.run(worker.drain_once()) == 1
+
+    with SessionLocal() as db:
+        message = db.query(OutboxMessage).one()
+        assert message.status == "pending"
+        assert message.attempts == 1
+        assert message.last_error
+        assert message.next_attempt_at > utcnow()
+
+
+def test_mail_worker_without_mail_settings_keeps_mail_queued(monkeypatch):
+    import asyncio
+    import main
+    from database import AsyncSessionLocal, SessionLocal
+    from mailer import MailWorker
+    from models import OutboxMessage
+
+    monkeypatch.setattr(main.settings, "MAIL_USERNAME", None)
+    client.post("/api/register", json={"username": "zoe", "email": "zoe@example.com", "password": "secret123"})
+    client.post("/forgot-password", data={"email": "zoe@example.com"})
+
+    # the SMTP settings are only looked at once there is something to send
+    worker = MailWorker(AsyncSessionLocal, main.smtp_config)
+    with pytest.raises(RuntimeError, match="MAIL_USERNAME"):
+        asyncio.run(worker.drain_once())
+    with SessionLocal() as db:
+        message = db.query(OutboxMessage).one()
+        assert message.status == "pending" and message.attempts == 0
+
+
+def test_import_has_no_side_effects_and_lifespan_prepares_the_app(tmp_path):
+    import subprocess
+
+    # a fresh interpreter in an empty directory, without any MAIL_* settings
+    env = {name: value for name, value in os.environ.items() if not name.startswith("MAIL_")}
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = """
+import os, sqlite3
+import main
+from fastapi.testclient import TestClient
+from migrations import LATEST_VERSION
+
+assert os.listdir(".") == [], os.listdir(".")
+with TestClient(main.app) as client:
+    assert client.get("/ping").json() == {"status": "ok"}
+assert os.path.isdir("uploads")
+with sqlite3.connect("notes.db") as conn:
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == LATEST_VERSION
+"""
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True,
+                            timeout=120)
+    assert result.returncode == 0, result.stderr
+
+
+def test_passwords_are_hashed_and_plaintext_rows_upgraded():
+    from database import SessionLocal
+
+    client.post("/api/register", json={"username": "amy", "email": "amy@example.com", "password": "secret123"})
+    with SessionLocal() as db:
+        stored = db.query(User).filter(User.email == "amy@example.com").first().password
+        assert stored.startswith("scrypt$") and "secret123" not in stored
+
+        # a row written before hashing existed
+        db.add(User(username="ben", email="ben@example.com", password="legacy-pass"))
+        db.commit()
+
+    res = client.post("/api/login", json={"email": "ben@example.com", "password": "legacy-pass"})
+    assert res.status_code == 200
+    with SessionLocal() as db:
+        assert db.query(User).filter(User.email == "ben@example.com").first().password.startswith("scrypt$")
+
+    assert client.post("/api/login", json={"email": "ben@example.com", "password": "legacy-pass"}).status_code == 200
+    assert client.post("/api/login", json={"email": "ben@example.com", "password": "wrong"}).status_code == 401
+    assert client.post("/api/login", json={"email": "nobody@example.com", "password": "x"}).status_code == 401
+
+
+def test_notes_are_sharded_per_user_and_rebalanced(monkeypatch, tmp_path):
+    import sqlite3
+    import main
+    from database import SessionLocal
+    from models import Note
+    from shards import ShardSet, jump_hash, rebalance, shard_path
+
+    shard_dir = str(tmp_path / "shards")
+    sharded = ShardSet(2, shard_dir)
+    sharded.init()
+    monkeypatch.setattr(main, "shards", sharded)
+
+    def rows(index, table="notes", columns="user_id, title"):
+        with sqlite3.connect(os.path.join(shard_path(shard_dir, index), "notes.db")) as conn:
+            return conn.execute(f"SELECT {columns} FROM {table}").fetchall()
+
+    users = {}
+    for name in ("ada", "bea", "cal", "dan"):
+        client.cookies.clear()
+        users[name] = client.post("/api/register", json={"username": name, "email": f"{name}@example.com",
+                                                         "password": "secret123"}).json()["id"]
+        client.post("/api/login", json={"email": f"{name}@example.com", "password": "secret123"})
+        client.post("/api/notes", json={"title": f"{name} one", "content": "quince"})
+        client.post("/api/notes/batch", json={"ops": [{"op": "create", "title": f"{name} two"}]})
+        assert [n["title"] for n in client.get("/api/notes").json()] == [f"{name} one", f"{name} two"]
+        assert len(client.get("/api/notes/search", params={"q": "quince"}).json()) == 1
+
+    # each user's notes are in the shard their id hashes to, and nothing is left in notes.db
+    for name, user_id in users.items():
+        for index in range(2):
+            expected = 2 if jump_hash(user_id, 2) == index else 0
+            assert len([row for row in rows(index) if row[0] == user_id]) == expected
+    with SessionLocal() as db:
+        assert db.query(Note).count() == 0
+    ids = sorted(row[0] for index in range(2) for row in rows(index, "notes", "id"))
+    assert len(set(ids)) == 8
+
+    # more shards than the layout in notes.db: refused until rebalanced
+    with pytest.raises(RuntimeError):
+        ShardSet(3, shard_dir).init()
+    assert rebalance(3, shard_dir) > 0
+    for shard in sharded.shards:
+        shard.database.engine.dispose()
+
+    resharded = ShardSet(3, shard_dir)
+    resharded.init()
+    monkeypatch.setattr(main, "shards", resharded)
+    note_reads.clear()
+    for name, user_id in users.items():
+        client.cookies.clear()
+        client.post("/api/login", json={"email": f"{name}@example.com", "password": "secret123"})
+        notes = client.get("/api/notes").json()
+        assert [n["title"] for n in notes] == [f"{name} one", f"{name} two"]
+        assert {n["id"] for n in notes} <= set(ids)  # notes keep their ids when they move
+        assert len(client.get("/api/notes/search", params={"q": "quince"}).json()) == 1
+        assert [row[0] for row in rows(jump_hash(user_id, 3))].count(user_id) == 2
+    assert sorted(row[0] for index in range(3) for row in rows(index, "notes", "id")) == ids
+    for shard in resharded.shards:
+        shard.database.engine.dispose()
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+
+from metrics import UPLOAD_BYTES
+
+CHUNK_SIZE = 1024 * 1024
+
+# room for the other multipart fields (title, content) on top of the file itself
+FORM_OVERHEAD_BYTES = 256 * 1024
+
+
+class UploadTooLarge(HTTPException):
+    # an HTTPException so it becomes a 413 wherever it is raised, including
+    # from inside FastAPI's form parsing (which turns other errors into 400s)
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"Upload exceeds {max_bytes} bytes")
+
+
+@dataclass
+class StoredUpload:
+    path: str
+    size: int
+    sha256: str
+    created: bool = False  # set by blobs.store_upload when this upload added a new blob file
+
+
+def _write_chunk(out, digest, chunk: bytes):
+    # runs on a worker thread; both the write and sha256 release the GIL on large buffers
+    digest.update(chunk)
+    out.write(chunk)
+
+
+async def save_upload(upload, directory: str, max_bytes: int) -> StoredUpload:
+    """Stream `upload` into a temp file in `directory`, hashing it on the way.
+
+    Chunks are written on a worker thread. The returned path is a complete
+    file; the caller moves it into place with os.replace() (atomic within
+    `directory`'s filesystem, so readers never see a partial file) or
+    deletes it. Raises UploadTooLarge, leaving nothing behind, as soon as
+    more than `max_bytes` have been read.
+    """
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := await upload.read(CHUNK_SIZE):
+                size += len(chunk)
+                UPLOAD_BYTES.inc(len(chunk))
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                await run_in_threadpool(_write_chunk, out, digest, chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return StoredUpload(path=tmp_path, size=size, sha256=digest.hexdigest())
+
+
+class UploadSizeLimitMiddleware:
+    """Reject request bodies larger than `max_bytes` while they are being received.
+
+    Form parsing spools the whole body before a handler runs, so the cap in
+    save_upload() alone would only fire after a huge upload had already been
+    written to a temp file. This checks Content-Length up front and counts
+    bytes as they arrive for chunked bodies.
+    """
+
+    def __init__(self, app, max_bytes: int, paths=("/notes",)):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            try:
+                content_length = int(content_length)
+            except ValueError:
+                response = JSONResponse({"detail": "Invalid Content-Length header"}, status_code=400)
+                return await response(scope, receive, send)
+            if content_length > self.max_bytes:
+                response = JSONResponse({"detail": f"Upload exceeds {self.max_bytes} bytes"}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise UploadTooLarge(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,63 @@
+import hashlib
+from typing import Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from starlette.responses import Response
+
+from attachments import etag_matches
+from models import NotesVersion
+
+# clients may keep note responses but must revalidate them on every use
+NOTES_CACHE_CONTROL = "private, no-cache"
+
+# called with the user id by bump_notes_version(), e.g. to drop what this worker cached for them
+_change_listeners = []
+
+
+def on_notes_changed(listener: Callable[[int], None]):
+    _change_listeners.append(listener)
+
+
+async def bump_notes_version(db, user_id: int):
+    """Record that some note of `user_id` changed. Call in the same transaction as the change."""
+    await db.execute(insert(NotesVersion).values(user_id=user_id, version=1)
+                     .on_conflict_do_update(index_elements=[NotesVersion.user_id],
+                                            set_={"version": NotesVersion.version + 1}))
+    for listener in _change_listeners:
+        listener(user_id)
+
+
+async def notes_version(db, user_id: int) -> int:
+    # no row yet: the user's notes have never changed
+    return await db.scalar(select(NotesVersion.version).where(NotesVersion.user_id == user_id)) or 0
+
+
+def format_etag(user_id: int, version: Optional[int], variant: str = "") -> str:
+    tag = f"{user_id}.{version}"
+    if variant:
+        tag += "." + hashlib.sha256(variant.encode()).hexdigest()[:16]
+    return f'W/"{tag}"'
+
+
+async def notes_etag(db, user_id: int, variant: str = "") -> str:
+    """Weak ETag for a user's notes at their current version.
+
+    `variant` tells apart representations served from one version (e.g.
+    different pages of the list). Costs one primary-key lookup, so a
+    conditional request is answered without loading any notes.
+    """
+    return format_etag(user_id, await notes_version(db, user_id), variant)
+
+
+def not_modified(request, etag: str) -> Optional[Response]:
+    """A 304 response if the request's If-None-Match matches `etag`, else None."""
+    header = request.headers.get("if-none-match")
+    if header is None or not etag_matches(header, etag):
+        return None
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": NOTES_CACHE_CONTROL})
+
+
+def set_cache_headers(response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = NOTES_CACHE_CONTROL